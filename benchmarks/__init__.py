@@ -0,0 +1,4 @@
+"""Benchmarks for `homekit_mqtt`. Run them from the repository root, e.g.
+
+    python -m benchmarks.bench_decode
+"""
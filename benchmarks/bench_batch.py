@@ -0,0 +1,153 @@
+"""
+Replays bursts of Tasmota messages (stat/RESULT, stat/POWER, tele/STATE and
+tele/SENSOR of one device, back to back) and compares dispatching every
+message on its own with collecting the messages of a device for BatchWindow
+seconds and applying them in one pass.
+
+The bursts are replayed at --rate bursts per second and as fast as possible.
+Reported are the CPU time per message of the whole process, the HomeKit
+events and the thread hops from the dispatching thread to the event loop of
+the driver. Unthrottled, a device sends several bursts within one window,
+which are merged into one update.
+
+Run from the repository root: python -m benchmarks.bench_batch
+"""
+
+import os
+import json
+import time
+import asyncio
+import argparse
+import threading
+
+from pyhap.accessory_driver import AccessoryDriver
+
+from homekit_mqtt import cfg_loader
+from homekit_mqtt.mqtt_bridge import MqttBridge
+
+from benchmarks.common import BRIDGE_CFG, config_dir
+
+PLUG_CFG = """
+[Accessory]
+Category = Outlet
+DisplayName = {name}
+
+[Outlet]
+On = +/{name}/+ cmnd/{name}/POWER tasmota.POWER
+OutletInUse = tele/{name}/STATE _ json path=POWER map=ON:1,OFF:0
+"""
+
+
+def bursts(plugs, n):
+    """
+    Return n bursts of 4 messages, cycling through the plugs
+    """
+    messages = []
+    for i in range(n):
+        name = 'Plug{}'.format(i % plugs)
+        power = 'ON' if (i // plugs) % 2 else 'OFF'
+        messages += [
+            ('stat/{}/RESULT'.format(name),
+             json.dumps({'POWER': power}).encode()),
+            ('stat/{}/POWER'.format(name), power.encode()),
+            ('tele/{}/STATE'.format(name), json.dumps({
+                'Time': '2026-10-16T12:00:00', 'UptimeSec': 3600 + i,
+                'POWER': power, 'Wifi': {'RSSI': 70}}).encode()),
+            ('tele/{}/SENSOR'.format(name), json.dumps({
+                'Time': '2026-10-16T12:00:00',
+                'ENERGY': {'Power': i % 100, 'Voltage': 230}}).encode()),
+        ]
+    return messages
+
+
+def measure(cfg, messages, rate):
+    # the driver belongs to the thread running its loop, like in the CLI
+    ready = threading.Event()
+    drivers = []
+
+    def run_loop():
+        drivers.append(AccessoryDriver(
+            port=51826, persist_file=os.path.join(cfg, 'accessory.state')))
+        ready.set()
+        drivers[0].loop.run_forever()
+
+    thread = threading.Thread(target=run_loop, daemon=True)
+    thread.start()
+    ready.wait()
+    driver = drivers[0]
+
+    bridge = MqttBridge(cfg, driver, 'MQTT')
+    bridge.client.publish = lambda *args, **kwargs: None
+    for acc in cfg_loader.CfgLoader(driver, cfg).load_accessories():
+        bridge.add_accessory(acc)
+    bridge._compile_dispatch()
+
+    # count the events and the hops of AccessoryDriver.publish
+    counts = {'events': 0, 'hops': 0}
+
+    def count_event():
+        counts['events'] += 1
+
+    def publish(data, *args, **kwargs):
+        if threading.current_thread() == driver.tid:
+            count_event()
+        else:
+            counts['hops'] += 1
+            driver.loop.call_soon_threadsafe(count_event)
+
+    driver.publish = publish
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    for i in range(0, len(messages), 4):
+        if rate > 0:
+            delay = start + i / 4 / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        for topic, payload in messages[i:i + 4]:
+            bridge.update_char(topic, payload)
+
+    # wait for the last batches and events
+    if bridge.batcher is not None:
+        while bridge.batcher.pending:
+            time.sleep(0.0005)
+    asyncio.run_coroutine_threadsafe(asyncio.sleep(0), driver.loop).result()
+    cpu = time.process_time() - cpu
+
+    driver.loop.call_soon_threadsafe(driver.loop.stop)
+    thread.join(5.0)
+    bridge.timers.stop()
+
+    return cpu / len(messages), counts['events'], counts['hops']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=5000,
+                        help='number of bursts')
+    parser.add_argument('--plugs', type=int, default=50,
+                        help='number of devices')
+    parser.add_argument('--window', type=float, default=0.005,
+                        help='BatchWindow in seconds')
+    parser.add_argument('--rate', type=float, default=2000,
+                        help='bursts per second')
+    args = parser.parse_args()
+
+    messages = bursts(args.plugs, args.n)
+    accessories = {'plug{}.cfg'.format(i): PLUG_CFG.format(
+        name='Plug{}'.format(i)) for i in range(args.plugs)}
+
+    print('{:>10s}  {:14s}{:>12s}{:>10s}{:>10s}'.format(
+        'bursts/s', 'mode', 'CPU [us/msg]', 'events', 'hops'))
+    for rate in (args.rate, 0):
+        for name, window in (('per-message', 0), ('batched', args.window)):
+            bridge_cfg = BRIDGE_CFG + 'BatchWindow = {}\n'.format(window)
+            with config_dir(accessories, bridge_cfg) as cfg:
+                cpu, events, hops = measure(cfg, messages, rate)
+            print('{:>10s}  {:14s}{:12.1f}{:10d}{:10d}'.format(
+                str(int(rate)) if rate else 'max', name, cpu * 1e6, events,
+                hops))
+
+
+if __name__ == '__main__':
+    main()
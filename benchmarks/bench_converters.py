@@ -0,0 +1,118 @@
+"""
+Micro-benchmark of the MQTT -> HAP and HAP -> MQTT converters for every HAP
+format: the former if/elif chain, the lookup per call (mqtt2hap, hap2var)
+and the converter resolved once per characteristic.
+"""
+
+import json
+import argparse
+import timeit
+
+import pyhap.characteristic as pyhap_char
+
+from homekit_mqtt import mqtt_bridge
+
+# (format, MQTT payload, HAP value)
+SAMPLES = [
+    (pyhap_char.HAP_FORMAT_BOOL, 'true', True),
+    (pyhap_char.HAP_FORMAT_INT, '42', 42),
+    (pyhap_char.HAP_FORMAT_FLOAT, '21.5', 21.5),
+    (pyhap_char.HAP_FORMAT_STRING, 'foo', 'foo'),
+    (pyhap_char.HAP_FORMAT_ARRAY, '[1, 2, 3]', [1, 2, 3]),
+    (pyhap_char.HAP_FORMAT_DICTIONARY, '{"x": 1}', {'x': 1}),
+    (pyhap_char.HAP_FORMAT_UINT8, '100', 100),
+    (pyhap_char.HAP_FORMAT_UINT16, '1000', 1000),
+    (pyhap_char.HAP_FORMAT_UINT32, '100000', 100000),
+    (pyhap_char.HAP_FORMAT_UINT64, '10000000000', 10000000000),
+    (pyhap_char.HAP_FORMAT_DATA, 'ZGF0YQ==', 'ZGF0YQ=='),
+    (pyhap_char.HAP_FORMAT_TLV8, 'AQEB', 'AQEB'),
+]
+
+
+def chain_mqtt2hap(hap_format, value):
+    """The if/elif chain formerly used by mqtt2hap"""
+    if hap_format == pyhap_char.HAP_FORMAT_BOOL:
+        if value == b'true':
+            return True
+        return bool(value)
+    elif hap_format == pyhap_char.HAP_FORMAT_FLOAT:
+        return float(value)
+    elif hap_format == pyhap_char.HAP_FORMAT_ARRAY:
+        return json.loads(value)
+    elif hap_format == pyhap_char.HAP_FORMAT_DICTIONARY:
+        return json.loads(value)
+    elif hap_format == pyhap_char.HAP_FORMAT_TLV8:
+        return str(value)
+    elif hap_format in pyhap_char.HAP_FORMAT_NUMERICS:
+        return int(value)
+    elif hap_format in [pyhap_char.HAP_FORMAT_STRING,
+                        pyhap_char.HAP_FORMAT_DATA]:
+        return str(value)
+
+    return str(value)
+
+
+def chain_hap2var(hap_format, value):
+    """The if/elif chain formerly used by hap2var"""
+    if hap_format == pyhap_char.HAP_FORMAT_BOOL:
+        return bool(value)
+    elif hap_format == pyhap_char.HAP_FORMAT_FLOAT:
+        return float(value)
+    elif hap_format == pyhap_char.HAP_FORMAT_STRING:
+        return str(value)
+    elif hap_format == pyhap_char.HAP_FORMAT_ARRAY:
+        return json.dumps(value)
+    elif hap_format == pyhap_char.HAP_FORMAT_DICTIONARY:
+        return json.dumps(value)
+    elif hap_format == pyhap_char.HAP_FORMAT_DATA:
+        return str(value)
+    elif hap_format == pyhap_char.HAP_FORMAT_TLV8:
+        return str(value)
+    elif hap_format in pyhap_char.HAP_FORMAT_NUMERICS:
+        return int(value)
+
+    return str(value)
+
+
+def measure(func, args, n):
+    return timeit.timeit(lambda: func(*args), number=n) / n
+
+
+def run(n):
+    results = []
+    for hap_format, payload, value in SAMPLES:
+        mqtt2hap = mqtt_bridge.mqtt2hap_converter(hap_format)
+        hap2var = mqtt_bridge.hap2var_converter(hap_format)
+
+        results.append((hap_format, {
+            'mqtt2hap chain': measure(chain_mqtt2hap, (hap_format, payload),
+                                      n),
+            'mqtt2hap lookup': measure(mqtt_bridge.mqtt2hap,
+                                       (hap_format, payload), n),
+            'mqtt2hap compiled': measure(mqtt2hap, (payload,), n),
+            'hap2var chain': measure(chain_hap2var, (hap_format, value), n),
+            'hap2var lookup': measure(mqtt_bridge.hap2var,
+                                      (hap_format, value), n),
+            'hap2var compiled': measure(hap2var, (value,), n),
+        }))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=100000,
+                        help='number of conversions per format')
+    args = parser.parse_args()
+
+    results = run(args.n)
+    names = list(results[0][1].keys())
+    print('{:12s}'.format('ns/call') + ''.join(
+        '{:>19s}'.format(name) for name in names))
+    for hap_format, timings in results:
+        print('{:12s}'.format(hap_format) + ''.join(
+            '{:19.0f}'.format(timings[name] * 1e9) for name in names))
+
+
+if __name__ == '__main__':
+    main()
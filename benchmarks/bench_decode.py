@@ -0,0 +1,57 @@
+"""
+Messages/sec of MqttBridge.update_char for a Tasmota bulb with six
+characteristics on one RESULT topic.
+
+'per adapter' lets every adapter parse the JSON payload on its own (the
+behaviour before the payload was decoded once per message), 'decode once'
+shares the parsed payload between all adapters.
+"""
+
+import argparse
+from unittest import mock
+
+from homekit_mqtt.mqtt_bridge import MqttBridge
+
+from benchmarks import common
+
+
+get_adapter = MqttBridge.get_adapter
+
+
+def legacy_get_adapter(self, name):
+    adapter = get_adapter(self, name)
+    if adapter is None:
+        return None
+
+    # same adapter, but parsing the payload by itself
+    return type(adapter.__name__, (adapter,), {'json_input': False})
+
+
+def run(n):
+    results = {}
+    with common.config_dir({'bulb.cfg': common.BULB_CFG.format(
+            name='bulb')}) as cfg:
+        with mock.patch.object(MqttBridge, 'get_adapter', legacy_get_adapter):
+            bridge = common.make_bridge(cfg)
+        results['per adapter'] = common.rate(
+            lambda: bridge.update_char('stat/bulb/RESULT', common.RESULT), n)
+
+        bridge = common.make_bridge(cfg)
+        results['decode once'] = common.rate(
+            lambda: bridge.update_char('stat/bulb/RESULT', common.RESULT), n)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=20000,
+                        help='number of messages')
+    args = parser.parse_args()
+
+    for name, msgs in run(args.n).items():
+        print('{:12s} {:10.0f} msg/s'.format(name, msgs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Per-message latency of MqttBridge.update_char with a synthetic config of
+Tasmota bulbs, each with six characteristics on its own RESULT topic.
+"""
+
+import time
+import random
+import argparse
+
+from benchmarks import common
+
+
+def percentile(samples, p):
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+def run(topics, n):
+    accs = {'bulb{}.cfg'.format(i): common.BULB_CFG.format(
+        name='bulb{}'.format(i)) for i in range(topics)}
+
+    with common.config_dir(accs) as cfg:
+        bridge = common.make_bridge(cfg)
+
+        names = ['stat/bulb{}/RESULT'.format(i) for i in range(topics)]
+        msgs = [random.choice(names) for _ in range(n)]
+
+        samples = []
+        clock = time.perf_counter
+        for topic in msgs:
+            start = clock()
+            bridge.update_char(topic, common.RESULT)
+            samples.append(clock() - start)
+
+    samples.sort()
+    return {'p50': percentile(samples, 50), 'p99': percentile(samples, 99),
+            'mean': sum(samples) / len(samples)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--topics', type=int, default=1000,
+                        help='number of topics')
+    parser.add_argument('-n', type=int, default=20000,
+                        help='number of messages')
+    args = parser.parse_args()
+
+    for name, latency in run(args.topics, args.n).items():
+        print('{:5s} {:8.1f} us/msg'.format(name, latency * 1e6))
+
+
+if __name__ == '__main__':
+    main()
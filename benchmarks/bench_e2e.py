@@ -0,0 +1,517 @@
+"""
+End-to-end benchmark of the MqttBridge with a local fake broker and a fake
+HomeKit controller.
+
+Tasmota traffic (RESULT, STATE and SENSOR messages) is replayed through the
+broker at a fixed rate, while the controller writes characteristics. The
+accessories are generated from the traffic as config files and loaded with
+the CfgLoader. Reported are the messages handled per second, the latency from
+a MQTT message to the HomeKit event (MQTT->HAP), the latency from a write of
+the controller to the MQTT message at the broker (HAP->MQTT), the CPU usage
+and the RSS of the process. The broker runs in the same process, so it is
+included in the CPU usage.
+
+By default, synthetic traffic of --devices devices is replayed. --replay
+replays a recording instead, with one message per line as JSON
+{"topic": ..., "payload": ...} or as 'topic payload' like the output of
+'mosquitto_sub -v -t "#"'.
+
+Save the results with --output and compare a later run against them with
+--compare, which exits with 1 if a metric regressed by more than --threshold
+percent.
+
+Run from the repository root: python -m benchmarks.bench_e2e
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import resource
+import threading
+import collections
+
+from pyhap.accessory_driver import AccessoryDriver
+
+from homekit_mqtt import cfg_loader
+from homekit_mqtt.mqtt_bridge import MqttBridge
+from tests.fake_broker import FakeBroker
+
+from benchmarks.common import BULB_CFG, config_dir
+
+RESULTS_VERSION = 1
+
+PLUG_CFG = """
+[Accessory]
+Category = Outlet
+DisplayName = {name}
+
+[Outlet]
+On = stat/{name}/RESULT cmnd/{name}/POWER tasmota.POWER
+"""
+
+PLUG_STATE_CFG = """
+[Switch]
+On = tele/{name}/STATE cmnd/{name}/POWER tasmota.POWER
+"""
+
+SENSOR_CFG = """
+[Accessory]
+Category = Sensor
+DisplayName = {name}
+
+[TemperatureSensor]
+CurrentTemperature = tele/{name}/SENSOR _ json path=*.Temperature
+"""
+
+# True if higher values are better
+METRICS = collections.OrderedDict([
+    ('handled_per_sec', True),
+    ('mqtt2hap_p50_us', False),
+    ('mqtt2hap_p99_us', False),
+    ('hap2mqtt_p50_us', False),
+    ('hap2mqtt_p99_us', False),
+    ('cpu_percent', False),
+    ('rss_mb', False),
+])
+
+
+def synthetic_traffic(devices, n, seed=0):
+    """
+    Return n Tasmota messages of bulbs, plugs and sensors as (topic, payload)
+    tuples, with values changing from message to message
+
+    :param devices: the number of devices
+    :type devices: int
+
+    :param n: the number of messages
+    :type n: int
+    """
+    rand = random.Random(seed)
+    counts = [0] * devices
+    traffic = []
+    for _ in range(n):
+        device = rand.randrange(devices)
+        kind = device % 3
+        # every message of a device changes a value
+        i = counts[device] = counts[device] + 1
+        value = i % 100
+        if kind == 0:
+            name = 'Bulb{}'.format(device)
+            traffic.append(('stat/{}/RESULT'.format(name), json.dumps({
+                'POWER': 'ON' if i % 2 else 'OFF', 'Dimmer': value,
+                'Color': '1A2B3C', 'HSBColor': '{},{},{}'.format(
+                    value * 3, value, 100 - value),
+                'Channel': [10, 17, 24], 'CT': 153 + value * 3},
+                separators=(',', ':')).encode()))
+        elif kind == 1:
+            name = 'Plug{}'.format(device)
+            traffic.append(('tele/{}/STATE'.format(name), json.dumps({
+                'Time': '2026-10-16T12:00:00', 'Uptime': '0T01:00:00',
+                'UptimeSec': 3600 + i, 'Heap': 26, 'SleepMode': 'Dynamic',
+                'Sleep': 50, 'LoadAvg': 19, 'MqttCount': 1,
+                'POWER': 'ON' if i % 2 else 'OFF',
+                'Wifi': {'AP': 1, 'SSId': 'home', 'Channel': 1, 'RSSI': 70,
+                         'Signal': -65, 'LinkCount': 1,
+                         'Downtime': '0T00:00:03'}},
+                separators=(',', ':')).encode()))
+        else:
+            name = 'Sensor{}'.format(device)
+            traffic.append(('tele/{}/SENSOR'.format(name), json.dumps({
+                'Time': '2026-10-16T12:00:00',
+                'DS18B20': {'Id': '01144A0CB2AA',
+                            'Temperature': round(15 + value / 10.0, 1)},
+                'TempUnit': 'C'}, separators=(',', ':')).encode()))
+    return traffic
+
+
+def load_traffic(fname):
+    """
+    Return the messages of a recording as (topic, payload) tuples
+
+    :param fname: the recording
+    :type fname: str
+    """
+    traffic = []
+    with open(fname) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                message = json.loads(line)
+                topic, payload = message['topic'], message['payload']
+                if not isinstance(payload, str):
+                    payload = json.dumps(payload, separators=(',', ':'))
+            else:
+                topic, _, payload = line.partition(' ')
+            traffic.append((topic, payload.encode('utf-8')))
+    return traffic
+
+
+def accessory_cfgs(traffic):
+    """
+    Return the config files of the devices sending the traffic, by the
+    Tasmota topics they use
+
+    :param traffic: the messages
+    :type traffic: list of (str, bytes)
+    """
+    kinds = collections.OrderedDict()
+    for topic, payload in traffic:
+        parts = topic.split('/')
+        if len(parts) != 3:
+            continue
+        prefix, name, suffix = parts
+        kind = kinds.setdefault(name, set())
+        if suffix == 'RESULT' and b'HSBColor' in payload:
+            kind.add('bulb')
+        elif suffix in ('RESULT', 'STATE'):
+            kind.add(suffix)
+        elif suffix == 'SENSOR' and b'Temperature' in payload:
+            kind.add('sensor')
+
+    cfgs = {}
+    for name, kind in kinds.items():
+        if 'bulb' in kind:
+            content = BULB_CFG.format(name=name)
+        elif 'RESULT' in kind or 'STATE' in kind:
+            content = PLUG_CFG.format(name=name)
+            if 'STATE' in kind:
+                content += PLUG_STATE_CFG.format(name=name)
+        elif 'sensor' in kind:
+            content = SENSOR_CFG.format(name=name)
+        else:
+            continue
+        cfgs['{}.cfg'.format(name.lower())] = content
+    return cfgs
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(p * (len(values) - 1))]
+
+
+def rss_mb():
+    """
+    Return the current RSS of the process in MB
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        # peak RSS, in kB on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** (20 if sys.platform == 'darwin' else 10)
+
+
+class Controller:
+    """
+    Fake HomeKit controller: receives the events of the AccessoryDriver and
+    writes characteristics like the Home app
+    """
+
+    def __init__(self, bridge, use_asyncio):
+        self.bridge = bridge
+        self.use_asyncio = use_asyncio
+        self.lock = threading.Lock()
+
+        # (aid, iid) of every characteristic fed by a topic
+        self.topics = {}
+        # one characteristic per output topic, writes to the same topic
+        # within the PublishWindow would be coalesced
+        writable = collections.OrderedDict()
+        for topic, routes in bridge.routes.items():
+            for route in routes:
+                acc = route.char.broker
+                self.topics[(acc.aid, acc.iid_manager.get_iid(route.char))] = \
+                    topic
+                topic_out = route.char.properties.get('topic_out', None)
+                if topic_out is not None and route.char.display_name == 'On':
+                    writable.setdefault(topic_out, route.char)
+        self.writable = [(char, topic_out)
+                         for topic_out, char in writable.items()]
+
+        self.sent_in = {}
+        self.writing = set()
+        self.sent_out = {}
+        self.mqtt2hap = []
+        self.hap2mqtt = []
+        self.events = 0
+
+    def publish(self, data, *args, **kwargs):
+        """
+        Replaces AccessoryDriver.publish
+        """
+        now = time.perf_counter()
+        with self.lock:
+            self.events += 1
+            if (data['aid'], data['iid']) in self.writing:
+                # the event of a write to the other controllers
+                return
+            topic = self.topics.get((data['aid'], data['iid']), None)
+            sent = self.sent_in.pop(topic, None)
+            if sent is not None:
+                self.mqtt2hap.append(now - sent)
+
+    def on_broker_publish(self, topic, payload):
+        now = time.perf_counter()
+        with self.lock:
+            sent = self.sent_out.pop(topic, None)
+            if sent is not None:
+                self.hap2mqtt.append(now - sent)
+
+    def message_sent(self, topic):
+        # messages without an event are measured with the next message
+        with self.lock:
+            self.sent_in[topic] = time.perf_counter()
+
+    def write(self, i):
+        if not self.writable:
+            return
+        char, topic_out = self.writable[i % len(self.writable)]
+        acc = char.broker
+        key = (acc.aid, acc.iid_manager.get_iid(char))
+        value = not char.value
+
+        def write():
+            with self.lock:
+                self.writing.add(key)
+            try:
+                char.client_update_value(value)
+            finally:
+                with self.lock:
+                    self.writing.discard(key)
+
+        with self.lock:
+            self.sent_out[topic_out] = time.perf_counter()
+
+        if self.use_asyncio:
+            self.bridge.driver.loop.call_soon_threadsafe(write)
+        else:
+            write()
+
+
+def shed(bridge):
+    return (bridge.stats.get('inbound_collapsed', 0) +
+            bridge.stats.get('inbound_dropped', 0))
+
+
+def run(broker, cfg, traffic, use_asyncio, rate, write_rate):
+    """
+    Replay the traffic and return the results
+
+    :param rate: messages per second, 0 sends as fast as possible
+    :type rate: float
+
+    :param write_rate: writes of the controller per second
+    :type write_rate: float
+    """
+    driver = AccessoryDriver(port=51826,
+                             persist_file=os.path.join(cfg, 'accessory.state'))
+    bridge = MqttBridge(cfg, driver, 'MQTT', use_asyncio=use_asyncio)
+    for acc in cfg_loader.CfgLoader(driver, cfg).load_accessories():
+        bridge.add_accessory(acc)
+    bridge._compile_dispatch()
+
+    controller = Controller(bridge, use_asyncio)
+    driver.publish = controller.publish
+    broker.on_publish = controller.on_broker_publish
+
+    handled = [0]
+    update_char = bridge.update_char
+
+    def counting_update_char(topic, payload):
+        handled[0] += 1
+        update_char(topic, payload)
+
+    bridge.update_char = counting_update_char
+
+    if use_asyncio:
+        thread = threading.Thread(target=driver.loop.run_forever, daemon=True)
+        thread.start()
+
+    bridge.connect()
+    try:
+        if not broker.wait_for(lambda: 'subscribe_seconds' in bridge.stats):
+            raise RuntimeError('The bridge did not subscribe')
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        writes = 0
+        for i, (topic, payload) in enumerate(traffic):
+            if rate > 0:
+                delay = start + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            controller.message_sent(topic)
+            broker.publish(topic, payload)
+
+            if write_rate > 0:
+                due = int((time.perf_counter() - start) * write_rate)
+                while writes < due:
+                    controller.write(writes)
+                    writes += 1
+
+        # messages shed by the inbound queue under overload are not handled
+        def done():
+            return handled[0] + shed(bridge) >= len(traffic)
+
+        if not broker.wait_for(done, 30.0):
+            raise RuntimeError('Only {} of {} messages were handled'.format(
+                handled[0], len(traffic)))
+        elapsed = time.perf_counter() - start
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        # the last writes
+        time.sleep(0.1)
+    finally:
+        broker.on_publish = None
+        if use_asyncio:
+            driver.loop.call_soon_threadsafe(bridge.aio.stop)
+            driver.loop.call_soon_threadsafe(driver.loop.stop)
+            thread.join(5.0)
+            # let the cancelled tasks finish
+            driver.loop.run_until_complete(asyncio.sleep(0.01))
+        else:
+            bridge.client.loop_stop()
+        bridge.client.disconnect()
+        bridge.timers.stop()
+
+    cpu = (end_usage.ru_utime - usage.ru_utime +
+           end_usage.ru_stime - usage.ru_stime)
+    return {
+        'messages': len(traffic),
+        'events': controller.events,
+        'writes': writes,
+        'shed': shed(bridge),
+        'handled_per_sec': handled[0] / elapsed,
+        'mqtt2hap_p50_us': percentile(controller.mqtt2hap, 0.5) * 1e6,
+        'mqtt2hap_p99_us': percentile(controller.mqtt2hap, 0.99) * 1e6,
+        'hap2mqtt_p50_us': percentile(controller.hap2mqtt, 0.5) * 1e6,
+        'hap2mqtt_p99_us': percentile(controller.hap2mqtt, 0.99) * 1e6,
+        'cpu_percent': 100.0 * cpu / elapsed,
+        'rss_mb': rss_mb(),
+    }
+
+
+def compare(baseline, results, threshold):
+    """
+    Print the changes against the baseline and return the regressed metrics
+
+    :param baseline: results of an earlier run
+    :type baseline: dict
+
+    :param results: results of this run
+    :type results: dict
+
+    :param threshold: tolerated change in percent
+    :type threshold: float
+    """
+    regressions = []
+    print('{:10s}{:18s}{:>12s}{:>12s}{:>10s}'.format(
+        'mode', 'metric', 'baseline', 'current', 'change'))
+    for mode, current in results['modes'].items():
+        old = baseline.get('modes', {}).get(mode, None)
+        if old is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            if not old.get(metric, 0):
+                continue
+            change = 100.0 * (current[metric] - old[metric]) / old[metric]
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > threshold:
+                flag = ' !'
+                regressions.append((mode, metric))
+            print('{:10s}{:18s}{:12.1f}{:12.1f}{:+9.1f}%{}'.format(
+                mode, metric, old[metric], current[metric], change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-n', type=int, default=5000,
+                        help='number of messages per mode')
+    parser.add_argument('--devices', type=int, default=100,
+                        help='number of devices of the synthetic traffic')
+    parser.add_argument('--replay', help='recorded traffic to replay')
+    parser.add_argument('--rate', type=float, default=1000,
+                        help='messages per second, 0 for unthrottled')
+    parser.add_argument('--write-rate', type=float, default=20,
+                        help='writes of the controller per second')
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'],
+                        action='append', help='modes to run, default all')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--compare', help='compare with saved results')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='tolerated regression in percent')
+    args = parser.parse_args()
+
+    if args.replay:
+        traffic = load_traffic(args.replay)[:args.n]
+    else:
+        traffic = synthetic_traffic(args.devices, args.n, args.seed)
+    accessories = accessory_cfgs(traffic)
+
+    broker = FakeBroker()
+    bridge_cfg = ('[Accessory]\nDisplayName = MQTT Bridge\n\n'
+                  '[MQTT]\nHostName = 127.0.0.1\nPort = {}\n\n'
+                  '[Snapshot]\nInterval = 0\n'.format(broker.port))
+
+    results = {
+        'version': RESULTS_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {'messages': len(traffic),
+                     'accessories': len(accessories),
+                     'replay': args.replay, 'rate': args.rate,
+                     'write_rate': args.write_rate, 'seed': args.seed},
+        'modes': collections.OrderedDict(),
+    }
+
+    try:
+        with config_dir(accessories, bridge_cfg) as cfg:
+            for mode in args.mode or ['threaded', 'asyncio']:
+                results['modes'][mode] = run(
+                    broker, cfg, traffic, mode == 'asyncio', args.rate,
+                    args.write_rate)
+    finally:
+        broker.close()
+
+    print('{} messages, {} accessories'.format(len(traffic), len(accessories)))
+    for mode, result in results['modes'].items():
+        if result['shed']:
+            print('{}: {} messages shed under overload'.format(
+                mode, result['shed']))
+    print('{:10s}'.format('mode') +
+          ''.join('{:>17s}'.format(metric) for metric in METRICS))
+    for mode, result in results['modes'].items():
+        print('{:10s}'.format(mode) + ''.join(
+            '{:17.1f}'.format(result[metric]) for metric in METRICS))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        regressions = compare(baseline, results, args.threshold)
+        if regressions:
+            print('{} metrics regressed by more than {}%'.format(
+                len(regressions), args.threshold))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Micro-benchmark of the Tasmota adapter classes against the equivalent
+declarative 'json' adapters, extracting POWER, Hue, Saturation, Brightness
+and ColorTemperature of a bulb from one RESULT message like the MqttBridge
+does: the payload is decoded once and passed to all adapters of the topic.
+
+Run from the repository root: python -m benchmarks.bench_json_path
+"""
+
+import argparse
+
+from homekit_mqtt import json_path, tasmota
+from homekit_mqtt.mqtt_bridge import decode_payload
+
+from benchmarks.common import RESULT, rate
+
+TOPIC = 'stat/Bulb/RESULT'
+
+CLASSES = [tasmota.POWER, tasmota.Hue, tasmota.Saturation,
+           tasmota.Brightness, tasmota.ColorTemperature]
+
+SPECS = [
+    {'path': 'POWER', 'map': 'ON:1,OFF:0'},
+    {'path': 'HSBColor', 'split': ',', 'index': '0'},
+    {'path': 'HSBColor', 'split': ',', 'index': '1'},
+    {'path': 'HSBColor', 'split': ',', 'index': '2'},
+    {'path': 'CT', 'clamp': '153:500'},
+]
+
+
+def extract(adapters):
+    def func():
+        _, data = decode_payload(RESULT)
+        return [adapter.input(TOPIC, data) for adapter in adapters]
+    return func
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=100000,
+                        help='number of messages')
+    args = parser.parse_args()
+
+    compiled = [json_path.compile_adapter(spec) for spec in SPECS]
+
+    decode = rate(lambda: decode_payload(RESULT), args.n)
+    classes = rate(extract(CLASSES), args.n)
+    specs = rate(extract(compiled), args.n)
+
+    print('{:24s}{:>14s}'.format('adapters', 'msgs/s'))
+    print('{:24s}{:14.0f}'.format('decode only', decode))
+    print('{:24s}{:14.0f}'.format('tasmota classes', classes))
+    print('{:24s}{:14.0f}'.format('json specs', specs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+End-to-end latency from a MQTT message published to the broker until the
+HomeKit event of the characteristic is sent, with the threaded MQTT client and
+with the MQTT client running on the event loop of the AccessoryDriver.
+
+Run from the repository root: python -m benchmarks.bench_latency
+"""
+
+import os
+import asyncio
+import time
+import argparse
+import threading
+import statistics
+
+from pyhap.accessory_driver import AccessoryDriver
+
+from homekit_mqtt import cfg_loader
+from homekit_mqtt.mqtt_bridge import MqttBridge
+from tests.fake_broker import FakeBroker
+
+from benchmarks.common import config_dir
+
+SENSOR_CFG = """
+[Accessory]
+Category = Sensor
+DisplayName = {name}
+
+[TemperatureSensor]
+CurrentTemperature = stat/{name}/Temperature _ _
+"""
+
+
+def measure(broker, cfg, use_asyncio, n, sensors):
+    driver = AccessoryDriver(port=51826,
+                             persist_file=os.path.join(cfg, 'accessory.state'))
+    bridge = MqttBridge(cfg, driver, 'MQTT', use_asyncio=use_asyncio)
+    for acc in cfg_loader.CfgLoader(driver, cfg).load_accessories():
+        bridge.add_accessory(acc)
+    bridge._compile_dispatch()
+
+    # timestamp the HomeKit events instead of sending them
+    received = [0.0]
+    event = threading.Event()
+
+    def publish(data, *args, **kwargs):
+        received[0] = time.perf_counter()
+        event.set()
+
+    driver.publish = publish
+
+    if use_asyncio:
+        thread = threading.Thread(target=driver.loop.run_forever, daemon=True)
+        thread.start()
+
+    bridge.connect()
+    try:
+        broker.wait_for(lambda: 'subscribe_seconds' in bridge.stats)
+
+        latencies = []
+        for i in range(n):
+            # changing values within the range and step of the
+            # characteristic, so every message triggers an event
+            value = round(0.5 + (i % 990) / 10.0, 1)
+            event.clear()
+            sent = time.perf_counter()
+            broker.publish('stat/Sensor{}/Temperature'.format(i % sensors),
+                           str(value).encode())
+            if not event.wait(5.0):
+                raise RuntimeError('Message {} was not received'.format(i))
+            latencies.append(received[0] - sent)
+    finally:
+        if use_asyncio:
+            driver.loop.call_soon_threadsafe(bridge.aio.stop)
+            driver.loop.call_soon_threadsafe(driver.loop.stop)
+            thread.join(5.0)
+            # let the cancelled tasks finish
+            driver.loop.run_until_complete(asyncio.sleep(0.01))
+        else:
+            bridge.client.loop_stop()
+        bridge.client.disconnect()
+
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=2000,
+                        help='number of messages per mode')
+    parser.add_argument('--sensors', type=int, default=10,
+                        help='number of sensor accessories')
+    args = parser.parse_args()
+
+    broker = FakeBroker()
+    accessories = {'sensor{}.cfg'.format(i):
+                   SENSOR_CFG.format(name='Sensor{}'.format(i))
+                   for i in range(args.sensors)}
+    bridge_cfg = ('[Accessory]\nDisplayName = MQTT Bridge\n\n'
+                  '[MQTT]\nHostName = 127.0.0.1\nPort = {}\n'
+                  .format(broker.port))
+
+    try:
+        with config_dir(accessories, bridge_cfg) as cfg:
+            print('{:10s}{:>12s}{:>12s}{:>12s}'.format(
+                'mode', 'p50 [us]', 'p99 [us]', 'max [us]'))
+            for name, use_asyncio in (('threaded', False), ('asyncio', True)):
+                latencies = sorted(measure(broker, cfg, use_asyncio, args.n,
+                                           args.sensors))
+                p99 = latencies[int(0.99 * (len(latencies) - 1))]
+                print('{:10s}{:12.0f}{:12.0f}{:12.0f}'.format(
+                    name, statistics.median(latencies) * 1e6, p99 * 1e6,
+                    latencies[-1] * 1e6))
+    finally:
+        broker.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Startup time of CfgLoader.load_accessories for synthetic config directories
+of 10, 100 and 1,000 accessories, on the first start (nothing cached) and on
+a restart with an unchanged config.
+
+Run from the repository root: python -m benchmarks.bench_startup
+"""
+
+import os
+import time
+import argparse
+
+from pyhap.accessory_driver import AccessoryDriver
+
+from homekit_mqtt import cfg_loader
+
+from benchmarks.common import BULB_CFG, config_dir
+
+
+def load(cfg, **kwargs):
+    driver = AccessoryDriver(port=51826,
+                             persist_file=os.path.join(cfg, 'accessory.state'))
+    # measure parsing only, without the limit of accessories per bridge
+    loader = cfg_loader.CfgLoader(driver, cfg, max_accessories=None,
+                                  **kwargs)
+
+    start = time.perf_counter()
+    accs = loader.load_accessories()
+    return time.perf_counter() - start, len(accs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('sizes', type=int, nargs='*', default=[10, 100, 1000],
+                        help='numbers of accessories')
+    args = parser.parse_args()
+
+    print('{:>8s}{:>14s}{:>14s}{:>14s}'.format(
+        'accs', 'serial [ms]', 'cold [ms]', 'cached [ms]'))
+    for size in args.sizes:
+        accessories = {'bulb{}.cfg'.format(i):
+                       BULB_CFG.format(name='Bulb{}'.format(i))
+                       for i in range(size)}
+        with config_dir(accessories) as cfg:
+            serial, n = load(cfg, workers=1, use_cache=False)
+            cold, _ = load(cfg)
+            cached, _ = load(cfg)
+            assert n == size
+
+        print('{:8d}{:14.1f}{:14.1f}{:14.1f}'.format(
+            size, serial * 1e3, cold * 1e3, cached * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Helpers shared by the benchmarks."""
+
+import os
+import time
+import shutil
+import tempfile
+import contextlib
+
+from pyhap.accessory_driver import AccessoryDriver
+
+from homekit_mqtt import cfg_loader
+from homekit_mqtt.mqtt_bridge import MqttBridge
+
+BRIDGE_CFG = """
+[Accessory]
+DisplayName = MQTT Bridge
+
+[MQTT]
+HostName = localhost
+Port = 1883
+"""
+
+BULB_CFG = """
+[Accessory]
+Category = Lightbulb
+DisplayName = {name}
+
+[Lightbulb]
+On = stat/{name}/RESULT cmnd/{name}/POWER tasmota.POWER
+Hue = stat/{name}/RESULT cmnd/{name}/HSBColor tasmota.Hue
+Saturation = stat/{name}/RESULT cmnd/{name}/HSBColor tasmota.Saturation
+Brightness = stat/{name}/RESULT cmnd/{name}/HSBColor tasmota.Brightness
+ColorTemperature = stat/{name}/RESULT cmnd/{name}/CT tasmota.ColorTemperature
+
+[Switch]
+On = stat/{name}/RESULT cmnd/{name}/POWER tasmota.POWER
+"""
+
+RESULT = (b'{"POWER":"ON","Dimmer":42,"Color":"1A2B3C","HSBColor":"21,42,63",'
+          b'"Channel":[10,17,24],"CT":250}')
+
+
+@contextlib.contextmanager
+def config_dir(accessories, bridge_cfg=BRIDGE_CFG):
+    """
+    Create a temporary config directory
+
+    :param accessories: dict mapping file names to config file contents
+    :type accessories: dict
+    """
+    dname = tempfile.mkdtemp(prefix='homekit-mqtt-bench-')
+    try:
+        with open(os.path.join(dname, 'bridge.cfg'), 'w') as f:
+            f.write(bridge_cfg)
+
+        for fname, content in accessories.items():
+            with open(os.path.join(dname, fname), 'w') as f:
+                f.write(content)
+
+        yield dname
+    finally:
+        shutil.rmtree(dname)
+
+
+def make_bridge(cfg):
+    """
+    Create a MqttBridge with all accessories of a config directory without
+    connecting to a broker
+
+    :param cfg: the config directory
+    :type cfg: str
+    """
+    driver = AccessoryDriver(port=51826,
+                             persist_file=os.path.join(cfg, 'accessory.state'))
+
+    bridge = MqttBridge(cfg, driver, 'MQTT')
+
+    # drop everything published by the bridge
+    bridge.client.publish = lambda *args, **kwargs: None
+
+    # benchmarks load more accessories than a single bridge may have
+    loader = cfg_loader.CfgLoader(driver, cfg, max_accessories=None)
+    for acc in loader.load_accessories():
+        bridge.add_accessory(acc)
+
+    return bridge
+
+
+def rate(func, n):
+    """
+    Call func n times and return the calls per second
+
+    :param func: function without arguments
+    :type func: callable
+
+    :param n: number of calls
+    :type n: int
+    """
+    start = time.perf_counter()
+    for _ in range(n):
+        func()
+
+    return n / (time.perf_counter() - start)
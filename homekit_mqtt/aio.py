@@ -0,0 +1,128 @@
+import asyncio
+import logging
+
+import paho.mqtt.client as mqtt
+
+from homekit_mqtt.backoff import Backoff
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncioHelper:
+    """
+    Drives the network I/O of a paho MQTT client on an asyncio event loop
+    instead of the thread started by loop_start().
+
+    The socket callbacks of paho may be called from any thread, they are
+    forwarded to the loop with call_soon_threadsafe().
+    """
+
+    def __init__(self, loop, client, backoff=None):
+        """
+        Init
+
+        :param loop: the event loop, e.g. AccessoryDriver.loop
+        :type loop: asyncio.AbstractEventLoop
+
+        :param client: the MQTT client
+        :type client: paho.mqtt.client.Client
+
+        :param backoff: delays between connection attempts
+        :type backoff: homekit_mqtt.backoff.Backoff
+        """
+        self.loop = loop
+        self.client = client
+        self.backoff = backoff if backoff is not None else Backoff()
+        self.misc = None
+        self.connecting = None
+
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def _call(self, func, *args):
+        # the socket may be closed after the loop, e.g. on shutdown
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self._call(self._open, sock)
+
+    def on_socket_close(self, client, userdata, sock):
+        self._call(self._close, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._call(self.loop.add_writer, sock, self.client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self.loop.remove_writer, sock)
+
+    def _open(self, sock):
+        self.loop.add_reader(sock, self.client.loop_read)
+        if self.misc is None:
+            self.misc = self.loop.create_task(self._misc_loop())
+
+    def _close(self, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+
+    def connect(self, host, port):
+        """
+        Connect to the broker without blocking the loop and retry until it
+        succeeds. May be called from any thread.
+
+        :param host: the host name of the broker
+        :type host: str
+
+        :param port: the port of the broker
+        :type port: int
+        """
+        def start():
+            self.connecting = self.loop.create_task(
+                self._connect(self.client.connect, host, port))
+
+        self._call(start)
+
+    async def _connect(self, func, *args):
+        try:
+            while True:
+                try:
+                    # connecting blocks, keep it off the loop
+                    await self.loop.run_in_executor(None, func, *args)
+                except (OSError, ValueError) as e:
+                    delay = self.backoff.next()
+                    logger.info('Connecting to MQTT Broker failed: {}, '
+                                'retrying in {:.1f}s'.format(e, delay))
+                    await asyncio.sleep(delay)
+                    continue
+
+                self.backoff.reset()
+                return
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.connecting = None
+
+    async def _misc_loop(self):
+        """
+        Handle keepalive pings and reconnects, like the loop_start() thread
+        """
+        try:
+            while True:
+                if self.client.loop_misc() == mqtt.MQTT_ERR_NO_CONN and \
+                        self.connecting is None:
+                    self.connecting = self.loop.create_task(
+                        self._connect(self.client.reconnect))
+                await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            pass
+
+    def stop(self):
+        """
+        Stop handling keepalive pings and connecting
+        """
+        for task in (self.misc, self.connecting):
+            if task is not None:
+                self._call(task.cancel)
+        self.misc = None
@@ -0,0 +1,43 @@
+import random
+
+
+class Backoff:
+    """
+    Exponential backoff with jitter for reconnecting to the broker.
+
+    The n-th delay is drawn uniformly from [d/2, d] with
+    d = min(maximum, minimum * 2^n), so many bridges restarted at once do not
+    hit the broker in lockstep.
+    """
+
+    def __init__(self, minimum=1.0, maximum=60.0, rand=random.random):
+        """
+        Init
+
+        :param minimum: the first delay in seconds
+        :type minimum: float
+
+        :param maximum: the maximum delay in seconds
+        :type maximum: float
+
+        :param rand: function returning a random float in [0, 1)
+        :type rand: callable
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.rand = rand
+        self.attempts = 0
+
+    def next(self):
+        """
+        Return the delay before the next attempt
+        """
+        delay = min(self.maximum, self.minimum * 2 ** min(self.attempts, 32))
+        self.attempts += 1
+        return delay / 2 + self.rand() * delay / 2
+
+    def reset(self):
+        """
+        Start over after a successful attempt
+        """
+        self.attempts = 0
@@ -0,0 +1,119 @@
+import logging
+import threading
+
+from homekit_mqtt.brokers import broker_topic, split_topic
+
+logger = logging.getLogger(__name__)
+
+
+def device_of(topic):
+    """
+    Return the device part of a topic, e.g. 'bulb' for 'stat/bulb/RESULT'
+    and 'tele/bulb/STATE', so all messages of a device are batched together.
+    Devices of other brokers keep the name of their broker.
+
+    :param topic: the topic as used by the MqttBridge
+    :type topic: str
+    """
+    broker, topic = split_topic(topic)
+    parts = topic.split('/')
+    if len(parts) >= 3:
+        topic = '/'.join(parts[1:-1])
+    return broker_topic(broker, topic)
+
+
+def last_input(adapter, messages):
+    """
+    Return the input of the latest message the adapter could read a value
+    from, a simple input_batch() for adapters with a stateless input()
+
+    :param adapter: the adapter class
+    :type adapter: type
+
+    :param messages: the (topic, payload) of the messages, oldest first
+    :type messages: list of tuple
+    """
+    for topic, payload in reversed(messages):
+        value = adapter.input(topic, payload)
+        if value is not None:
+            return value
+    return None
+
+
+class Batcher:
+    """
+    Collects the messages for characteristics with a batch adapter per device
+    for 'window' seconds. The messages of a burst, e.g. RESULT, STATE and
+    SENSOR of a Tasmota device, are then passed to apply() at once.
+    """
+
+    def __init__(self, apply, timers, stats, window=0.01):
+        """
+        Init
+
+        :param apply: function apply(batch) with batch mapping each route to
+            the (topic, payload) of its messages
+        :type apply: callable
+
+        :param timers: timers ending the windows
+        :type timers: homekit_mqtt.timers.Timers
+
+        :param stats: dict with the counters 'batches' and 'batched_messages'
+        :type stats: dict
+
+        :param window: seconds to collect the messages of a device
+        :type window: float
+        """
+        self.apply = apply
+        self.timers = timers
+        self.stats = stats
+        self.window = window
+
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def add(self, route, topic, payload):
+        """
+        Add a message for a route
+
+        :param route: the route of the characteristic
+        :type route: homekit_mqtt.mqtt_bridge.Route
+
+        :param topic: the topic of the message
+        :type topic: str
+
+        :param payload: the decoded payload
+        :type payload: object
+        """
+        device = device_of(topic)
+        with self.lock:
+            batch = self.pending.get(device, None)
+            if batch is None:
+                batch = self.pending[device] = {}
+                self.timers.call_later(self.window, self.flush, device)
+            messages = batch.get(route, None)
+            if messages is None:
+                batch[route] = [(topic, payload)]
+            else:
+                messages.append((topic, payload))
+
+    def flush(self, device):
+        """
+        Apply the messages of a device collected so far
+
+        :param device: the device, see device_of()
+        :type device: str
+        """
+        with self.lock:
+            batch = self.pending.pop(device, None)
+        if not batch:
+            return
+
+        self.stats['batches'] = self.stats.get('batches', 0) + 1
+        self.stats['batched_messages'] = self.stats.get(
+            'batched_messages', 0) + sum(map(len, batch.values()))
+        try:
+            self.apply(batch)
+        except Exception as e:
+            logger.warn('Applying a batch of "{}" failed: {}'.format(
+                device, e))
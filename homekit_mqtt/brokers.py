@@ -0,0 +1,141 @@
+import threading
+
+# name of the broker of the section [MQTT] of bridge.cfg
+DEFAULT_BROKER = 'default'
+
+# prefix of the sections of further brokers, e.g. [MQTT:sensors]
+SECTION_PREFIX = 'MQTT:'
+
+# separates the broker from the topic in the topics used by the MqttBridge.
+# MQTT forbids U+0000 in topics, so they never clash with real topics.
+SEPARATOR = '\x00'
+
+
+def broker_topic(broker, topic):
+    """
+    Return the topic used by the MqttBridge for a topic of a broker. Topics
+    of the default broker are used as they are, those of other brokers are
+    prefixed with the name of the broker.
+
+    :param broker: the name of the broker
+    :type broker: str
+
+    :param topic: the topic
+    :type topic: str
+    """
+    if broker == DEFAULT_BROKER or topic is None:
+        return topic
+    return broker + SEPARATOR + topic
+
+
+def split_topic(topic):
+    """
+    Return the name of the broker and the topic of a topic returned by
+    broker_topic()
+
+    :param topic: the topic
+    :type topic: str
+    """
+    if SEPARATOR not in topic:
+        return DEFAULT_BROKER, topic
+    broker, _, topic = topic.partition(SEPARATOR)
+    return broker, topic
+
+
+_context = threading.local()
+
+
+def current_broker():
+    """
+    Return the name of the broker of the message an adapter is called for.
+    Adapters receive topics without the name of their broker, state kept
+    per device (see state_cache.DeviceStateCache) uses it to keep devices of
+    the same name on different brokers apart.
+    """
+    return getattr(_context, 'broker', DEFAULT_BROKER)
+
+
+def set_current_broker(broker):
+    """
+    Set the broker returned by current_broker() in this thread
+
+    :param broker: the name of the broker
+    :type broker: str
+    """
+    _context.broker = broker
+
+
+def display_topic(topic):
+    """
+    Return a topic returned by broker_topic() in the form 'broker:topic' for
+    log messages and metrics
+
+    :param topic: the topic
+    :type topic: str
+    """
+    return topic.replace(SEPARATOR, ':', 1)
+
+
+class Broker:
+    """
+    A MQTT broker of the MqttBridge with its client, connection state and
+    inbound queue. The settings are read from the section [MQTT] for the
+    default broker or [MQTT:<name>] for further brokers, which fall back to
+    the settings of [MQTT].
+    """
+
+    def __init__(self, name, section, defaults=None):
+        """
+        Init
+
+        :param name: the name of the broker
+        :type name: str
+
+        :param section: the section of bridge.cfg
+        :type section: configparser.SectionProxy or dict
+
+        :param defaults: the section [MQTT] for settings missing in section
+        :type defaults: configparser.SectionProxy or dict
+        """
+        if defaults is None:
+            defaults = {}
+
+        def get(key, default=None):
+            return section.get(key, defaults.get(key, default))
+
+        self.name = name
+        self.addr = (section['HostName'], int(section['Port']))
+
+        self.creds = None
+        username = section.get('UserName', None)
+        password = section.get('Password', None)
+        if username is not None and password is not None:
+            self.creds = (username, password)
+
+        self.default_qos = int(get('QoS', 0))
+        self.reconnect_min = float(get('ReconnectMin', 1))
+        self.reconnect_max = float(get('ReconnectMax', 60))
+        self.queue_size = int(get('QueueSize', 10000))
+        self.queue_policy = get('QueuePolicy', 'drop_oldest')
+        self.collapse_depth = int(get('CollapseDepth', 100))
+
+        self.client = None
+        self.aio = None
+        self.backoff = None
+        self.inbound = None
+
+        self.subscribe_lock = threading.Lock()
+        self.subscribed = {}
+        self.ready = False
+
+    def __repr__(self):
+        return 'Broker({!r}, {}:{})'.format(self.name, *self.addr)
+
+    @property
+    def thread_suffix(self):
+        """
+        Suffix of the names of the threads of this broker
+        """
+        if self.name == DEFAULT_BROKER:
+            return ''
+        return '-' + self.name
@@ -1,13 +1,28 @@
+import collections
+import concurrent.futures
 import configparser
+import json
 import logging
 import os
 
 from pyhap.const import *
 from pyhap.accessory import Accessory, Bridge
+from pyhap.service import Service
+from pyhap.util import hap_type_to_uuid
 import pyhap.loader as loader
 
+from homekit_mqtt import json_path
+from homekit_mqtt.shards import MAX_ACCESSORIES, shard_of
+from homekit_mqtt.topic_trie import has_wildcards, is_valid_filter
+
 logger = logging.getLogger(__name__)
 
+CACHE_VERSION = 1
+
+# a parsed config file, sections maps section names to dicts of options
+CfgFile = collections.namedtuple('CfgFile',
+                                 ['fname', 'mtime', 'size', 'sections'])
+
 categories = {
     'Other': CATEGORY_OTHER,
     'Bridge': CATEGORY_BRIDGE,
@@ -29,6 +44,92 @@ categories = {
 }
 
 
+_char_type_ids = {}
+
+
+def char_type_id(hap_loader, name):
+    """
+    Return the type_id of a characteristic without creating it
+
+    :param hap_loader: the loader of the HAP types
+    :type hap_loader: pyhap.loader.Loader
+
+    :param name: the name of the characteristic
+    :type name: str
+    """
+    type_id = _char_type_ids.get(name, None)
+    if type_id is None:
+        type_id = hap_type_to_uuid(hap_loader.char_types[name]['UUID'])
+        _char_type_ids[name] = type_id
+    return type_id
+
+
+def build_service(hap_loader, serv_type, chars):
+    """
+    Create a service with the configured characteristics. Only the required
+    characteristics which are not configured are created with their defaults.
+
+    :param hap_loader: the loader of the HAP types
+    :type hap_loader: pyhap.loader.Loader
+
+    :param serv_type: the name of the service
+    :type serv_type: str
+
+    :param chars: the configured characteristics by type_id
+    :type chars: dict
+    """
+    serv_info = hap_loader.serv_types[serv_type]
+    serv = Service(hap_type_to_uuid(serv_info['UUID']), serv_type)
+
+    chars = dict(chars)
+    required = []
+    for name in serv_info['RequiredCharacteristics']:
+        char = chars.pop(char_type_id(hap_loader, name), None)
+        required.append(char if char is not None
+                        else hap_loader.get_char(name))
+
+    # the characteristics are unique, skip the check of add_characteristic()
+    for char in required + list(chars.values()):
+        char.service = serv
+        serv.characteristics.append(char)
+
+    return serv
+
+
+def check_options(options, adapter=None):
+    """
+    Return why the options of a characteristic are invalid or None if they
+    are valid
+
+    :param options: the options of the characteristic
+    :type options: dict
+
+    :param adapter: the adapter of the characteristic
+    :type adapter: str
+    """
+    qos = options.get('qos', None)
+    if qos is not None and qos not in ('0', '1', '2'):
+        return 'qos must be 0, 1 or 2'
+
+    # notification options, see notify.NotifyPolicy
+    for key in ('deadband', 'interval'):
+        value = options.get(key, None)
+        if value is None:
+            continue
+        try:
+            if not float(value) >= 0:
+                raise ValueError
+        except ValueError:
+            return '{} must be a number >= 0'.format(key)
+
+    if adapter == json_path.ADAPTER:
+        try:
+            json_path.compile_adapter(options)
+        except ValueError as e:
+            return str(e)
+    return None
+
+
 class CfgLoader:
     """
     Loader class that loads accessories from a directory with config files.
@@ -45,12 +146,39 @@ class CfgLoader:
     AccessoryName1 = mqtt/input/topic mqtt/output/topic AdapterClass
     AccessoryName2 = mqtt/input/topic mqtt/output/topic AdapterClass
 
-    If there is no topic or adapter class, replace it with a '_'.
+    If there is no topic or adapter class, replace it with a '_'. The input
+    topic may contain the MQTT wildcards '+' and '#'.
+
+    Devices which only report their state when asked are polled with the
+    options 'PollTopic', 'PollPayload' (default empty) and 'PollInterval' (in
+    seconds, default 300) of the [Accessory] section.
+
+    The option 'Broker' of the [Accessory] section selects the broker of a
+    section [MQTT:<name>] of bridge.cfg, the broker of the section [MQTT] is
+    used by default. Single characteristics may override it with the option
+    'broker'.
+
+    The adapter class may be followed by options of the form key=value, e.g.
+    'qos=1' to subscribe to the input topic with QoS 1 or 'interval=10' to
+    notify HomeKit at most every 10 seconds (see notify.NotifyPolicy).
 
-    Adapter classes are defined in the module 'adapters'.
+    Adapter classes are defined in the module 'adapters'. Instead of a class,
+    the adapter 'json' extracts the value with the options 'path', 'split',
+    'index', 'map', 'clamp' and 'scale' (see json_path.JsonPathAdapter), e.g.
+
+    Hue = stat/bulb/RESULT _ json path=HSBColor split=, index=0
+
+    The files are parsed by a pool of worker threads. The parsed files are
+    cached in 'accessory.cache' next to the state file of the driver and only
+    files with a changed modification time or size are parsed again.
+
+    With shards > 1, only the files of the given shard are loaded (see
+    shards.shard_of).
     """
 
-    def __init__(self, driver, cfg_path='config'):
+    def __init__(self, driver, cfg_path='config', workers=None,
+                 use_cache=True, shard=0, shards=1,
+                 max_accessories=MAX_ACCESSORIES):
         """
         Initialize the loader
 
@@ -59,60 +187,179 @@ class CfgLoader:
 
         :param cfg_path: path to config-directory
         :type cfg_path: str
+
+        :param workers: number of threads parsing config files, defaults to
+            the number of processors plus four
+        :type workers: int
+
+        :param use_cache: use the cache of parsed config files
+        :type use_cache: bool
+
+        :param shard: the shard to load
+        :type shard: int
+
+        :param shards: the number of shards
+        :type shards: int
+
+        :param max_accessories: warn if more accessories are loaded, None to
+            disable the warning
+        :type max_accessories: int
         """
         self.driver = driver
         self.cfg_path = cfg_path
+        self.workers = workers
+        self.use_cache = use_cache
+        self.shard = shard
+        self.shards = shards
+        self.max_accessories = max_accessories
+        # accessory.state -> accessory.cache
+        self.cache_file = os.path.splitext(
+            os.path.abspath(driver.persist_file))[0] + '.cache'
 
         self.cfgs = []
         self.accs = None
+        self.acc_cfgs = []
 
-    def load_accessories(self, override_ids=False):
+    @staticmethod
+    def read_cfg(fname, stat):
         """
-        Return a list of initialized accessories specified by the config files.
+        Parse a config file and return a CfgFile or None if it is invalid
 
-        The characteristics of those accessories should contain three additional
-        values: topic_in, topic_out and adapter used by the MqttBridge class.
+        :param fname: the file name
+        :type fname: str
 
-        :param override_ids: override accessory ids for a new bridge config
-        :type override_ids: bool
+        :param stat: the result of os.stat() for the file
+        :type stat: os.stat_result
+        """
+        cfg = configparser.ConfigParser()
+        cfg.optionxform = str
+
+        try:
+            cfg.read(fname)
+            sections = {section: dict(cfg.items(section))
+                        for section in cfg.sections()}
+        except Exception as e:
+            logger.warn(
+                'Skipping "{}" because of Exception: {}'.format(fname,
+                                                                str(e)))
+            return None
+
+        return CfgFile(fname, stat.st_mtime_ns, stat.st_size, sections)
+
+    def _load_cache(self):
+        """
+        Return the cached config files by file name
+        """
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        if cache.get('version', None) != CACHE_VERSION:
+            return {}
+
+        return {cfg[0]: CfgFile(*cfg) for cfg in cache['files']}
+
+    def _save_cache(self, cfgs):
+        """
+        Atomically replace the cache with the given config files
+
+        :param cfgs: the parsed config files
+        :type cfgs: list of CfgFile
+        """
+        tmp = self.cache_file + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'version': CACHE_VERSION,
+                           'files': [list(cfg) for cfg in cfgs]}, f)
+            os.replace(tmp, self.cache_file)
+        except OSError as e:
+            logger.warn('Could not write "{}": {}'.format(self.cache_file, e))
+
+    def find_cfgs(self):
+        """
+        Return the file names of all accessory config files
         """
         # find all cfg files, but skip the bridge.cfg
         fnames = []
         for r, _, fs in os.walk(self.cfg_path):
             fnames += [os.path.join(r, f) for f in fs if f != 'bridge.cfg'
-                       and f != 'accessory.state']
+                       and not f.endswith(('.state', '.cache', '.values',
+                                           '.tmp'))]
 
-        for fname in fnames:
-            cfg = configparser.ConfigParser()
-            cfg.optionxform = str
-            cfg.fname = fname
+        if self.shards > 1:
+            fnames = [fname for fname in fnames if shard_of(
+                fname, self.cfg_path, self.shards) == self.shard]
+        return fnames
+
+    def read_cfgs(self):
+        """
+        Return the parsed config files of the config directory, using the
+        cache for unchanged files
+        """
+        fnames = self.find_cfgs()
+
+        cache = self._load_cache() if self.use_cache else {}
 
+        cfgs = []
+        missing = []
+        for fname in fnames:
             try:
-                cfg.read(fname)
-                self.cfgs.append(cfg)
-            except Exception as e:
-                logger.warn(
-                    'Skipping "{}" because of Exception: {}'.format(fname,
-                                                                    str(e)))
+                stat = os.stat(fname)
+            except OSError:
+                continue
+
+            cfg = cache.get(fname, None)
+            if cfg is not None and cfg.mtime == stat.st_mtime_ns and \
+                    cfg.size == stat.st_size:
+                cfgs.append(cfg)
+            else:
+                missing.append((fname, stat))
+
+        if missing:
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+                parsed = pool.map(lambda args: self.read_cfg(*args), missing)
+                cfgs += [cfg for cfg in parsed if cfg is not None]
+
+        if self.use_cache and (missing or len(cfgs) != len(cache)):
+            self._save_cache(cfgs)
+
+        return cfgs
+
+    def load_accessories(self, override_ids=False):
+        """
+        Return a list of initialized accessories specified by the config files.
+
+        The characteristics of those accessories should contain three additional
+        values: topic_in, topic_out and adapter used by the MqttBridge class.
+
+        :param override_ids: override accessory ids for a new bridge config
+        :type override_ids: bool
+        """
+        self.cfgs = self.read_cfgs()
 
         # sort by aid
         max_aid = 2**63 - 1
         self.cfgs = sorted(self.cfgs, key=lambda cfg: int(
-            cfg['Accessory'].get('AID', max_aid)))
+            cfg.sections.get('Accessory', {}).get('AID', max_aid)))
+
+        hap_loader = loader.get_loader()
 
         self.accs = []
+        self.acc_cfgs = []
         for cfg in self.cfgs:
             try:
                 # init accessory
-                acc_def = cfg['Accessory']
+                acc_def = dict(cfg.sections['Accessory'])
                 if acc_def['Category'] not in categories:
                     logger.warn('Unknown category: "{}"'.format(
-                        acc_def['category']))
+                        acc_def['Category']))
                     continue
                 if 'DisplayName' not in acc_def.keys():
                     # use filename as display name
-                    acc_def['DisplayName'] = os.path.basename(fname).split('.')[
-                        0]
+                    acc_def['DisplayName'] = os.path.basename(
+                        cfg.fname).split('.')[0]
 
                 aid = None
                 if not override_ids:
@@ -128,31 +375,60 @@ class CfgLoader:
                                      acc_def.get('Model', None),
                                      acc_def.get('SerialNumber', None))
 
+                # poll devices which do not report their state by themselves
+                acc.poll_topic = acc_def.get('PollTopic', None)
+                acc.poll_payload = acc_def.get('PollPayload', '')
+                acc.poll_interval = float(acc_def.get('PollInterval', 300))
+
+                # the broker of a section [MQTT:<name>] of bridge.cfg
+                acc.mqtt_broker = acc_def.get('Broker', None)
+
                 # init services
-                serv_types = cfg.sections()
+                serv_types = list(cfg.sections)
                 serv_types.remove('Accessory')
                 for serv_type in serv_types:
-                    serv_def = cfg[serv_type]
-                    serv = loader.get_loader().get_service(serv_type)
+                    serv_def = cfg.sections[serv_type]
                     char_types = serv_def.keys()
 
+                    # configured characteristics by type_id
+                    chars = {}
+
                     for char_type in char_types:
                         char_def = serv_def[char_type]
                         char_def = char_def.split()
 
                         # init characteristic
                         try:
-                            char = loader.get_loader().get_char(char_type)
+                            char = hap_loader.get_char(char_type)
 
-                            if len(char_def) != 3:
+                            if len(char_def) < 3 or not all(
+                                    '=' in opt for opt in char_def[3:]):
                                 logger.warn(
                                     'Skipping caracteristic "{}" because of invalid format'.format(char_type))
                                 continue
 
-                            # add topics and adapter
+                            # add topics, adapter and options
                             char.properties['topic_in'] = None
                             char.properties['topic_out'] = None
                             char.properties['adapter'] = None
+                            char.properties['options'] = dict(
+                                opt.split('=', 1) for opt in char_def[3:])
+
+                            error = check_options(char.properties['options'],
+                                                  char_def[2])
+                            if error is not None:
+                                logger.warn(
+                                    'Skipping caracteristic "{}" because of '
+                                    'invalid options: {}'.format(char_type,
+                                                                 error))
+                                continue
+
+                            if not is_valid_filter(char_def[0]) or \
+                                    has_wildcards(char_def[1]):
+                                logger.warn(
+                                    'Skipping caracteristic "{}" because of '
+                                    'invalid topic'.format(char_type))
+                                continue
 
                             if char_def[0] != '_':
                                 char.properties['topic_in'] = char_def[0]
@@ -161,37 +437,83 @@ class CfgLoader:
                             if char_def[2] != '_':
                                 char.properties['adapter'] = char_def[2]
 
-                            # add characteristic
-                            added = False
-                            for i, old_char in enumerate(serv.characteristics):
-                                if old_char.type_id == char.type_id:
-                                    serv.characteristics[i] = char
-                                    added = True
-                                    break
-
-                            if not added:
-                                serv.add_characteristic(char)
+                            # add characteristic, replacing former ones
+                            chars[char.type_id] = char
 
                         except KeyError as e:
                             continue
 
-                    acc.add_service(serv)
+                    acc.add_service(build_service(hap_loader, serv_type,
+                                                  chars))
 
                 self.accs.append(acc)
+                self.acc_cfgs.append(cfg)
                 logger.info('Added accessory "{}"'.format(acc.display_name))
 
             except Exception as e:
                 logger.warn('Skipping "{}" because of Exception: {}: {}'.format(
                     type(e), cfg.fname, str(e)))
 
+        if self.max_accessories is not None and \
+                len(self.accs) > self.max_accessories:
+            logger.warn('{} accessories exceed the limit of {} accessories '
+                        'per bridge, use more shards'.format(
+                            len(self.accs), self.max_accessories))
+
         return self.accs
 
+    @staticmethod
+    def write_aid(fname, aid):
+        """
+        Set the AID in a config file. The file is replaced atomically, so it
+        is never left truncated.
+
+        :param fname: the file name
+        :type fname: str
+
+        :param aid: the AID
+        :type aid: int
+        """
+        cfg = configparser.ConfigParser(interpolation=None)
+        cfg.optionxform = str
+        cfg.read(fname)
+        cfg['Accessory']['AID'] = str(aid)
+
+        tmp = fname + '.tmp'
+        with open(tmp, 'w') as f:
+            cfg.write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, fname)
+
     def save_accessories(self):
         """
-        Save the accessories (with new aid's)
+        Save the new aid's of the accessories. Only files with a changed aid
+        are written.
         """
-        # add new aid's
-        for i in range(len(self.accs)):
-            self.cfgs[i]['Accessory']['AID'] = str(self.accs[i].aid)
-            with open(self.cfgs[i].fname, 'w') as f:
-                self.cfgs[i].write(f)
+        changed = False
+        for i, (cfg, acc) in enumerate(zip(self.acc_cfgs, self.accs)):
+            if acc.aid is None or \
+                    cfg.sections['Accessory'].get('AID', None) == str(acc.aid):
+                continue
+
+            try:
+                self.write_aid(cfg.fname, acc.aid)
+                stat = os.stat(cfg.fname)
+            except OSError as e:
+                logger.warn('Could not save AID to "{}": {}'.format(
+                    cfg.fname, e))
+                continue
+
+            sections = dict(cfg.sections)
+            sections['Accessory'] = dict(sections['Accessory'],
+                                         AID=str(acc.aid))
+            self.acc_cfgs[i] = CfgFile(cfg.fname, stat.st_mtime_ns,
+                                       stat.st_size, sections)
+            changed = True
+
+        # keep the cache valid for the written files
+        if changed and self.use_cache:
+            saved = {cfg.fname: cfg for cfg in self.acc_cfgs}
+            self.cfgs = [saved.get(cfg.fname, cfg) for cfg in self.cfgs]
+            self._save_cache(self.cfgs)
@@ -12,6 +12,8 @@ from pyhap.accessory_driver import AccessoryDriver
 from homekit_mqtt.mqtt_bridge import MqttBridge
 
 from homekit_mqtt import cfg_loader
+from homekit_mqtt import shards as sharding
+from homekit_mqtt.watcher import ConfigWatcher
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +37,30 @@ def create_cfg(dname):
     shutil.copyfile(src, dst)
 
 
+def supervise(cfg, reset, use_asyncio, watch, shards):
+    """
+    Run every shard in its own process and restart failed ones. With reset,
+    the shards are reset on their first start only.
+
+    :param shards: the number of shards
+    :type shards: int
+    """
+    commands = []
+    for shard in range(shards):
+        commands.append([
+            sys.executable, '-m', 'homekit_mqtt.cli', '--cfg', cfg,
+            '--asyncio' if use_asyncio else '--threaded',
+            '--watch', str(watch),
+            '--shards', str(shards), '--shard', str(shard)])
+
+    first_commands = None
+    if reset:
+        first_commands = [command + ['--reset'] for command in commands]
+
+    sharding.Supervisor(commands, first_commands=first_commands).run()
+    return 0
+
+
 def systmd():
     """
     Setup a systemd service for homekit-mqtt
@@ -56,14 +82,20 @@ def systmd():
                     to the Home App again.')
 @click.option('--setup-systemd', is_flag=True,
               help='Create a systemd service.')
-def main(cfg, reset, setup_systemd):
+@click.option('--asyncio/--threaded', 'use_asyncio', default=False,
+              help='Run MQTT on the event loop of HomeKit instead of a \
+                    separate thread.')
+@click.option('--watch', default=5.0, show_default=True,
+              help='Seconds between checks for changed accessory configs, '
+                   '0 disables reloading.')
+@click.option('--shards', default=1, show_default=True,
+              help='Number of bridges, each running in its own process.')
+@click.option('--shard', type=int, default=None,
+              help='Run a single shard, used by the supervisor.')
+def main(cfg, reset, setup_systemd, use_asyncio, watch, shards, shard):
     # init logging
     logging.basicConfig(level=logging.INFO)
 
-    if reset:
-        # remove accessory.state
-        os.remove('accessory.state')
-
     if setup_systemd:
         systmd()
 
@@ -71,23 +103,48 @@ def main(cfg, reset, setup_systemd):
     if not os.path.exists(os.path.join(cfg, 'bridge.cfg')):
         create_cfg(cfg)
 
-    # start the accessory driver on port 51826
-    driver = AccessoryDriver(port=51826)
+    if shards > 1 and shard is None:
+        return supervise(cfg, reset, use_asyncio, watch, shards)
+
+    shard = shard or 0
+    state_file = sharding.shard_state_file(shard, shards)
+    if reset and os.path.exists(state_file):
+        # remove accessory.state
+        os.remove(state_file)
+
+    # start the accessory driver on port 51826 (+ shard)
+    driver = AccessoryDriver(port=sharding.shard_port(51826, shard),
+                             persist_file=state_file)
 
     # create bridge
-    bridge = MqttBridge(cfg, driver, 'MQTT')
+    bridge = MqttBridge(cfg, driver, 'MQTT', use_asyncio=use_asyncio)
+    if shards > 1:
+        # unique names for mDNS
+        bridge.display_name += ' {}'.format(shard + 1)
 
     # load accs
-    loader = cfg_loader.CfgLoader(driver, cfg)
+    loader = cfg_loader.CfgLoader(driver, cfg, shard=shard, shards=shards)
     accs = loader.load_accessories(reset)
+    if len(accs) > sharding.MAX_ACCESSORIES:
+        # HomeKit refuses the bridge
+        raise click.ClickException(
+            '{} accessories exceed the limit of {} accessories per bridge, '
+            'raise --shards'.format(len(accs), sharding.MAX_ACCESSORIES))
     for acc in accs:
         bridge.add_accessory(acc)
 
     loader.save_accessories()
 
+    # show the last known values right away
+    bridge.restore_values()
+
     # add the bridge
     driver.add_accessory(accessory=bridge)
 
+    # reload changed accessory configs
+    if watch > 0:
+        ConfigWatcher(bridge, loader, watch).start()
+
     signal.signal(signal.SIGTERM, driver.signal_handler)
 
     # start HomeKit
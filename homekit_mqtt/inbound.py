@@ -0,0 +1,208 @@
+import collections
+import logging
+import threading
+
+from homekit_mqtt.brokers import DEFAULT_BROKER
+
+logger = logging.getLogger(__name__)
+
+# what to do with a message if the queue is full
+POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+# messages dispatched per call of the event loop
+LOOP_CHUNK = 100
+
+
+class InboundQueue:
+    """
+    Bounded queue between the MQTT client and the dispatching of messages,
+    so a slow adapter or HomeKit does not stall reading from the broker.
+
+    Messages are dispatched by a worker thread or, with a loop, in chunks on
+    the event loop. Once 'collapse_depth' messages are queued, a message for a
+    topic which is still queued replaces the queued payload, so only the
+    latest value per topic is dispatched. If the queue is full, the policy
+    decides:
+
+    - drop_oldest: drop the oldest queued message
+    - drop_newest: drop the new message
+    - block: wait until there is space, which stops reading from the broker
+      (only without a loop, otherwise like drop_oldest)
+
+    The stats contain the gauges 'inbound_depth' and 'inbound_max_depth' and
+    the counters 'inbound_collapsed' and 'inbound_dropped'. The gauges of
+    queues of other brokers than the default one are keyed by the broker,
+    e.g. 'inbound_depth:sensors'.
+    """
+
+    def __init__(self, dispatch, stats, size=10000, policy='drop_oldest',
+                 collapse_depth=100, loop=None, broker=DEFAULT_BROKER):
+        """
+        Init
+
+        :param dispatch: function dispatch(topic, payload)
+        :type dispatch: callable
+
+        :param stats: dict receiving the counters and gauges
+        :type stats: dict
+
+        :param size: maximum number of queued messages
+        :type size: int
+
+        :param policy: one of POLICIES
+        :type policy: str
+
+        :param collapse_depth: number of queued messages from which on
+            messages of the same topic replace each other
+        :type collapse_depth: int
+
+        :param loop: dispatch on this event loop instead of a thread
+        :type loop: asyncio.AbstractEventLoop
+
+        :param broker: the name of the broker of the messages
+        :type broker: str
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy "{}", use one of {}'.format(
+                policy, ', '.join(POLICIES)))
+        if policy == 'block' and loop is not None:
+            logger.warn('The policy "block" would block the event loop, '
+                        'using "drop_oldest"')
+            policy = 'drop_oldest'
+
+        self.dispatch = dispatch
+        self.stats = stats
+        self.size = max(1, size)
+        self.policy = policy
+        self.collapse_depth = collapse_depth
+        self.loop = loop
+
+        self.name = 'mqtt-dispatch'
+        self.depth_key = 'inbound_depth'
+        self.max_depth_key = 'inbound_max_depth'
+        if broker != DEFAULT_BROKER:
+            self.name += '-' + broker
+            self.depth_key += ':' + broker
+            self.max_depth_key += ':' + broker
+
+        self.cond = threading.Condition()
+        # entries [topic, payload], the latest entry of each topic in index
+        self.queue = collections.deque()
+        self.index = {}
+        self.thread = None
+        self.scheduled = False
+        self.stopped = False
+
+        stats[self.depth_key] = 0
+        stats[self.max_depth_key] = 0
+
+    def _count(self, key):
+        self.stats[key] = self.stats.get(key, 0) + 1
+
+    def _pop(self):
+        entry = self.queue.popleft()
+        if self.index.get(entry[0], None) is entry:
+            del self.index[entry[0]]
+        return entry
+
+    def put(self, topic, payload):
+        """
+        Queue a message
+
+        :param topic: the topic
+        :type topic: str
+
+        :param payload: the payload
+        :type payload: bytes
+        """
+        with self.cond:
+            if self.stopped:
+                return
+
+            depth = len(self.queue)
+            if depth >= self.collapse_depth:
+                entry = self.index.get(topic, None)
+                if entry is not None:
+                    entry[1] = payload
+                    self._count('inbound_collapsed')
+                    return
+
+            if depth >= self.size:
+                if self.policy == 'drop_newest':
+                    self._count('inbound_dropped')
+                    return
+                elif self.policy == 'block':
+                    while len(self.queue) >= self.size and not self.stopped:
+                        self.cond.wait()
+                else:
+                    self._pop()
+                    self._count('inbound_dropped')
+
+            entry = [topic, payload]
+            self.queue.append(entry)
+            self.index[topic] = entry
+
+            depth = len(self.queue)
+            self.stats[self.depth_key] = depth
+            if depth > self.stats[self.max_depth_key]:
+                self.stats[self.max_depth_key] = depth
+
+            if self.loop is not None:
+                if not self.scheduled:
+                    self.scheduled = True
+                    self.loop.call_soon(self._drain)
+            elif self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True,
+                                               name=self.name)
+                self.thread.start()
+            elif depth == 1:
+                self.cond.notify_all()
+
+    def _dispatch(self, entry):
+        try:
+            self.dispatch(entry[0], entry[1])
+        except Exception as e:
+            logger.warn('Dispatching "{}" failed: {}'.format(entry[0], e))
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                entry = self._pop()
+                self.stats[self.depth_key] = len(self.queue)
+                if self.policy == 'block':
+                    self.cond.notify_all()
+
+            self._dispatch(entry)
+
+    def _drain(self):
+        """
+        Dispatch a chunk of messages on the loop and reschedule, so reading
+        from the broker is not starved
+        """
+        for _ in range(LOOP_CHUNK):
+            with self.cond:
+                if not self.queue or self.stopped:
+                    self.scheduled = False
+                    self.stats[self.depth_key] = len(self.queue)
+                    return
+                entry = self._pop()
+
+            self._dispatch(entry)
+
+        with self.cond:
+            self.stats[self.depth_key] = len(self.queue)
+        self.loop.call_soon(self._drain)
+
+    def stop(self):
+        """
+        Stop dispatching, queued messages are dropped
+        """
+        with self.cond:
+            self.stopped = True
+            self.queue.clear()
+            self.index.clear()
+            self.cond.notify_all()
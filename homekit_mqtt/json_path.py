@@ -0,0 +1,218 @@
+import logging
+import threading
+
+from homekit_mqtt.batcher import last_input
+
+logger = logging.getLogger(__name__)
+
+# name of the declarative adapter in the config files
+ADAPTER = 'json'
+
+_MISSING = object()
+
+
+def walk(data, path):
+    """
+    Return the value at path in a parsed JSON object or None. '*' matches any
+    key, the first match is returned.
+
+    :param data: the JSON object
+    :type data: dict or list
+
+    :param path: the keys or list indexes
+    :type path: tuple of str or int
+    """
+    for i, key in enumerate(path):
+        if key == '*':
+            if not isinstance(data, dict):
+                return None
+            for value in data.values():
+                value = walk(value, path[i + 1:])
+                if value is not None:
+                    return value
+            return None
+
+        try:
+            data = data[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return data
+
+
+class Field:
+    """
+    A field of a payload. Extractors of the same field share one Field, so
+    all characteristics fed by a message look the field up and split it only
+    once per message.
+    """
+    __slots__ = ('path', 'split', 'last')
+
+    def __init__(self, path, split):
+        self.path = path
+        self.split = split
+        # (payload, value) of the last message
+        self.last = (_MISSING, None)
+
+    def get(self, payload):
+        """
+        Return the field of a parsed JSON payload or the payload itself, if
+        it is not JSON
+
+        :param payload: the payload as passed to JsonPathAdapter.input()
+        :type payload: dict, list or str
+        """
+        last = self.last
+        if last[0] is payload:
+            return last[1]
+
+        value = payload
+        if self.path and isinstance(value, (dict, list)):
+            value = walk(value, self.path)
+        if self.split is not None and isinstance(value, str):
+            value = value.split(self.split)
+
+        self.last = (payload, value)
+        return value
+
+
+_fields = {}
+_fields_lock = threading.Lock()
+
+
+def get_field(path, split):
+    """
+    Return the shared Field of a path and separator
+    """
+    key = (path, split)
+    with _fields_lock:
+        field = _fields.get(key, None)
+        if field is None:
+            field = _fields[key] = Field(path, split)
+        return field
+
+
+def _key(value):
+    """
+    Return the key of a value in a map, so True, 1 and '1' are the same
+    """
+    if value is True or value is False:
+        value = int(value)
+    elif isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def _number(value):
+    value = float(value)
+    if value.is_integer():
+        return int(value)
+    return value
+
+
+class JsonPathAdapter:
+    """
+    Adapter compiled from the options of a characteristic instead of an
+    adapter class:
+
+    - path: the field of a JSON payload, keys and list indexes separated by
+      '.', '*' matches any key, e.g. 'HSBColor', 'Channel.0' or
+      '*.Temperature'. Payloads which are not JSON are used as they are.
+    - split: split the field at this separator, e.g. ','
+    - index: the element of the split field or list
+    - map: map values, e.g. 'ON:1,OFF:0'. Unmapped values are ignored.
+    - clamp: limit numbers to a range, e.g. '153:500'
+    - scale: multiply numbers by this factor, e.g. '0.1'
+
+    Output values are mapped back, divided by 'scale' and clamped.
+    """
+    json_input = True
+
+    def __init__(self, options):
+        """
+        Compile the options
+
+        :param options: the options of the characteristic
+        :type options: dict
+        """
+        path = options.get('path', '')
+        self.__name__ = '{}({})'.format(ADAPTER, path)
+        path = tuple(int(key) if key.isdigit() else key
+                     for key in path.split('.') if key)
+        self.field = get_field(path, options.get('split', None))
+
+        self.index = None
+        if 'index' in options:
+            self.index = int(options['index'])
+
+        self.map = None
+        self.inverse = None
+        if 'map' in options:
+            pairs = [pair.split(':', 1) for pair in
+                     options['map'].split(',') if pair]
+            if not all(len(pair) == 2 for pair in pairs):
+                raise ValueError('Invalid map "{}"'.format(options['map']))
+            self.map = {key: value for key, value in pairs}
+            self.inverse = {}
+            for key, value in pairs:
+                self.inverse.setdefault(value, key)
+
+        self.clamp = None
+        if 'clamp' in options:
+            low, _, high = options['clamp'].partition(':')
+            self.clamp = (float(low), float(high))
+
+        self.scale = None
+        if 'scale' in options:
+            self.scale = float(options['scale'])
+            if self.scale == 0:
+                raise ValueError('scale must not be 0')
+
+    def input(self, topic, payload):
+        value = self.field.get(payload)
+        if value is None:
+            return None
+
+        if self.index is not None:
+            try:
+                value = value[self.index]
+            except (IndexError, KeyError, TypeError):
+                return None
+
+        if self.map is not None:
+            value = self.map.get(_key(value), None)
+            if value is None:
+                return None
+
+        if self.clamp is not None:
+            value = min(max(float(value), self.clamp[0]), self.clamp[1])
+        if self.scale is not None:
+            value = float(value) * self.scale
+
+        return value
+
+    def input_batch(self, messages):
+        return last_input(self, messages)
+
+    def output(self, topic, payload):
+        value = payload
+        if self.scale is not None:
+            value = float(value) / self.scale
+        if self.clamp is not None:
+            value = min(max(float(value), self.clamp[0]), self.clamp[1])
+        if self.scale is not None or self.clamp is not None:
+            value = _number(value)
+
+        if self.inverse is not None:
+            value = self.inverse.get(_key(value), None)
+
+        return value
+
+
+def compile_adapter(options):
+    """
+    Return the JsonPathAdapter of the options of a characteristic
+
+    :param options: the options of the characteristic
+    :type options: dict
+    """
+    return JsonPathAdapter(options)
@@ -0,0 +1,183 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# maximum number of distinct keys aggregated per window
+MAX_KEYS = 1000
+
+
+def parse_level(level):
+    """
+    Return the logging level of a name like 'WARNING' or a number. 'OFF'
+    disables publishing.
+
+    :param level: the name or number of the level
+    :type level: str
+    """
+    level = str(level).strip().upper()
+    if level in ('OFF', 'NONE', ''):
+        return float('inf')
+    if level.isdigit():
+        return int(level)
+    value = logging.getLevelName(level)
+    if not isinstance(value, int):
+        raise ValueError('Unknown log level "{}"'.format(level))
+    return value
+
+
+class LogChannel:
+    """
+    Logs messages and publishes them to a MQTT topic, without letting a
+    misbehaving device flood the log or the broker.
+
+    Messages are aggregated by key (the message itself by default): the first
+    message of a key is logged and published right away, repetitions within
+    'window' seconds are only counted and reported once at the end of the
+    window. A window of 0 disables the aggregation. Published messages are
+    limited by a token bucket refilled with 'rate' messages per second and
+    holding up to 'burst' messages. Messages beyond the limit are still
+    logged, but not published.
+    """
+
+    def __init__(self, send, timers, stats, level=logging.WARNING, rate=1.0,
+                 burst=10, window=60.0):
+        """
+        Init
+
+        :param send: function send(message) publishing a message
+        :type send: callable
+
+        :param timers: timers ending the aggregation windows
+        :type timers: homekit_mqtt.timers.Timers
+
+        :param stats: dict with the counters 'log_suppressed' and
+            'log_dropped'
+        :type stats: dict
+
+        :param level: minimum level of published messages
+        :type level: int
+
+        :param rate: published messages per second
+        :type rate: float
+
+        :param burst: maximum number of messages published at once
+        :type burst: int
+
+        :param window: seconds over which repeated messages are aggregated,
+            0 disables the aggregation
+        :type window: float
+        """
+        self.send = send
+        self.timers = timers
+        self.stats = stats
+        self.level = level
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+
+        self.lock = threading.Lock()
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.entries = {}
+        self.overflow = 0
+        self.flush_pending = False
+
+    def _count(self, key, n=1):
+        self.stats[key] = self.stats.get(key, 0) + n
+
+    def _take(self):
+        """
+        Take a token from the bucket, return False if it is empty
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self._count('log_dropped')
+        return False
+
+    def log(self, level, message, key=None):
+        """
+        Log and publish a message, unless it was already sent in this window
+
+        :param level: the logging level
+        :type level: int
+
+        :param message: the message
+        :type message: str
+
+        :param key: messages with the same key are aggregated, e.g. a
+            message without variable parts
+        :type key: str
+        """
+        message = str(message)
+        if key is None:
+            key = message
+
+        with self.lock:
+            if self.window > 0:
+                entry = self.entries.get(key, None)
+                if entry is not None:
+                    entry[0] += 1
+                    self._count('log_suppressed')
+                    return
+
+                # too many different messages, only log them locally
+                if len(self.entries) >= MAX_KEYS:
+                    self.overflow += 1
+                    self._count('log_suppressed')
+                    publish = False
+                else:
+                    self.entries[key] = [0, level, message]
+                    if not self.flush_pending:
+                        self.flush_pending = True
+                        self.timers.call_later(self.window, self.flush)
+                    publish = level >= self.level and self._take()
+            else:
+                publish = level >= self.level and self._take()
+
+        logger.log(level, message)
+        if publish:
+            self._send(message)
+
+    def warn(self, message, key=None):
+        """
+        Log and publish a warning, see log()
+        """
+        self.log(logging.WARNING, message, key)
+
+    def flush(self):
+        """
+        End the current window and report the repeated messages
+        """
+        with self.lock:
+            entries = self.entries
+            overflow = self.overflow
+            self.entries = {}
+            self.overflow = 0
+            self.flush_pending = False
+
+        summaries = [(level, '{} (repeated {} times in {:.0f}s)'.format(
+                          message, count, self.window))
+                     for count, level, message in entries.values() if count]
+        if overflow:
+            summaries.append((logging.WARNING, '{} more messages in {:.0f}s'
+                              .format(overflow, self.window)))
+
+        for level, summary in summaries:
+            logger.log(level, summary)
+            with self.lock:
+                publish = level >= self.level and self._take()
+            if publish:
+                self._send(summary)
+
+    def _send(self, message):
+        try:
+            self.send(message)
+        except Exception as e:
+            logger.debug('Cannot publish log message: {}'.format(e))
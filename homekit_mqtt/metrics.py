@@ -0,0 +1,315 @@
+import bisect
+import collections
+import functools
+import http.server
+import logging
+import socketserver
+import threading
+import time
+
+from homekit_mqtt.brokers import DEFAULT_BROKER, split_topic
+
+logger = logging.getLogger(__name__)
+
+# latency buckets in seconds, from 10us to 1s
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+           0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# entries of MqttBridge.stats which only increase
+COUNTERS = ('notify_delivered', 'notify_suppressed', 'publish_sent',
+            'publish_coalesced', 'mqtt_connects', 'polls_sent',
+            'polls_skipped', 'hap_events', 'log_suppressed', 'log_dropped',
+            'batches', 'batched_messages', 'inbound_collapsed',
+            'inbound_dropped', 'messages_unmatched')
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server.ThreadingHTTPServer requires Python 3.7
+    daemon_threads = True
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets. Observing a value only increments
+    preallocated counters.
+    """
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds=BUCKETS):
+        """
+        Init
+
+        :param bounds: the upper bounds of the buckets in ascending order
+        :type bounds: tuple of float
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        Add a value
+
+        :param value: the value
+        :type value: float
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels=''):
+        """
+        Return the histogram in the Prometheus text format
+
+        :param name: the name of the metric
+        :type name: str
+
+        :param labels: labels of the metric, e.g. 'adapter="POWER"'
+        :type labels: str
+        """
+        sep = ',' if labels else ''
+        lines = []
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(
+                name, labels, sep, le, total))
+        labels = '{{{}}}'.format(labels) if labels else ''
+        lines.append('{}_sum{} {!r}'.format(name, labels, self.sum))
+        lines.append('{}_count{} {}'.format(name, labels, total))
+        return lines
+
+
+class TimedAdapter:
+    """
+    Proxy of an adapter class recording the time and the exceptions of its
+    input(), output() and input_batch() methods
+    """
+
+    def __init__(self, adapter, metrics):
+        self.adapter = adapter
+        self.metrics = metrics
+        self.__name__ = adapter.__name__
+        self.json_input = getattr(adapter, 'json_input', False)
+        if hasattr(adapter, 'prune'):
+            self.prune = adapter.prune
+
+        self.input = self._timed(adapter.input, 'input')
+        self.output = self._timed(adapter.output, 'output')
+        if callable(getattr(adapter, 'input_batch', None)):
+            self.input_batch = self._timed(adapter.input_batch,
+                                           'input_batch')
+
+    def _timed(self, func, method):
+        histogram = self.metrics.adapter_histogram(self.__name__, method)
+        errors = self.metrics.adapter_errors
+        key = (self.__name__, method)
+
+        @functools.wraps(func)
+        def timed(*args):
+            start = time.perf_counter()
+            try:
+                return func(*args)
+            except Exception:
+                errors[key] += 1
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start)
+
+        return timed
+
+
+class Metrics:
+    """
+    Counters and latency histograms of the bridge, served in the Prometheus
+    text format on /metrics.
+
+    The hot paths are only instrumented if metrics are enabled, by wrapping
+    MqttBridge.update_char and the adapters. Otherwise, nothing is recorded
+    and nothing is wrapped.
+    """
+
+    def __init__(self, stats):
+        """
+        Init
+
+        :param stats: the counters and gauges of the bridge
+        :type stats: dict
+        """
+        self.stats = stats
+        self.messages = collections.Counter()
+        self.dispatch = Histogram()
+        self.adapters = {}
+        self.adapter_errors = collections.Counter()
+        self.proxies = {}
+        self.server = None
+
+    def adapter_histogram(self, name, method):
+        key = (name, method)
+        histogram = self.adapters.get(key, None)
+        if histogram is None:
+            histogram = self.adapters[key] = Histogram()
+        return histogram
+
+    def wrap_dispatch(self, update_char):
+        """
+        Return update_char recording the dispatch time and counting the
+        messages per topic. Messages of topics without a characteristic are
+        counted in total, so unknown topics do not create new series.
+
+        :param update_char: the function dispatching a message
+        :type update_char: callable
+        """
+        messages = self.messages
+        histogram = self.dispatch
+        stats = self.stats
+
+        @functools.wraps(update_char)
+        def timed(topic, payload):
+            start = time.perf_counter()
+            routed = False
+            try:
+                routed = update_char(topic, payload)
+                return routed
+            finally:
+                histogram.observe(time.perf_counter() - start)
+                if routed:
+                    messages[topic] += 1
+                else:
+                    stats['messages_unmatched'] = \
+                        stats.get('messages_unmatched', 0) + 1
+
+        return timed
+
+    def wrap_adapter(self, adapter):
+        """
+        Return a TimedAdapter of an adapter class
+
+        :param adapter: the adapter class
+        :type adapter: type
+        """
+        if adapter is None:
+            return None
+
+        proxy = self.proxies.get(adapter, None)
+        if proxy is None:
+            proxy = self.proxies[adapter] = TimedAdapter(adapter, self)
+        return proxy
+
+    def wrap_counter(self, func, key):
+        """
+        Return func counting its calls in the stats
+
+        :param func: the function
+        :type func: callable
+
+        :param key: the key of the counter in the stats
+        :type key: str
+        """
+        stats = self.stats
+
+        @functools.wraps(func)
+        def counted(*args, **kwargs):
+            stats[key] = stats.get(key, 0) + 1
+            return func(*args, **kwargs)
+
+        return counted
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text format
+        """
+        lines = []
+        typed = set()
+        for key, value in sorted(self.stats.items()):
+            if not isinstance(value, (int, float)):
+                continue
+            # stats of other brokers are keyed 'key:broker'
+            key, _, broker = key.partition(':')
+            name = 'homekit_mqtt_' + key
+            if key in COUNTERS:
+                name += '_total'
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} {}'.format(
+                    name, 'counter' if key in COUNTERS else 'gauge'))
+            if broker:
+                lines.append('{}{{broker="{}"}} {}'.format(
+                    name, escape(broker), value))
+            else:
+                lines.append('{} {}'.format(name, value))
+
+        lines.append('# TYPE homekit_mqtt_messages_total counter')
+        for topic, count in sorted(self.messages.items()):
+            broker, topic = split_topic(topic)
+            labels = 'topic="{}"'.format(escape(topic))
+            if broker != DEFAULT_BROKER:
+                labels += ',broker="{}"'.format(escape(broker))
+            lines.append('homekit_mqtt_messages_total{{{}}} {}'.format(
+                labels, count))
+
+        lines.append('# TYPE homekit_mqtt_dispatch_seconds histogram')
+        lines += self.dispatch.render('homekit_mqtt_dispatch_seconds')
+
+        lines.append('# TYPE homekit_mqtt_adapter_seconds histogram')
+        for (name, method), histogram in sorted(self.adapters.items()):
+            lines += histogram.render(
+                'homekit_mqtt_adapter_seconds',
+                'adapter="{}",method="{}"'.format(escape(name), method))
+
+        lines.append('# TYPE homekit_mqtt_adapter_exceptions_total counter')
+        for (name, method), count in sorted(self.adapter_errors.items()):
+            lines.append('homekit_mqtt_adapter_exceptions_total'
+                         '{{adapter="{}",method="{}"}} {}'.format(
+                             escape(name), method, count))
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host=''):
+        """
+        Serve the metrics on http://host:port/metrics in a background thread
+
+        :param port: the port
+        :type port: int
+
+        :param host: the address to listen on, all by default
+        :type host: str
+        """
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self.server = _Server((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True,
+                         name='metrics').start()
+        logger.info('Serving metrics on port {}'.format(
+            self.server.server_address[1]))
+
+    def stop(self):
+        """
+        Stop serving the metrics
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
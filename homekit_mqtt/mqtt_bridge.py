@@ -1,6 +1,35 @@
+"""
+The MqttBridge and the conversion of MQTT payloads to HAP values.
+
+Received messages are queued per broker (inbound.InboundQueue) and
+dispatched with a table mapping each topic to a tuple of Routes. A payload
+is decoded once per message, adapters with a true 'json_input' attribute
+receive the parsed JSON object. Wildcard topics are resolved with a
+TopicTrie and the result is remembered per topic. The routes are replaced,
+never changed, when accessories are added, removed or remapped, and the
+table is compiled again on the next message.
+
+Adapters with input_batch(messages) are batched per device (see
+batcher.Batcher), the adapter 'json' is compiled from the options of the
+characteristic (see json_path.JsonPathAdapter). Characteristics with the
+options 'dedup', 'deadband' or 'interval' notify HomeKit through a
+notify.NotifyPolicy and values set in the Home app are published through a
+publisher.PublishQueue.
+
+Topics of other brokers than the one of the section [MQTT] are prefixed
+with the name of their broker (see brokers.broker_topic). Adapters receive
+the topics without the prefix, brokers.current_broker() returns the broker
+of the message an adapter is called for. With
+use_asyncio=True, the MQTT I/O and all timers run on the event loop of the
+AccessoryDriver.
+"""
+
 import os
 import json
+import time
 import logging
+import threading
+import collections
 import configparser
 import paho.mqtt.client as mqtt
 
@@ -8,10 +37,190 @@ from pyhap.accessory import Bridge
 from pyhap.const import CATEGORY_BRIDGE
 import pyhap.characteristic as pyhap_char
 
-from homekit_mqtt import adapters
+from homekit_mqtt import json_path
+from homekit_mqtt.backoff import Backoff
+from homekit_mqtt.batcher import Batcher
+from homekit_mqtt.brokers import (DEFAULT_BROKER, SECTION_PREFIX, SEPARATOR,
+                                  Broker, broker_topic, split_topic,
+                                  display_topic, set_current_broker)
+from homekit_mqtt.inbound import InboundQueue
+from homekit_mqtt.log_channel import LogChannel, parse_level
+from homekit_mqtt.metrics import Metrics
+from homekit_mqtt.notify import NotifyPolicy
+from homekit_mqtt.poller import Poller
+from homekit_mqtt.publisher import PublishQueue
+from homekit_mqtt.registry import capabilities, default_registry
+from homekit_mqtt.snapshot import Snapshot
+from homekit_mqtt.timers import Timers, LoopTimers
+from homekit_mqtt.aio import AsyncioHelper
+from homekit_mqtt.topic_trie import TopicTrie, has_wildcards, covers, collapse
 
 logger = logging.getLogger(__name__)
 
+# One entry of the dispatch table: a characteristic fed by a topic
+Route = collections.namedtuple(
+    'Route', ['char', 'adapter', 'hap_format', 'converter', 'json_input',
+              'notify', 'qos', 'poll', 'batch'])
+
+# The compiled dispatch table: the routes it was compiled from, the routes
+# of each literal topic, the number of compiled topics and the tries of the
+# wildcard topics by broker (or None)
+DispatchTable = collections.namedtuple(
+    'DispatchTable', ['routes', 'topics', 'size', 'wildcards'])
+
+# maximum number of topics matched against wildcards remembered by dispatch
+MATCH_CACHE_SIZE = 10000
+
+
+def decode_payload(payload):
+    """
+    Decode a MQTT payload once, so all adapters of a topic can share it
+
+    Returns a tuple (text, data). data is the parsed JSON object if the payload
+    looks like JSON and None otherwise.
+
+    :param payload: The payload of the MQTT message
+    :type payload: bytes
+    """
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8', 'replace')
+
+    data = None
+    if payload[:1] in ('{', '['):
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            pass
+
+    return payload, data
+
+
+def to_str(value):
+    """
+    Convert a value to str, decoding bytes instead of returning "b'...'"
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return str(value)
+
+
+def _bool_table():
+    table = {}
+    for text, value in [('true', True), ('on', True), ('1', True),
+                        ('yes', True), ('false', False), ('off', False),
+                        ('0', False), ('no', False), ('', False)]:
+        for variant in (text, text.upper(), text.capitalize()):
+            table[variant] = table[variant.encode()] = value
+    return table
+
+
+_BOOLS = _bool_table()
+
+
+def to_bool(value):
+    """
+    Convert a value to bool. Strings like 'false', 'off' or '0' are False.
+    """
+    if value is True or value is False:
+        return value
+
+    try:
+        return _BOOLS[value]
+    except (KeyError, TypeError):
+        pass
+
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    if isinstance(value, str):
+        text = value.strip().lower()
+        if text in _BOOLS:
+            return _BOOLS[text]
+        try:
+            return bool(float(text))
+        except ValueError:
+            pass
+    return bool(value)
+
+
+def to_int(value):
+    """
+    Convert a value to int, accepting floats like '42.0'
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+
+def to_float(value):
+    """
+    Convert a value to float
+    """
+    return float(value)
+
+
+def to_json(value):
+    """
+    Parse a JSON value, unless it was already parsed by decode_payload()
+    """
+    if isinstance(value, (str, bytes)):
+        return json.loads(value)
+    return value
+
+
+def from_json(value):
+    """
+    Serialize a value as JSON
+    """
+    return json.dumps(value)
+
+
+# converters by HAP format, resolved once per characteristic
+MQTT2HAP = {
+    pyhap_char.HAP_FORMAT_BOOL: to_bool,
+    pyhap_char.HAP_FORMAT_FLOAT: to_float,
+    pyhap_char.HAP_FORMAT_ARRAY: to_json,
+    pyhap_char.HAP_FORMAT_DICTIONARY: to_json,
+    pyhap_char.HAP_FORMAT_STRING: to_str,
+    pyhap_char.HAP_FORMAT_DATA: to_str,
+    pyhap_char.HAP_FORMAT_TLV8: to_str,
+}
+
+HAP2VAR = {
+    pyhap_char.HAP_FORMAT_BOOL: to_bool,
+    pyhap_char.HAP_FORMAT_FLOAT: to_float,
+    pyhap_char.HAP_FORMAT_ARRAY: from_json,
+    pyhap_char.HAP_FORMAT_DICTIONARY: from_json,
+    pyhap_char.HAP_FORMAT_STRING: to_str,
+    pyhap_char.HAP_FORMAT_DATA: to_str,
+    pyhap_char.HAP_FORMAT_TLV8: to_str,
+}
+
+_INTEGERS = [hap_format for hap_format in pyhap_char.HAP_FORMAT_NUMERICS
+             if hap_format != pyhap_char.HAP_FORMAT_FLOAT]
+MQTT2HAP.update({hap_format: to_int for hap_format in _INTEGERS})
+HAP2VAR.update({hap_format: to_int for hap_format in _INTEGERS})
+
+
+def mqtt2hap_converter(hap_format):
+    """
+    Return the function converting MQTT payload values to valid HAP values
+
+    :param hap_format: The HAP_FORMAT constant from pyhap.pyhap_characteristic
+    :type hap_format: str
+    """
+    return MQTT2HAP.get(hap_format, to_str)
+
+
+def hap2var_converter(hap_format):
+    """
+    Return the function converting HAP values to python vars
+
+    :param hap_format: The HAP_FORMAT constant from pyhap.pyhap_characteristic
+    :type hap_format: str
+    """
+    return HAP2VAR.get(hap_format, to_str)
+
 
 def mqtt2hap(hap_format, value):
     """
@@ -23,25 +232,7 @@ def mqtt2hap(hap_format, value):
     :param value: The value to convert
     :type value: bin
     """
-    if hap_format == pyhap_char.HAP_FORMAT_BOOL:
-        if value == b'true':
-            return True
-        return bool(value)
-    elif hap_format == pyhap_char.HAP_FORMAT_FLOAT:
-        return float(value)
-    elif hap_format == pyhap_char.HAP_FORMAT_ARRAY:
-        return json.loads(value)
-    elif hap_format == pyhap_char.HAP_FORMAT_DICTIONARY:
-        return json.loads(value)
-    elif hap_format == pyhap_char.HAP_FORMAT_TLV8:
-        return str(value)
-    elif hap_format in pyhap_char.HAP_FORMAT_NUMERICS:
-        return int(value)
-    elif hap_format in [pyhap_char.HAP_FORMAT_STRING,
-                        pyhap_char.HAP_FORMAT_DATA]:
-        return str(value)
-
-    return str(value)
+    return mqtt2hap_converter(hap_format)(value)
 
 
 def hap2var(hap_format, value):
@@ -54,24 +245,7 @@ def hap2var(hap_format, value):
     :param value: The value to convert
     :type value: bin
     """
-    if hap_format == pyhap_char.HAP_FORMAT_BOOL:
-        return bool(value)
-    elif hap_format == pyhap_char.HAP_FORMAT_FLOAT:
-        return float(value)
-    elif hap_format == pyhap_char.HAP_FORMAT_STRING:
-        return str(value)
-    elif hap_format == pyhap_char.HAP_FORMAT_ARRAY:
-        return json.dumps(value)
-    elif hap_format == pyhap_char.HAP_FORMAT_DICTIONARY:
-        return json.dumps(value)
-    elif hap_format == pyhap_char.HAP_FORMAT_DATA:
-        return str(value)
-    elif hap_format == pyhap_char.HAP_FORMAT_TLV8:
-        return str(value)
-    elif hap_format in pyhap_char.HAP_FORMAT_NUMERICS:
-        return int(value)
-
-    return str(value)
+    return hap2var_converter(hap_format)(value)
 
 
 class MqttBridge(Bridge):
@@ -87,57 +261,178 @@ class MqttBridge(Bridge):
     and sends the received values to iOS-devices.
 
     The optional adapter class accessory.properties['adapter']
-    from the adapters module is used.
+    from the adapters module or an adapter plugin is used. The settings are
+    read from bridge.cfg (see data/bridge.cfg), counters and gauges are
+    collected in self.stats.
     """
     category = CATEGORY_BRIDGE
+    registry = default_registry
 
-    def __init__(self, cfg, *args, **kwargs):
+    def __init__(self, cfg, *args, use_asyncio=False, **kwargs):
         """
         Init
 
         :param cfg: directory containing the configuration
         :type cfg: str
+
+        :param use_asyncio: run MQTT on the event loop of the driver
+        :type use_asyncio: bool
         """
         super().__init__(*args, **kwargs)
 
-        self.client = None
-        self.getter_callbacks = {}
+        self.created = time.monotonic()
+        self.stats = {}
+        self.stopped = threading.Event()
+        self.use_asyncio = use_asyncio
+        if use_asyncio:
+            self.timers = LoopTimers(self.driver.loop)
+        else:
+            self.timers = Timers()
+        self.routes = {}
+        self.qos = {}
+        self.adapters = set()
+        # the adapters used by each accessory
+        self.acc_adapters = {}
+        self.known_topics = set()
+        self.dispatch = None
+        self.collapsed = {}
 
         self._load_cfg(cfg)
-        self._init_mqtt(self.broker_addr, self.creds)
 
-    def _init_mqtt(self, broker_addr, creds=None):
+        self.metrics = None
+        if self.metrics_port > 0:
+            self.metrics = Metrics(self.stats)
+            self.update_char = self.metrics.wrap_dispatch(self.update_char)
+            self.driver.publish = self.metrics.wrap_counter(
+                self.driver.publish, 'hap_events')
+
+        for broker in self.brokers.values():
+            self._init_mqtt(broker)
+
+        # the default broker
+        broker = self.brokers[DEFAULT_BROKER]
+        self.client = broker.client
+        self.aio = broker.aio
+        self.backoff = broker.backoff
+        self.inbound = broker.inbound
+        self.log_channel = LogChannel(
+            lambda message: self.client.publish(self.log_topic, message),
+            self.timers, self.stats, self.log_level, self.log_rate,
+            self.log_burst, self.log_window)
+        self.publisher = PublishQueue(self._publish, self.timers, self.stats,
+                                      self.publish_window)
+
+        self.batcher = None
+        if self.batch_window > 0:
+            self.batcher = Batcher(self._apply_batch, self.timers, self.stats,
+                                   self.batch_window)
+
+        self.poller = Poller(self._publish, self.timers, self.stats,
+                             self.poll_rate, self.poll_timeout)
+
+        # characteristics which received a value
+        self.seen = set()
+        self.saved_values = None
+        self.snapshot = None
+        if self.snapshot_interval > 0:
+            self.snapshot = Snapshot(os.path.splitext(
+                self.driver.persist_file)[0] + '.values')
+
+    def _init_mqtt(self, broker):
         """
-        Initialize the MQTT client
+        Initialize the MQTT client and the InboundQueue of a broker
 
-        :param broker_addr: The address:port of the MQTT Broker
-        :type broker_addr: tuple(str, int)
-
-        :param creds: login credentials for the Broker
-        :type creds: tuple(username, password)
+        :param broker: the broker
+        :type broker: homekit_mqtt.brokers.Broker
         """
-        def on_connect(client, userdata, flags, rc):
-            logger.info('Connected to MQTT Broker with result code ' + str(rc))
+        pending = set()
+        started = [0.0]
 
-            for topic in self.getter_callbacks.keys():
-                self.client.subscribe(topic)
+        def on_connect(client, userdata, flags, rc):
+            logger.info('Connected to MQTT Broker {} with result code '
+                        '{}'.format(broker.name, rc))
+            if rc != 0:
+                return
+
+            self.stats['mqtt_connects'] = \
+                self.stats.get('mqtt_connects', 0) + 1
+            self.resync(broker.name)
+
+            with broker.subscribe_lock:
+                subscriptions = self.get_subscriptions(broker.name)
+                broker.subscribed = dict(subscriptions)
+                self._count_subscriptions()
+
+                started[0] = time.monotonic()
+                pending.clear()
+                pending.update(self._subscribe(broker, subscriptions))
+
+        def on_subscribe(client, userdata, mid, granted_qos):
+            if 0x80 in granted_qos:
+                self.warn('Broker {} rejected {} subscriptions'.format(
+                    broker.name, granted_qos.count(0x80)))
+
+            # subscriptions of reloaded accessories are not timed
+            if mid not in pending:
+                return
+
+            pending.discard(mid)
+            if not pending:
+                elapsed = time.monotonic() - started[0]
+                self.stats['subscribe_seconds'] = elapsed
+                logger.info('Subscribed to {} topics of {} in {:.3f}s'.format(
+                    len(broker.subscribed), broker.name, elapsed))
+
+                broker.ready = True
+                if 'mqtt_ready_seconds' not in self.stats and all(
+                        other.ready for other in self.brokers.values()):
+                    ready = time.monotonic() - self.created
+                    self.stats['mqtt_ready_seconds'] = ready
+                    logger.info('MQTT ready after {:.3f}s'.format(ready))
 
         def on_disconnect(client, userdata, rc):
-            logger.info('Disconnected from MQTT Broker with result code ' +
-                        str(rc))
-
-        def on_message(client, userdata, message):
-            self.update_char(message.topic, message.payload)
-
-        self.client = mqtt.Client()
-        self.client.on_connect = on_connect
-        self.client.on_disconnect = on_disconnect
-        self.client.on_message = on_message
-
-        if creds is not None:
-            self.client.username_pw_set(creds[0], creds[1])
-
-        self.client.connect(broker_addr[0], broker_addr[1])
+            logger.info('Disconnected from MQTT Broker {} with result code '
+                        '{}'.format(broker.name, rc))
+
+        if broker.queue_size > 0:
+            broker.inbound = InboundQueue(
+                lambda topic, payload: self.update_char(topic, payload),
+                self.stats, broker.queue_size, broker.queue_policy,
+                broker.collapse_depth,
+                self.driver.loop if self.use_asyncio else None,
+                broker.name)
+
+        if broker.name == DEFAULT_BROKER:
+            def on_message(client, userdata, message):
+                if broker.inbound is None:
+                    self.update_char(message.topic, message.payload)
+                else:
+                    broker.inbound.put(message.topic, message.payload)
+        else:
+            def on_message(client, userdata, message):
+                topic = broker_topic(broker.name, message.topic)
+                if broker.inbound is None:
+                    self.update_char(topic, message.payload)
+                else:
+                    broker.inbound.put(topic, message.payload)
+
+        client = broker.client = mqtt.Client()
+        client.on_connect = on_connect
+        client.on_subscribe = on_subscribe
+        client.on_disconnect = on_disconnect
+        client.on_message = on_message
+
+        if broker.creds is not None:
+            client.username_pw_set(broker.creds[0], broker.creds[1])
+
+        # later reconnects of the paho network thread
+        client.reconnect_delay_set(broker.reconnect_min,
+                                   broker.reconnect_max)
+        broker.backoff = Backoff(broker.reconnect_min, broker.reconnect_max)
+
+        if self.use_asyncio:
+            broker.aio = AsyncioHelper(self.driver.loop, client,
+                                       broker.backoff)
 
     def _load_cfg(self, cfg):
         """
@@ -164,14 +459,41 @@ class MqttBridge(Bridge):
                               acc_def.get('SerialNumber', None))
 
         mqtt_def = cfg['MQTT']
-        self.broker_addr = (mqtt_def['HostName'], int(mqtt_def['Port']))
-
-        self.creds = None
-        username = mqtt_def.get('UserName', None)
-        password = mqtt_def.get('Password', None)
-
-        if username is not None and password is not None:
-            self.creds = (username, password)
+        self.brokers = {DEFAULT_BROKER: Broker(DEFAULT_BROKER, mqtt_def)}
+        for section in cfg.sections():
+            if section.startswith(SECTION_PREFIX):
+                name = section[len(SECTION_PREFIX):].strip()
+                self.brokers[name] = Broker(name, cfg[section], mqtt_def)
+
+        broker = self.brokers[DEFAULT_BROKER]
+        self.broker_addr = broker.addr
+        self.creds = broker.creds
+
+        self.collapse_threshold = int(mqtt_def.get('CollapseThreshold', 8))
+        self.subscribe_chunk_size = int(
+            mqtt_def.get('SubscribeChunkSize', 100))
+        self.default_qos = broker.default_qos
+        self.publish_qos = int(mqtt_def.get('PublishQoS', 0))
+        self.publish_window = float(mqtt_def.get('PublishWindow', 0.1))
+        self.batch_window = float(mqtt_def.get('BatchWindow', 0))
+
+        poll_def = cfg['Poll'] if 'Poll' in cfg else {}
+        self.poll_rate = float(poll_def.get('Rate', 20))
+        self.poll_timeout = float(poll_def.get('Timeout', 5))
+
+        snapshot_def = cfg['Snapshot'] if 'Snapshot' in cfg else {}
+        self.snapshot_interval = float(snapshot_def.get('Interval', 60))
+
+        log_def = cfg['Log'] if 'Log' in cfg else {}
+        self.log_topic = log_def.get('Topic', 'stat/homekit/log')
+        self.log_level = parse_level(log_def.get('Level', 'WARNING'))
+        self.log_rate = float(log_def.get('Rate', 1))
+        self.log_burst = int(log_def.get('Burst', 10))
+        self.log_window = float(log_def.get('Window', 60))
+
+        metrics_def = cfg['Metrics'] if 'Metrics' in cfg else {}
+        self.metrics_port = int(metrics_def.get('Port', 0))
+        self.metrics_host = metrics_def.get('Host', '')
 
     def __getstate__(self):
         """
@@ -192,7 +514,8 @@ class MqttBridge(Bridge):
 
     def update_char(self, topic, payload):
         """
-        Update a characteristic from a received MQTT message
+        Update a characteristic from a received MQTT message and return if
+        the topic has a characteristic
 
         :param topic: topic of the MQTT message
         :type topic: str
@@ -200,18 +523,317 @@ class MqttBridge(Bridge):
         :param payload: payload of the MQTT message
         :type payload: bytes
         """
-        # split topic into acc, char, serv
-        callback = self.getter_callbacks.get(topic, None)
-        if callback is None:
-            self.warn('Received unknown topic "{}"'.format(topic))
+        # the routes are replaced, never changed, when accessories change
+        dispatch = self.dispatch
+        if dispatch is None or dispatch.routes is not self.routes:
+            dispatch = self._compile_dispatch()
+
+        routes = dispatch.topics.get(topic, None)
+        if routes is None:
+            routes = self._match_routes(dispatch, topic)
+        if not routes:
+            return False
+
+        if SEPARATOR not in topic:
+            self._apply_routes(routes, topic, topic, payload)
+            return True
+
+        # adapters receive the topic without the name of the broker
+        broker, mqtt_topic = split_topic(topic)
+        set_current_broker(broker)
+        try:
+            self._apply_routes(routes, topic, mqtt_topic, payload)
+        finally:
+            set_current_broker(DEFAULT_BROKER)
+        return True
+
+    def _apply_routes(self, routes, topic, mqtt_topic, payload):
+        """
+        Update the characteristics of the routes of a message
+
+        :param routes: the routes of the topic
+        :type routes: tuple of Route
+
+        :param topic: the topic as used by the MqttBridge
+        :type topic: str
+
+        :param mqtt_topic: the topic on the broker
+        :type mqtt_topic: str
+
+        :param payload: payload of the MQTT message
+        :type payload: bytes
+        """
+        # decode once and share the result with all adapters of this topic
+        text, data = decode_payload(payload)
+
+        for route in routes:
+            adapter = route.adapter
+            value = text
+            if route.json_input and data is not None:
+                value = data
+
+            if route.batch:
+                self.batcher.add(route, topic, value)
+                continue
+
+            if adapter is not None:
+                try:
+                    value = adapter.input(mqtt_topic, value)
+                except Exception as e:
+                    self.warn('Exception in {}.input(): {}'.format(
+                        adapter.__name__, e),
+                        key='input:' + adapter.__name__)
+                    continue
+
+                if value is None:
+                    continue
+
+            self._set_char(route, topic, value)
+
+    def _apply_batch(self, batch):
+        """
+        Convert the messages collected by the Batcher and set the values
+
+        :param batch: maps routes to the (topic, payload) of their messages
+        :type batch: dict
+        """
+        updates = []
+        for route, messages in batch.items():
+            # all messages of a batch are from the same device and broker
+            topic = messages[-1][0]
+            broker, _ = split_topic(topic)
+            if broker != DEFAULT_BROKER:
+                messages = [(split_topic(message_topic)[1], payload)
+                            for message_topic, payload in messages]
+
+            set_current_broker(broker)
+            try:
+                value = route.adapter.input_batch(messages)
+            except Exception as e:
+                self.warn('Exception in {}.input_batch(): {}'.format(
+                    route.adapter.__name__, e),
+                    key='input_batch:' + route.adapter.__name__)
+                continue
+            finally:
+                set_current_broker(DEFAULT_BROKER)
+
+            if value is not None:
+                updates.append((route, topic, value))
+
+        if not updates:
             return
 
-        callback(payload)
+        # one thread hop for all events of the batch
+        loop = self.driver.loop
+        if loop.is_running() and \
+                threading.current_thread() != self.driver.tid:
+            loop.call_soon_threadsafe(self._set_values, updates)
+        else:
+            self._set_values(updates)
+
+    def _set_values(self, updates):
+        """
+        Set the values of characteristics
+
+        :param updates: the routes, topics and values
+        :type updates: list of (Route, str, object)
+        """
+        for route, topic, value in updates:
+            self._set_char(route, topic, value)
+
+    def _set_char(self, route, topic, value):
+        """
+        Convert a value of an adapter or a message and set the characteristic
+        of its route, through its notify.NotifyPolicy if it has one
+
+        :param route: the route of the characteristic
+        :type route: Route
+
+        :param topic: the topic of the value as used by the MqttBridge
+        :type topic: str
+
+        :param value: the value
+        :type value: object
+        """
+        try:
+            if route.notify is None:
+                route.char.set_value(route.converter(value))
+            else:
+                route.notify.offer(route.converter(value))
+            self.seen.add(route.char)
+            if route.poll is not None:
+                route.poll.touch()
+        except Exception as e:
+            self.warn('Cannot set {} from "{}": {}'.format(
+                route.char.display_name, display_topic(topic), e),
+                key='set:' + topic)
+
+    def _match_routes(self, dispatch, topic):
+        """
+        Find the routes of a topic without an entry in the dispatch table
+
+        :param dispatch: the dispatch table
+        :type dispatch: DispatchTable
+
+        :param topic: topic of the MQTT message
+        :type topic: str
+        """
+        broker, mqtt_topic = split_topic(topic)
+
+        routes = ()
+        wildcards = dispatch.wildcards
+        if wildcards is not None and broker in wildcards:
+            routes = tuple(
+                route for matched in wildcards[broker].match(mqtt_topic)
+                for route in matched)
+
+        if not routes:
+            collapsed = self.collapsed.get(broker, None)
+            if collapsed is not None and collapsed.match(mqtt_topic):
+                logger.debug('Dropping unmapped topic "{}"'.format(
+                    display_topic(topic)))
+            else:
+                self.warn('Received unknown topic "{}"'.format(
+                    display_topic(topic)))
+
+        # remember the result, so the next message is dispatched (or dropped)
+        # with a single lookup
+        if len(dispatch.topics) < dispatch.size + MATCH_CACHE_SIZE:
+            dispatch.topics[topic] = routes
+
+        return routes
+
+    def _compile_dispatch(self):
+        """
+        Compile the dispatch table from the routes of all accessories and
+        return it. The table is replaced at once, so messages dispatched
+        concurrently use either the old or the new table.
+        """
+        all_routes = self.routes
+
+        # wildcards only match the topics of their broker
+        wildcards = {}
+        for topic, routes in all_routes.items():
+            if has_wildcards(topic):
+                broker, mqtt_topic = split_topic(topic)
+                wildcards.setdefault(broker, TopicTrie()).insert(
+                    mqtt_topic, routes)
+
+        topics = {}
+        for topic, routes in all_routes.items():
+            if has_wildcards(topic):
+                continue
+
+            broker, mqtt_topic = split_topic(topic)
+            if broker in wildcards:
+                routes = list(routes)
+                for matched in wildcards[broker].match(mqtt_topic):
+                    routes.extend(matched)
+            topics[topic] = tuple(routes)
+
+        dispatch = DispatchTable(all_routes, topics, len(topics),
+                                 wildcards if wildcards else None)
+        self.dispatch = dispatch
+
+        # let adapters drop cached states of removed devices
+        for adapter in self.adapters:
+            if capabilities(adapter).prune:
+                adapter.prune(self.known_topics)
+
+        return dispatch
+
+    def get_subscriptions(self, broker=DEFAULT_BROKER):
+        """
+        Return the topic filters to subscribe to at a broker as a list of
+        (topic, qos) tuples. Literal topics are collapsed into wildcard
+        filters if possible.
+
+        :param broker: the name of the broker
+        :type broker: str
+        """
+        default_qos = self.brokers[broker].default_qos
+        qos_of = {}
+        for topic in self.routes:
+            name, mqtt_topic = split_topic(topic)
+            if name == broker:
+                qos_of[mqtt_topic] = self.qos.get(topic, default_qos)
+
+        topics = collapse(qos_of.keys(), self.collapse_threshold)
+
+        subscriptions = []
+        collapsed = TopicTrie()
+        for topic in topics:
+            qos = qos_of.get(topic, default_qos)
+            if has_wildcards(topic):
+                # wildcards replace all topics they cover
+                qos = max([qos] + [q for t, q in qos_of.items()
+                                   if covers(topic, t)])
+            if topic not in qos_of:
+                collapsed.insert(topic, topic)
+            subscriptions.append((topic, qos))
+
+        self.collapsed[broker] = collapsed
+        return subscriptions
+
+    def _count_subscriptions(self):
+        self.stats['subscriptions'] = sum(
+            len(broker.subscribed) for broker in self.brokers.values())
+
+    def _subscribe(self, broker, subscriptions):
+        """
+        Subscribe in chunks of 'SubscribeChunkSize' topics and return the
+        message ids of the SUBSCRIBE packets
+
+        :param broker: the broker
+        :type broker: homekit_mqtt.brokers.Broker
+
+        :param subscriptions: the topic filters and their QoS
+        :type subscriptions: list of (str, int)
+        """
+        mids = []
+        chunk_size = max(1, self.subscribe_chunk_size)
+        for i in range(0, len(subscriptions), chunk_size):
+            result, mid = broker.client.subscribe(
+                subscriptions[i:i + chunk_size])
+            if result == mqtt.MQTT_ERR_SUCCESS:
+                mids.append(mid)
+        return mids
+
+    def update_subscriptions(self):
+        """
+        Subscribe to new topic filters and unsubscribe from removed ones after
+        accessories were added, removed or remapped
+        """
+        for broker in self.brokers.values():
+            with broker.subscribe_lock:
+                subscriptions = self.get_subscriptions(broker.name)
+                subscribed = dict(subscriptions)
+                removed = [topic for topic in broker.subscribed
+                           if topic not in subscribed]
+                added = [(topic, qos) for topic, qos in subscriptions
+                         if broker.subscribed.get(topic, None) != qos]
+                broker.subscribed = subscribed
+                self._count_subscriptions()
+
+                # everything is subscribed on connect
+                if not broker.client.is_connected():
+                    continue
+
+                if removed:
+                    broker.client.unsubscribe(removed)
+                if added:
+                    self._subscribe(broker, added)
+
+                if removed or added:
+                    logger.info('Subscribed to {} and unsubscribed from {} '
+                                'topics of {}'.format(len(added), len(removed),
+                                                      broker.name))
 
     def get_adapter(self, name):
         """
         Gets an adapter class by its name. The adapter has to be imported to
-        adapters.py
+        adapters.py or provided by an installed plugin (see
+        registry.AdapterRegistry)
 
         :param name: name of the adapter
         :type name: str
@@ -219,16 +841,9 @@ class MqttBridge(Bridge):
         if name is None:
             return None
 
-        name = name.split('.')
-        adap = adapters
-
-        try:
-            for part in name:
-                adap = getattr(adap, part)
-
-        except AttributeError as e:
+        adap = self.registry.resolve(name)
+        if adap is None:
             self.warn('Unknown adapter "{}"'.format(name))
-            return None
 
         return adap
 
@@ -236,81 +851,401 @@ class MqttBridge(Bridge):
         """
         Add a new accessory to this MqttBridge
 
+        :param acc: the accessory
+        :type acc: pyhap.accessory.Accessory
+        """
+        self._add_routes(acc)
+        super().add_accessory(acc)
+
+    def remove_accessory(self, acc):
+        """
+        Remove an accessory from this MqttBridge. Call commit_changes()
+        afterwards to update the dispatch table and the subscriptions.
+
+        :param acc: the accessory
+        :type acc: pyhap.accessory.Accessory
+        """
+        self._remove_routes(acc)
+        del self.accessories[acc.aid]
+
+    def remap_accessory(self, acc, new_acc):
+        """
+        Take over the topics, adapters and options of the characteristics of
+        new_acc, which must have the same services and characteristics as
+        acc. Call commit_changes() afterwards to update the dispatch table and
+        the subscriptions.
+
+        :param acc: the accessory of this MqttBridge
+        :type acc: pyhap.accessory.Accessory
+
+        :param new_acc: the accessory with the new configuration
+        :type new_acc: pyhap.accessory.Accessory
+        """
+        self._remove_routes(acc)
+        for serv, new_serv in zip(acc.services, new_acc.services):
+            for char, new_char in zip(serv.characteristics,
+                                      new_serv.characteristics):
+                for key in ('topic_in', 'topic_out', 'adapter', 'options'):
+                    if key in new_char.properties:
+                        char.properties[key] = new_char.properties[key]
+                    else:
+                        char.properties.pop(key, None)
+        for key in ('poll_topic', 'poll_payload', 'poll_interval',
+                    'mqtt_broker'):
+            setattr(acc, key, getattr(new_acc, key, None))
+        self._add_routes(acc)
+
+    def commit_changes(self):
+        """
+        Compile the dispatch table and update the subscriptions after
+        accessories were added, removed or remapped at runtime
+        """
+        self._compile_dispatch()
+        self.update_subscriptions()
+
+    def _remove_routes(self, acc):
+        """
+        Remove the routes and setter callbacks of an accessory
+
+        :param acc: the accessory
+        :type acc: pyhap.accessory.Accessory
+        """
+        self.poller.remove(acc)
+
+        chars = set()
+        removed = []
+        for serv in acc.services:
+            for char in serv.characteristics:
+                chars.add(id(char))
+                removed.append(char)
+                # restore the callbacks wrapped by the bridge
+                callback = char.setter_callback
+                if hasattr(callback, 'wrapped'):
+                    char.setter_callback = callback.wrapped
+                callback = char.getter_callback
+                if hasattr(callback, 'wrapped'):
+                    char.getter_callback = callback.wrapped
+
+        # replace the routes at once, messages are dispatched concurrently
+        routes = {}
+        for topic, topic_routes in self.routes.items():
+            topic_routes = tuple(route for route in topic_routes
+                                 if id(route.char) not in chars)
+            if topic_routes:
+                routes[topic] = topic_routes
+
+        self.qos = {topic: max(route.qos for route in topic_routes)
+                    for topic, topic_routes in routes.items()}
+        self.routes = routes
+
+        # forget the values and adapters only the accessory used
+        self.seen.difference_update(removed)
+        acc_adapters = dict(self.acc_adapters)
+        acc_adapters.pop(acc, None)
+        self.acc_adapters = acc_adapters
+        self.adapters = set().union(*acc_adapters.values())
+
+        known_topics = set(routes)
+        for other in self.accessories.values():
+            if other is acc:
+                continue
+            for serv in other.services:
+                for char in serv.characteristics:
+                    topic_out = char.properties.get('topic_out', None)
+                    if topic_out is not None:
+                        known_topics.add(broker_topic(
+                            self._broker_of(other, char), topic_out))
+        self.known_topics = known_topics
+
+    @staticmethod
+    def _broker_of(acc, char):
+        """
+        Return the name of the broker of a characteristic: its option
+        'broker', the broker of its accessory or the default broker
+        """
+        options = char.properties.get('options', None) or {}
+        broker = options.get('broker', None)
+        if broker is None:
+            broker = getattr(acc, 'mqtt_broker', None)
+        return broker or DEFAULT_BROKER
+
+    def _add_routes(self, acc):
+        """
+        Add the routes and setter callbacks of an accessory
+
         :param acc: the accessory
         :type acc: pyhap.accessory.Accessory
         """
         def build_setter_callback(old_callback, topic, adapter, hap_format):
+            converter = hap2var_converter(hap_format)
+            broker, mqtt_topic = split_topic(topic)
+
             def setter_callback(value):
                 # Call old callback
                 if old_callback is not None:
                     old_callback(value)
 
-                value = hap2var(hap_format, value)
+                value = converter(value)
 
                 # all adapter
                 if adapter is not None:
+                    set_current_broker(broker)
                     try:
-                        value = adapter.output(topic, value)
+                        value = adapter.output(mqtt_topic, value)
                     except Exception as e:
                         self.warn('Exception in {}.output(): {}'.format(
-                            adapter.__name__, e))
+                            adapter.__name__, e),
+                            key='output:' + adapter.__name__)
+                    finally:
+                        set_current_broker(DEFAULT_BROKER)
 
                 if value is not None:
                     # publish value
-                    self.client.publish(topic, value)
+                    self.publisher.publish(topic, value)
 
+            setter_callback.wrapped = old_callback
             return setter_callback
 
-        def build_getter_callback(old_callback, topic, adapter, hap_format,
-                                  char):
-            def getter_callback(payload):
-                # Call old callback
+        def build_getter_callback(old_callback, char, poll):
+            def getter_callback():
+                # poll stale values, the answer is sent as an event
+                self.poller.request(poll)
                 if old_callback is not None:
-                    old_callback(payload)
+                    return old_callback()
+                return char.value
 
-                # all adapter
-                if adapter is not None:
-                    try:
-                        payload = adapter.input(topic, payload.decode('utf-8'))
-                    except Exception as e:
-                        self.warn('Exception in {}.input(): {}'.format(
-                            adapter.__name__, e))
+            getter_callback.wrapped = old_callback
+            return getter_callback
 
-                if payload is not None:
-                    payload = mqtt2hap(hap_format, payload)
-                    char.set_value(payload)
+        # copies replacing the originals at once, messages are dispatched
+        # concurrently
+        routes = dict(self.routes)
+        qos_of = dict(self.qos)
+        adapters = set()
+        known_topics = set(self.known_topics)
 
-            return getter_callback
+        poll = None
+        poll_topic = getattr(acc, 'poll_topic', None)
+        broker = getattr(acc, 'mqtt_broker', None) or DEFAULT_BROKER
+        if poll_topic is not None and broker in self.brokers:
+            poll = self.poller.add(acc, broker_topic(broker, poll_topic),
+                                   acc.poll_payload, acc.poll_interval)
 
         # Add callbacks to characteristics
         for serv in acc.services:
             for char in serv.characteristics:
-                adapter = self.get_adapter(
-                    char.properties.get('adapter', None))
+                broker = self._broker_of(acc, char)
+                if broker not in self.brokers:
+                    self.warn('Unknown broker "{}" of {}'.format(
+                        broker, char.display_name))
+                    continue
+                default_qos = self.brokers[broker].default_qos
+
+                options = char.properties.get('options', {})
+                adapter = char.properties.get('adapter', None)
+                if adapter == json_path.ADAPTER:
+                    try:
+                        adapter = json_path.compile_adapter(options)
+                    except ValueError as e:
+                        self.warn('Invalid options of {}: {}'.format(
+                            char.display_name, e))
+                        continue
+                else:
+                    adapter = self.get_adapter(adapter)
                 hap_format = char.properties[pyhap_char.PROP_FORMAT]
+                caps = capabilities(adapter)
+                if adapter is not None:
+                    adapters.add(adapter)
+                    if self.metrics is not None:
+                        adapter = self.metrics.wrap_adapter(adapter)
 
                 # setter callback
-                topic_out = char.properties.get('topic_out', None)
+                topic_out = broker_topic(
+                    broker, char.properties.get('topic_out', None))
                 if topic_out is not None:
+                    known_topics.add(topic_out)
                     char.setter_callback = build_setter_callback(
                         char.setter_callback, topic_out, adapter, hap_format)
 
-                # getter callback
-                topic_in = char.properties.get('topic_in', None)
+                # route for incoming messages
+                topic_in = broker_topic(
+                    broker, char.properties.get('topic_in', None))
                 if topic_in is not None:
-                    self.getter_callbacks[topic_in] = build_getter_callback(
-                        self.getter_callbacks.get(topic_in, None),
-                        topic_in, adapter, hap_format, char)
+                    known_topics.add(topic_in)
+                    if poll is not None:
+                        char.getter_callback = build_getter_callback(
+                            char.getter_callback, char, poll)
+                    qos = int(options.get('qos', default_qos))
+                    qos_of[topic_in] = max(
+                        qos_of.get(topic_in, default_qos), qos)
+                    routes[topic_in] = routes.get(topic_in, ()) + (Route(
+                        char, adapter, hap_format,
+                        mqtt2hap_converter(hap_format),
+                        caps.json_input,
+                        NotifyPolicy.from_options(
+                            char, self.timers, self.stats, options),
+                        qos, poll,
+                        caps.batch_input and self.batcher is not None),)
+
+        acc_adapters = dict(self.acc_adapters)
+        acc_adapters[acc] = adapters
+        self.acc_adapters = acc_adapters
+        self.adapters = set().union(*acc_adapters.values())
+        self.known_topics = known_topics
+        self.qos = qos_of
+        self.routes = routes
+
+    def _publish(self, topic, value):
+        """
+        Publish a message and return if it was queued by the client
 
-        super().add_accessory(acc)
+        :param topic: the topic
+        :type topic: str
+
+        :param value: the payload
+        :type value: object
+        """
+        broker, topic = split_topic(topic)
+        info = self.brokers[broker].client.publish(topic, value,
+                                                   self.publish_qos)
+        return info.rc == mqtt.MQTT_ERR_SUCCESS
+
+    def _snapshot_key(self, char):
+        acc = char.broker
+        return '{}.{}'.format(acc.aid, acc.iid_manager.get_iid(char))
+
+    def restore_values(self):
+        """
+        Set the characteristics to the values of the snapshot without
+        notifying HomeKit. Call it after all accessories were added.
+        """
+        if self.snapshot is None:
+            return
+
+        values = self.snapshot.load()
+        restored = 0
+        for topic, routes in self.routes.items():
+            for route in routes:
+                entry = values.get(self._snapshot_key(route.char), None)
+                if entry is None or entry[0] != topic:
+                    continue
+
+                try:
+                    route.char.set_value(entry[1], should_notify=False)
+                except ValueError:
+                    continue
+                self.seen.add(route.char)
+                restored += 1
+
+        # the snapshot is up to date
+        self.saved_values = values
+        logger.info('Restored {} values'.format(restored))
+
+    def save_values(self):
+        """
+        Save the values of all characteristics which received a value, if
+        any of them changed since the last save
+        """
+        if self.snapshot is None:
+            return
+
+        values = {}
+        for topic, routes in self.routes.items():
+            for route in routes:
+                if route.char in self.seen and route.char.broker is not None:
+                    values[self._snapshot_key(route.char)] = \
+                        (topic, route.char.value)
+
+        if values != self.saved_values:
+            self.snapshot.save(values)
+            self.saved_values = values
+
+    def _save_values_periodically(self):
+        try:
+            self.save_values()
+        except Exception as e:
+            self.warn('Cannot save the values: {}'.format(e))
+        finally:
+            if not self.stopped.is_set():
+                self.timers.call_later(self.snapshot_interval,
+                                       self._save_values_periodically)
+
+    def resync(self, broker=None):
+        """
+        Forget the values delivered to HomeKit, so the retained messages
+        received after (re)subscribing are delivered in any case
+
+        :param broker: only forget the values of this broker, of all brokers
+            by default
+        :type broker: str
+        """
+        for topic, routes in self.routes.items():
+            if broker is not None and split_topic(topic)[0] != broker:
+                continue
+            for route in routes:
+                if route.notify is not None:
+                    route.notify.reset()
+
+    def connect(self):
+        """
+        Connect to the MQTT Brokers in the background. Failed attempts are
+        retried with exponential backoff, so HomeKit is not held up by an
+        unreachable broker.
+        """
+        for broker in self.brokers.values():
+            if broker.aio is not None:
+                broker.aio.connect(broker.addr[0], broker.addr[1])
+                continue
+
+            thread = threading.Thread(
+                target=self._connect_loop, args=(broker,), daemon=True,
+                name='mqtt-connect' + broker.thread_suffix)
+            thread.start()
+
+    def _connect_loop(self, broker):
+        while not self.stopped.is_set():
+            try:
+                broker.client.connect(broker.addr[0], broker.addr[1])
+            except (OSError, ValueError) as e:
+                delay = broker.backoff.next()
+                logger.info('Connecting to MQTT Broker {} failed: {}, '
+                            'retrying in {:.1f}s'.format(
+                                broker.name, e, delay))
+                self.stopped.wait(delay)
+                continue
+
+            broker.backoff.reset()
+            if self.stopped.is_set():
+                broker.client.disconnect()
+                return
+
+            logger.info('Starting MQTT Client Loop of {}.'.format(
+                broker.name))
+            broker.client.loop_start()
+            return
 
     def run(self):
         """
         Start the MQTT Client Loop
         """
+        ready = time.monotonic() - self.created
+        self.stats['hap_ready_seconds'] = ready
+        logger.info('HomeKit ready after {:.3f}s'.format(ready))
+
+        self._compile_dispatch()
         super().run()
-        logger.info("Starting MQTT Client Loop.")
-        self.client.loop_start()
+        if self.metrics is not None:
+            try:
+                self.metrics.serve(self.metrics_port, self.metrics_host)
+            except OSError as e:
+                self.warn('Cannot serve metrics on port {}: {}'.format(
+                    self.metrics_port, e))
+        self.connect()
+        self.poller.start()
+
+        if self.snapshot is not None:
+            self.timers.call_later(self.snapshot_interval,
+                                   self._save_values_periodically)
 
     def stop(self):
         """
@@ -318,15 +1253,32 @@ class MqttBridge(Bridge):
         """
         super().stop()
 
-        logger.info("Stopping MQTT Client Loop.")
-        self.client.loop_stop()
-
-    def warn(self, warning):
+        self.stopped.set()
+        self.poller.stop()
+        for broker in self.brokers.values():
+            if broker.inbound is not None:
+                broker.inbound.stop()
+            if broker.aio is None:
+                logger.info('Stopping MQTT Client Loop of {}.'.format(
+                    broker.name))
+                broker.client.loop_stop()
+            else:
+                broker.aio.stop()
+                broker.client.disconnect()
+        self.timers.stop()
+        if self.metrics is not None:
+            self.metrics.stop()
+        self.save_values()
+
+    def warn(self, warning, key=None):
         """
         Helper class to log warnings to the logger and MQTT
 
         :param warning: the warning
         :type warning: str
+
+        :param key: repeated warnings with the same key are aggregated, the
+            warning itself by default
+        :type key: str
         """
-        logger.warn(warning)
-        self.client.publish('stat/homekit/log', str(warning))
+        self.log_channel.warn(warning, key)
@@ -0,0 +1,145 @@
+import threading
+import time
+
+_UNSET = object()
+
+
+class NotifyPolicy:
+    """
+    Decides which values received for a characteristic are sent to the
+    HomeKit controllers. Configured with options of the characteristic:
+
+    dedup=1       drop values equal to the last delivered value
+    deadband=0.5  drop values closer than 0.5 to the last delivered value
+    interval=10   deliver at most one value per 10 seconds. Values received in
+                  between replace each other and the latest one is delivered
+                  at the end of the interval.
+    """
+
+    def __init__(self, char, timers, stats, dedup=False, deadband=None,
+                 interval=0.0):
+        """
+        Init
+
+        :param char: the characteristic
+        :type char: pyhap.characteristic.Characteristic
+
+        :param timers: timers used to deliver the trailing value
+        :type timers: homekit_mqtt.timers.Timers
+
+        :param stats: dict with the counters 'notify_delivered' and
+            'notify_suppressed'
+        :type stats: dict
+        """
+        self.char = char
+        self.timers = timers
+        self.stats = stats
+        self.dedup = dedup or deadband is not None
+        self.deadband = deadband
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.last = _UNSET
+        self.pending = _UNSET
+        self.timer = None
+        self.next_time = 0.0
+
+        self.delivered = 0
+        self.suppressed = 0
+
+    @classmethod
+    def from_options(cls, char, timers, stats, options):
+        """
+        Create a policy from the options of a characteristic or return None
+        if there are no notification options.
+
+        :param options: the options of the characteristic
+        :type options: dict
+        """
+        if not any(key in options for key in ('dedup', 'deadband',
+                                              'interval')):
+            return None
+
+        deadband = options.get('deadband', None)
+        if deadband is not None:
+            deadband = float(deadband)
+
+        return cls(char, timers, stats,
+                   dedup=options.get('dedup', '0').lower() in ('1', 'true'),
+                   deadband=deadband,
+                   interval=float(options.get('interval', 0)))
+
+    def _same(self, value):
+        if self.last is _UNSET:
+            return False
+        if self.deadband is not None and \
+                isinstance(value, (int, float)) and \
+                isinstance(self.last, (int, float)):
+            return abs(value - self.last) < self.deadband or \
+                value == self.last
+        return value == self.last
+
+    def _suppress(self):
+        self.suppressed += 1
+        self.stats['notify_suppressed'] = \
+            self.stats.get('notify_suppressed', 0) + 1
+
+    def _deliver(self, value):
+        self.char.set_value(value)
+        self.last = value
+        self.delivered += 1
+        self.stats['notify_delivered'] = \
+            self.stats.get('notify_delivered', 0) + 1
+
+    def offer(self, value):
+        """
+        Set the value of the characteristic according to this policy
+
+        :param value: the HAP value
+        :type value: object
+        """
+        with self.lock:
+            if self.dedup and self._same(value):
+                if self.pending is not _UNSET:
+                    # the newer value reverts the pending one
+                    self.pending = _UNSET
+                    self._suppress()
+                self._suppress()
+                return
+
+            if self.interval > 0:
+                now = time.monotonic()
+                if now < self.next_time:
+                    if self.pending is not _UNSET:
+                        self._suppress()
+                    self.pending = value
+                    if self.timer is None:
+                        self.timer = self.timers.call_later(
+                            self.next_time - now, self.flush)
+                    return
+
+                self.next_time = now + self.interval
+
+            self._deliver(value)
+
+    def flush(self):
+        """
+        Deliver the pending value at the end of the interval
+        """
+        with self.lock:
+            self.timer = None
+            if self.pending is _UNSET:
+                return
+
+            value = self.pending
+            self.pending = _UNSET
+            self.next_time = time.monotonic() + self.interval
+            self._deliver(value)
+
+    def reset(self):
+        """
+        Forget the last delivered value, so the next one is always delivered
+        """
+        with self.lock:
+            self.last = _UNSET
+            self.next_time = 0.0
@@ -0,0 +1,254 @@
+import logging
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel with a resolution of one tick. Scheduling and
+    expiring an item is O(1), independent of the number of items.
+    """
+
+    def __init__(self, tick=1.0, size=512):
+        """
+        Init
+
+        :param tick: the duration of a tick in seconds
+        :type tick: float
+
+        :param size: the number of slots
+        :type size: int
+        """
+        self.tick = tick
+        self.slots = [[] for _ in range(size)]
+        self.current = 0
+
+    def schedule(self, delay, item):
+        """
+        Expire item after delay seconds, rounded up to the next tick
+
+        :param delay: the delay in seconds
+        :type delay: float
+
+        :param item: the item
+        :type item: object
+        """
+        ticks = max(1, int(-(-delay // self.tick)))
+        slot = (self.current + ticks) % len(self.slots)
+        rounds = (ticks - 1) // len(self.slots)
+        self.slots[slot].append([rounds, item])
+
+    def advance(self):
+        """
+        Move to the next tick and return the expired items
+        """
+        self.current = (self.current + 1) % len(self.slots)
+        slot = self.slots[self.current]
+
+        expired = []
+        pending = []
+        for entry in slot:
+            if entry[0] > 0:
+                entry[0] -= 1
+                pending.append(entry)
+            else:
+                expired.append(entry[1])
+        self.slots[self.current] = pending
+        return expired
+
+
+class PollEntry:
+    """
+    A device polled by publishing payload to topic every interval seconds
+    """
+    __slots__ = ('topic', 'payload', 'interval', 'last_value', 'last_poll',
+                 'removed')
+
+    def __init__(self, topic, payload, interval):
+        self.topic = topic
+        self.payload = payload
+        self.interval = interval
+        self.last_value = float('-inf')
+        self.last_poll = float('-inf')
+        self.removed = False
+
+    def touch(self):
+        """
+        Note that a value of the device was received
+        """
+        self.last_value = time.monotonic()
+
+
+class Poller:
+    """
+    Polls devices which only report their state when asked.
+
+    All devices share one timer wheel driven by a single timer, which only
+    runs while devices are polled. The first poll
+    of each device is staggered within its interval by a hash of its topic
+    and at most 'rate' polls are sent per second, the others are delayed to
+    the next tick. A poll is skipped if the device sent a value within the
+    last half interval or if it was polled less than 'timeout' seconds ago.
+    """
+
+    def __init__(self, send, timers, stats, rate=20.0, timeout=5.0,
+                 tick=1.0):
+        """
+        Init
+
+        :param send: function send(topic, payload) publishing a poll
+        :type send: callable
+
+        :param timers: timers driving the timer wheel
+        :type timers: homekit_mqtt.timers.Timers
+
+        :param stats: dict with the counters 'polls_sent' and 'polls_skipped'
+        :type stats: dict
+
+        :param rate: maximum number of polls per second
+        :type rate: float
+
+        :param timeout: seconds to wait for the answer to a poll before
+            polling again
+        :type timeout: float
+
+        :param tick: the resolution of the scheduler in seconds
+        :type tick: float
+        """
+        self.send = send
+        self.timers = timers
+        self.stats = stats
+        self.rate = rate
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.wheel = TimerWheel(tick)
+        self.entries = {}
+        self.running = False
+        # the next tick is scheduled
+        self.armed = False
+
+    def _count(self, key):
+        self.stats[key] = self.stats.get(key, 0) + 1
+
+    def _arm(self):
+        # schedule the next tick while running with devices, needs the lock
+        if self.running and self.entries and not self.armed:
+            self.armed = True
+            self.timers.call_later(self.wheel.tick, self._tick)
+
+    def add(self, key, topic, payload, interval):
+        """
+        Add a device and return its PollEntry
+
+        :param key: the key of the device, e.g. its accessory
+        :type key: object
+
+        :param topic: the topic of the poll
+        :type topic: str
+
+        :param payload: the payload of the poll
+        :type payload: str
+
+        :param interval: seconds between two polls
+        :type interval: float
+        """
+        entry = PollEntry(topic, payload, interval)
+        offset = zlib.crc32(topic.encode('utf-8')) % max(1, int(interval))
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                old.removed = True
+            self.entries[key] = entry
+            self.wheel.schedule(offset, entry)
+            self._arm()
+        return entry
+
+    def remove(self, key):
+        """
+        Stop polling a device
+
+        :param key: the key of the device
+        :type key: object
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                entry.removed = True
+
+    def start(self):
+        """
+        Start polling
+        """
+        with self.lock:
+            self.running = True
+            self._arm()
+
+    def stop(self):
+        """
+        Stop polling
+        """
+        with self.lock:
+            self.running = False
+
+    def request(self, entry):
+        """
+        Poll a device now, unless it is fresh or a poll is in flight. Used
+        when a HomeKit controller reads a characteristic of the device.
+
+        :param entry: the device
+        :type entry: PollEntry
+        """
+        now = time.monotonic()
+        with self.lock:
+            if now - entry.last_value < entry.interval or \
+                    now - entry.last_poll < self.timeout:
+                return
+            entry.last_poll = now
+
+        self.send(entry.topic, entry.payload)
+        self._count('polls_sent')
+
+    def _tick(self):
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            self.armed = False
+            if not self.running or not self.entries:
+                return
+
+            budget = max(1, int(self.rate * self.wheel.tick))
+            for entry in self.wheel.advance():
+                if entry.removed:
+                    continue
+
+                if now - entry.last_value < entry.interval / 2:
+                    # the device reported by itself
+                    self._count('polls_skipped')
+                    self.wheel.schedule(
+                        entry.last_value + entry.interval - now, entry)
+                elif now - entry.last_poll < self.timeout:
+                    # a poll is in flight
+                    self._count('polls_skipped')
+                    self.wheel.schedule(
+                        entry.last_poll + entry.interval - now, entry)
+                elif budget > 0:
+                    budget -= 1
+                    entry.last_poll = now
+                    due.append(entry)
+                    self.wheel.schedule(entry.interval, entry)
+                else:
+                    # over the rate, try again with the next tick
+                    self.wheel.schedule(self.wheel.tick, entry)
+
+            self._arm()
+
+        for entry in due:
+            try:
+                self.send(entry.topic, entry.payload)
+                self._count('polls_sent')
+            except Exception as e:
+                logger.warn('Polling "{}" failed: {}'.format(entry.topic, e))
@@ -0,0 +1,155 @@
+import logging
+import threading
+import time
+
+from homekit_mqtt.backoff import Backoff
+
+logger = logging.getLogger(__name__)
+
+_UNSET = object()
+
+
+class _Topic:
+    __slots__ = ('next_time', 'pending', 'timer', 'sending', 'backoff')
+
+    def __init__(self, backoff):
+        self.next_time = 0.0
+        self.pending = _UNSET
+        self.timer = None
+        # a value is being sent without holding the lock
+        self.sending = False
+        self.backoff = backoff
+
+
+class PublishQueue:
+    """
+    Debounces outgoing messages per topic.
+
+    The first message of a topic is sent right away. Messages following
+    within the window replace each other and only the latest one is sent at
+    the end of the window. If sending fails, the value is kept and sent again
+    with an exponential backoff, so the final value is never lost.
+
+    Messages are sent without holding the lock, so a stalled broker only
+    blocks the thread sending to it.
+    """
+
+    def __init__(self, send, timers, stats, window=0.1, retry_max=30.0):
+        """
+        Init
+
+        :param send: function send(topic, value) publishing a message and
+            returning True on success
+        :type send: callable
+
+        :param timers: timers used to send the trailing value
+        :type timers: homekit_mqtt.timers.Timers
+
+        :param stats: dict with the counters 'publish_sent' and
+            'publish_coalesced'
+        :type stats: dict
+
+        :param window: the debounce window in seconds, 0 to disable
+        :type window: float
+
+        :param retry_max: the maximum delay between two retries in seconds
+        :type retry_max: float
+        """
+        self.send = send
+        self.timers = timers
+        self.stats = stats
+        self.window = window
+        self.retry_max = retry_max
+
+        self.lock = threading.Lock()
+        self.topics = {}
+
+    def _count(self, key):
+        self.stats[key] = self.stats.get(key, 0) + 1
+
+    def _send(self, topic, value):
+        if self.send(topic, value):
+            self._count('publish_sent')
+            return True
+        return False
+
+    def publish(self, topic, value):
+        """
+        Publish a value to a topic
+
+        :param topic: the topic
+        :type topic: str
+
+        :param value: the payload
+        :type value: object
+        """
+        if self.window <= 0:
+            self._send(topic, value)
+            return
+
+        with self.lock:
+            state = self.topics.get(topic, None)
+            if state is None:
+                state = self.topics[topic] = _Topic(
+                    Backoff(self.window, max(self.window, self.retry_max)))
+
+            now = time.monotonic()
+            if now < state.next_time or state.pending is not _UNSET or \
+                    state.sending:
+                if state.pending is not _UNSET:
+                    self._count('publish_coalesced')
+                state.pending = value
+
+                if state.timer is None:
+                    state.timer = self.timers.call_later(
+                        max(0.0, state.next_time - now), self.flush, topic)
+                return
+
+            state.next_time = now + self.window
+            state.sending = True
+
+        self._finish(topic, state, value, self._send(topic, value))
+
+    def flush(self, topic):
+        """
+        Send the pending value of a topic at the end of its window
+
+        :param topic: the topic
+        :type topic: str
+        """
+        with self.lock:
+            state = self.topics[topic]
+            state.timer = None
+            if state.pending is _UNSET:
+                return
+            if state.sending:
+                # sent again when the running send finished
+                return
+
+            value = state.pending
+            state.pending = _UNSET
+            state.next_time = time.monotonic() + self.window
+            state.sending = True
+
+        self._finish(topic, state, value, self._send(topic, value))
+
+    def _finish(self, topic, state, value, sent):
+        """
+        Keep a value which could not be sent and schedule the pending value
+        """
+        with self.lock:
+            state.sending = False
+            if sent:
+                state.backoff.reset()
+                delay = max(0.0, state.next_time - time.monotonic())
+            else:
+                # newer values replace the one which could not be sent
+                if state.pending is _UNSET:
+                    state.pending = value
+                delay = state.backoff.next()
+                state.next_time = time.monotonic() + delay
+                logger.debug('Retrying to publish to "{}" in {:.1f}s'.format(
+                    topic, delay))
+
+            if state.pending is not _UNSET and state.timer is None:
+                state.timer = self.timers.call_later(delay, self.flush, topic)
@@ -0,0 +1,160 @@
+import collections
+import logging
+import threading
+
+from homekit_mqtt import adapters
+
+logger = logging.getLogger(__name__)
+
+# entry point group of third-party adapters
+ENTRY_POINT_GROUP = 'homekit_mqtt.adapters'
+
+# what the MqttBridge may rely on when calling an adapter
+Capabilities = collections.namedtuple(
+    'Capabilities', ['json_input', 'batch_input', 'prune'])
+
+
+def iter_entry_points(group):
+    """
+    Return (name, load) of all entry points of a group without importing
+    them
+
+    :param group: the entry point group
+    :type group: str
+    """
+    try:
+        from importlib import metadata
+    except ImportError:
+        metadata = None
+
+    if metadata is not None:
+        eps = metadata.entry_points()
+        if hasattr(eps, 'select'):
+            eps = eps.select(group=group)
+        else:
+            eps = eps.get(group, [])
+        return [(ep.name, ep.load) for ep in eps]
+
+    try:
+        import pkg_resources
+    except ImportError:
+        return []
+    return [(ep.name, ep.load)
+            for ep in pkg_resources.iter_entry_points(group)]
+
+
+def capabilities(adapter):
+    """
+    Return the Capabilities of an adapter
+
+    :param adapter: the adapter class
+    :type adapter: type
+    """
+    return Capabilities(
+        bool(getattr(adapter, 'json_input', False)),
+        callable(getattr(adapter, 'input_batch', None)),
+        callable(getattr(adapter, 'prune', None)))
+
+
+class AdapterRegistry:
+    """
+    Resolves adapter names like 'tasmota.POWER' to adapter classes.
+
+    Names are looked up in the module 'adapters' first and then in the entry
+    points of the group 'homekit_mqtt.adapters' of installed packages. The
+    first part of the name selects the entry point, the rest is looked up in
+    the loaded object, e.g. the entry point
+
+        zigbee2mqtt = z2m_homekit.adapters
+
+    provides 'zigbee2mqtt.Occupancy'. Entry points are only listed when a
+    name is not found in 'adapters' and only loaded when one of their names
+    is used. Resolved names are cached.
+    """
+
+    def __init__(self, group=ENTRY_POINT_GROUP, module=adapters):
+        """
+        Init
+
+        :param group: the entry point group
+        :type group: str
+
+        :param module: the module with the built-in adapters
+        :type module: module
+        """
+        self.group = group
+        self.module = module
+
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.entry_points = None
+        self.loaded = {}
+
+    @staticmethod
+    def _lookup(obj, parts):
+        try:
+            for part in parts:
+                obj = getattr(obj, part)
+        except AttributeError:
+            return None
+        return obj
+
+    def _entry_point(self, name):
+        """
+        Return the loaded object of an entry point or None
+        """
+        if name in self.loaded:
+            return self.loaded[name]
+
+        if self.entry_points is None:
+            self.entry_points = {}
+            try:
+                for ep_name, load in iter_entry_points(self.group):
+                    self.entry_points.setdefault(ep_name, load)
+            except Exception as e:
+                logger.warn('Cannot list adapter plugins: {}'.format(e))
+
+        obj = None
+        load = self.entry_points.get(name, None)
+        if load is not None:
+            try:
+                obj = load()
+                logger.info('Loaded adapter plugin "{}"'.format(name))
+            except Exception as e:
+                logger.warn('Cannot load adapter plugin "{}": {}'.format(
+                    name, e))
+        self.loaded[name] = obj
+        return obj
+
+    def resolve(self, name):
+        """
+        Return the adapter class of a name or None if it is unknown
+
+        :param name: the name of the adapter
+        :type name: str
+        """
+        try:
+            return self.cache[name]
+        except KeyError:
+            pass
+
+        with self.lock:
+            parts = name.split('.')
+            adapter = self._lookup(self.module, parts)
+            if adapter is None:
+                obj = self._entry_point(parts[0])
+                if obj is not None:
+                    adapter = self._lookup(obj, parts[1:])
+
+            # only classes with input() and output() are adapters
+            if adapter is not None and not (
+                    callable(getattr(adapter, 'input', None)) and
+                    callable(getattr(adapter, 'output', None))):
+                adapter = None
+
+            self.cache[name] = adapter
+            return adapter
+
+
+# the registry used by all bridges
+default_registry = AdapterRegistry()
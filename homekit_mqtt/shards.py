@@ -0,0 +1,171 @@
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+import zlib
+
+from homekit_mqtt.backoff import Backoff
+
+logger = logging.getLogger(__name__)
+
+# HomeKit accepts at most 150 accessories per bridge, including the bridge
+MAX_ACCESSORIES = 149
+
+# a shard running this long is considered healthy again
+HEALTHY_SECONDS = 60
+
+
+def shard_of(fname, cfg_path, shards):
+    """
+    Return the shard of an accessory config file. The shard only depends on
+    the path of the file relative to the config directory, so it is stable
+    across restarts and independent of other files.
+
+    :param fname: the config file
+    :type fname: str
+
+    :param cfg_path: the config directory
+    :type cfg_path: str
+
+    :param shards: the number of shards
+    :type shards: int
+    """
+    rel = os.path.relpath(fname, cfg_path).replace(os.sep, '/')
+    return zlib.crc32(rel.encode('utf-8')) % shards
+
+
+def shard_port(port, shard):
+    """
+    Return the HAP port of a shard
+
+    :param port: the port of the first shard
+    :type port: int
+
+    :param shard: the shard
+    :type shard: int
+    """
+    return port + shard
+
+
+def shard_state_file(shard, shards):
+    """
+    Return the state file of the driver of a shard. A single shard keeps the
+    default 'accessory.state'.
+
+    :param shard: the shard
+    :type shard: int
+
+    :param shards: the number of shards
+    :type shards: int
+    """
+    if shards <= 1:
+        return 'accessory.state'
+    return 'accessory-{}.state'.format(shard)
+
+
+class Supervisor:
+    """
+    Runs every shard in its own process and restarts shards which exit, with
+    exponential backoff for shards failing repeatedly.
+    """
+
+    def __init__(self, commands, interval=1.0, backoff=None,
+                 first_commands=None):
+        """
+        Init
+
+        :param commands: the command line of every shard
+        :type commands: list of list of str
+
+        :param interval: seconds between two checks of the processes
+        :type interval: float
+
+        :param backoff: creates the Backoff of a shard
+        :type backoff: callable
+
+        :param first_commands: the command line of the first start of every
+            shard, commands by default
+        :type first_commands: list of list of str
+        """
+        self.commands = commands
+        self.first_commands = first_commands or commands
+        self.interval = interval
+        self.backoffs = [(backoff or Backoff)() for _ in commands]
+
+        self.procs = [None] * len(commands)
+        self.started = [0.0] * len(commands)
+        self.restart_at = [0.0] * len(commands)
+        self.restarts = [0] * len(commands)
+        self.stopped = threading.Event()
+
+    def _start(self, shard):
+        logger.info('Starting shard {}'.format(shard))
+        commands = self.commands if self.restarts[shard] else \
+            self.first_commands
+        self.procs[shard] = subprocess.Popen(commands[shard])
+        self.started[shard] = time.monotonic()
+
+    def check(self):
+        """
+        Start shards which are not running
+        """
+        now = time.monotonic()
+        for shard, proc in enumerate(self.procs):
+            if proc is None:
+                if now >= self.restart_at[shard]:
+                    self._start(shard)
+                continue
+
+            code = proc.poll()
+            if code is None:
+                continue
+
+            backoff = self.backoffs[shard]
+            if now - self.started[shard] >= HEALTHY_SECONDS:
+                backoff.reset()
+            delay = backoff.next()
+            logger.warn('Shard {} exited with code {}, restarting in '
+                        '{:.1f}s'.format(shard, code, delay))
+
+            self.procs[shard] = None
+            self.restart_at[shard] = now + delay
+            self.restarts[shard] += 1
+
+    def run(self):
+        """
+        Supervise the shards until stop() is called or SIGTERM is received
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda *args: self.stop())
+
+        try:
+            while not self.stopped.is_set():
+                self.check()
+                self.stopped.wait(self.interval)
+        finally:
+            self.terminate()
+
+    def stop(self):
+        """
+        Stop supervising and terminate the shards
+        """
+        self.stopped.set()
+
+    def terminate(self):
+        """
+        Terminate all running shards
+        """
+        for proc in self.procs:
+            if proc is not None and proc.poll() is None:
+                proc.terminate()
+
+        for shard, proc in enumerate(self.procs):
+            if proc is None:
+                continue
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                logger.warn('Killing shard {}'.format(shard))
+                proc.kill()
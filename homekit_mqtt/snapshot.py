@@ -0,0 +1,59 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+class Snapshot:
+    """
+    File with the last values received for the characteristics, so they can
+    be restored before HomeKit starts after a restart.
+
+    Values are stored by '<aid>.<iid>' of the characteristic together with its
+    input topic. A value is only restored if the characteristic still has the
+    same input topic.
+    """
+
+    def __init__(self, fname):
+        """
+        Init
+
+        :param fname: the snapshot file
+        :type fname: str
+        """
+        self.fname = fname
+
+    def load(self):
+        """
+        Return the stored values as dict mapping keys to (topic, value)
+        """
+        try:
+            with open(self.fname) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        if snapshot.get('version', None) != SNAPSHOT_VERSION:
+            return {}
+
+        return {key: tuple(entry)
+                for key, entry in snapshot['values'].items()}
+
+    def save(self, values):
+        """
+        Atomically replace the stored values
+
+        :param values: dict mapping keys to (topic, value)
+        :type values: dict
+        """
+        tmp = self.fname + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'version': SNAPSHOT_VERSION, 'values': values}, f,
+                          separators=(',', ':'))
+            os.replace(tmp, self.fname)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warn('Could not write "{}": {}'.format(self.fname, e))
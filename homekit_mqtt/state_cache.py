@@ -0,0 +1,163 @@
+import collections
+import threading
+
+from homekit_mqtt.brokers import (DEFAULT_BROKER, broker_topic,
+                                  current_broker, split_topic)
+from homekit_mqtt.topic_trie import TopicTrie, has_wildcards
+
+
+class DeviceStateCache:
+    """
+    Thread-safe cache of device states shared by the input() and output()
+    methods of adapters, which run on the MQTT and the HAP thread.
+
+    Entries are immutable tuples stored by a device key derived from the
+    topic and its broker. Keys are computed once per topic. The cache holds
+    at most maxsize devices and drops the least recently used ones.
+    """
+
+    def __init__(self, key_func, maxsize=4096):
+        """
+        Init
+
+        :param key_func: function returning the device key of a topic
+        :type key_func: callable
+
+        :param maxsize: maximum number of devices
+        :type maxsize: int
+        """
+        self.key_func = key_func
+        self.maxsize = maxsize
+
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.keys = {}
+        # topics the entries were stored with, to evict them by topic filter
+        self.topics = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, topic):
+        """
+        Return the device key of a topic of the current broker (see
+        brokers.current_broker)
+
+        :param topic: the topic
+        :type topic: str
+        """
+        return self._resolve(topic)[1]
+
+    def _resolve(self, topic):
+        # return the topic as used by the MqttBridge and its device key
+        broker = current_broker()
+        if broker != DEFAULT_BROKER:
+            topic = broker_topic(broker, topic)
+
+        key = self.keys.get(topic, None)
+        if key is None:
+            key = self._device_key(topic)
+            if len(self.keys) < 4 * self.maxsize:
+                self.keys[topic] = key
+        return topic, key
+
+    def _device_key(self, topic):
+        # devices of other brokers are kept apart by the name of the broker
+        broker, topic = split_topic(topic)
+        return broker_topic(broker, self.key_func(topic))
+
+    def _store(self, topic, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self.topics.setdefault(key, set()).add(topic)
+        if len(self.entries) > self.maxsize:
+            key, _ = self.entries.popitem(last=False)
+            self.topics.pop(key, None)
+
+    def get(self, topic, default=None):
+        """
+        Return the entry of the device of a topic
+
+        :param topic: the topic
+        :type topic: str
+
+        :param default: returned if there is no entry
+        :type default: tuple
+        """
+        key = self.key(topic)
+        with self.lock:
+            return self.entries.get(key, default)
+
+    def set(self, topic, entry):
+        """
+        Set the entry of the device of a topic
+
+        :param topic: the topic
+        :type topic: str
+
+        :param entry: the new entry
+        :type entry: tuple
+        """
+        topic, key = self._resolve(topic)
+        entry = tuple(entry)
+        with self.lock:
+            self._store(topic, key, entry)
+
+    def update(self, topic, index, value, default):
+        """
+        Atomically replace a single field of an entry and return the new entry
+
+        :param topic: the topic
+        :type topic: str
+
+        :param index: the index of the field
+        :type index: int
+
+        :param value: the new value of the field
+        :type value: object
+
+        :param default: the entry used if there is none yet
+        :type default: tuple
+        """
+        topic, key = self._resolve(topic)
+        with self.lock:
+            entry = self.entries.get(key, default)
+            entry = entry[:index] + (value,) + entry[index + 1:]
+            self._store(topic, key, entry)
+        return entry
+
+    def retain(self, topics):
+        """
+        Evict all devices without any of the given topics. A device is kept
+        if one of the topics maps to its key or one of its topics matches a
+        topic filter with wildcards.
+
+        :param topics: topics and topic filters of the configured devices as
+            used by the MqttBridge (see brokers.broker_topic)
+        :type topics: iterable of str
+        """
+        keys = set()
+        filters = TopicTrie()
+        for topic in topics:
+            if has_wildcards(topic):
+                broker, topic_filter = split_topic(topic)
+                filters.insert(topic_filter, broker)
+            else:
+                keys.add(self._device_key(topic))
+
+        def matches(topic):
+            broker, topic = split_topic(topic)
+            return broker in filters.match(topic)
+
+        with self.lock:
+            for key in list(self.entries):
+                if key in keys:
+                    continue
+                if len(filters) and any(matches(topic)
+                                        for topic in self.topics[key]):
+                    keys.add(key)
+                    continue
+                del self.entries[key]
+                del self.topics[key]
+            self.keys = {topic: key for topic, key in self.keys.items()
+                         if key in keys}
@@ -1,17 +1,35 @@
 import json
 
+from homekit_mqtt.batcher import last_input
+from homekit_mqtt.state_cache import DeviceStateCache
+
+
+def load(payload):
+    """
+    Return the JSON object of a payload, which may already be parsed by the
+    MqttBridge (see the 'json_input' attribute of the adapters)
+    """
+    if isinstance(payload, str):
+        return json.loads(payload)
+    return payload
+
 
 class POWER:
+    json_input = True
+
     def input(topic, payload):
-        if payload[0] != '{':
+        if isinstance(payload, str) and payload[0] != '{':
             return payload == 'ON'
-        result = json.loads(payload)
+        result = load(payload)
         power = result.get('POWER', None)
         if power is None:
             return None
 
         return power == 'ON'
 
+    def input_batch(messages):
+        return last_input(POWER, messages)
+
     def output(topic, payload):
         if bool(payload):
             return 'ON'
@@ -28,63 +46,87 @@ class HOLD:
         return None
 
 
+def device_key(topic):
+    """
+    Return the device part of a Tasmota topic, e.g. 'bulb' for
+    'stat/bulb/RESULT' and 'cmnd/bulb/HSBColor'
+    """
+    return '/'.join(topic.split('/')[1:-1])
+
+
 class HSBColor:
-    cache = {}
+    json_input = True
+    cache = DeviceStateCache(device_key)
 
     def gen_key(topic):
-        return '/'.join(topic.split('/')[1:-1])
+        return HSBColor.cache.key(topic)
 
     def input(topic, payload, chan=0):
         if payload is None:
             return None
 
-        result = json.loads(payload)
+        result = load(payload)
         hsb = result.get('HSBColor', None)
         if hsb is None:
             return None
 
-        hsb = hsb.split(',')
-        HSBColor.cache[HSBColor.gen_key(topic)] = hsb
+        hsb = tuple(int(c) for c in hsb.split(','))
+        HSBColor.cache.set(topic, hsb)
 
-        return int(hsb[chan])
+        return hsb[chan]
 
     def output(topic, payload, chan=0):
-        hsb = HSBColor.cache.get(HSBColor.gen_key(topic), [0, 0, 100])
-        hsb[chan] = payload
-        HSBColor.cache[HSBColor.gen_key(topic)] = hsb
+        hsb = HSBColor.cache.update(topic, chan, int(payload), (0, 0, 100))
+        return ','.join(map(str, hsb))
 
-        hsb = list(map(str, map(int, hsb)))
-        hsb = ','.join(hsb)
-        return hsb
+    def prune(topics):
+        HSBColor.cache.retain(topics)
 
 
 class Hue:
+    json_input = True
+
     def input(topic, payload):
         return HSBColor.input(topic, payload, 0)
 
     def output(topic, payload):
         return HSBColor.output(topic, payload, 0)
 
+    def prune(topics):
+        HSBColor.prune(topics)
+
 
 class Saturation:
+    json_input = True
+
     def input(topic, payload):
         return HSBColor.input(topic, payload, 1)
 
     def output(topic, payload):
         return HSBColor.output(topic, payload, 1)
 
+    def prune(topics):
+        HSBColor.prune(topics)
+
 
 class Brightness:
+    json_input = True
+
     def input(topic, payload):
         return HSBColor.input(topic, payload, 2)
 
     def output(topic, payload):
         return HSBColor.output(topic, payload, 2)
 
+    def prune(topics):
+        HSBColor.prune(topics)
+
 
 class Dimmer:
+    json_input = True
+
     def input(topic, payload):
-        result = json.loads(payload)
+        result = load(payload)
         dimmer = result.get('Dimmer', None)
         return dimmer
 
@@ -93,8 +135,10 @@ class Dimmer:
 
 
 class ColorTemperature:
+    json_input = True
+
     def input(topic, payload):
-        result = json.loads(payload)
+        result = load(payload)
         ct = result.get('CT', None)
         return ct
 
@@ -0,0 +1,139 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Timer:
+    """
+    Handle of a delayed call returned by Timers.call_later()
+    """
+    __slots__ = ('when', 'func', 'args', 'cancelled')
+
+    def __init__(self, when, func, args):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Cancel the call, if it did not run yet
+        """
+        self.cancelled = True
+
+
+class Timers:
+    """
+    Runs delayed calls on a single background thread, which is started with
+    the first call.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+
+    def call_later(self, delay, func, *args):
+        """
+        Call func(*args) after delay seconds
+
+        :param delay: the delay in seconds
+        :type delay: float
+
+        :param func: the function to call
+        :type func: callable
+        """
+        timer = Timer(time.monotonic() + delay, func, args)
+        with self.cond:
+            heapq.heappush(self.heap, (timer.when, next(self.counter), timer))
+            self.running = True
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True,
+                                               name='homekit-mqtt-timers')
+                self.thread.start()
+            self.cond.notify()
+
+        return timer
+
+    def stop(self):
+        """
+        Stop the thread, pending calls are dropped
+        """
+        with self.cond:
+            self.running = False
+            self.heap.clear()
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.running:
+                    now = time.monotonic()
+                    if self.heap and self.heap[0][0] <= now:
+                        timer = heapq.heappop(self.heap)[2]
+                        break
+                    self.cond.wait(self.heap[0][0] - now if self.heap
+                                   else None)
+                else:
+                    self.thread = None
+                    return
+
+            if timer.cancelled:
+                continue
+
+            try:
+                timer.func(*timer.args)
+            except Exception as e:
+                logger.exception('Exception in timer {}: {}'.format(
+                    timer.func, e))
+
+
+class LoopTimers:
+    """
+    Runs delayed calls on an asyncio event loop, with the interface of Timers
+    """
+
+    def __init__(self, loop):
+        """
+        Init
+
+        :param loop: the event loop
+        :type loop: asyncio.AbstractEventLoop
+        """
+        self.loop = loop
+
+    def call_later(self, delay, func, *args):
+        """
+        Call func(*args) after delay seconds on the loop. May be called from
+        any thread.
+
+        :param delay: the delay in seconds
+        :type delay: float
+
+        :param func: the function to call
+        :type func: callable
+        """
+        timer = Timer(time.monotonic() + delay, func, args)
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, self._run,
+                                       timer)
+        return timer
+
+    def stop(self):
+        """
+        Nothing to stop, pending calls end with the loop
+        """
+
+    def _run(self, timer):
+        if timer.cancelled:
+            return
+
+        try:
+            timer.func(*timer.args)
+        except Exception as e:
+            logger.exception('Exception in timer {}: {}'.format(timer.func, e))
@@ -0,0 +1,192 @@
+import collections
+
+
+def has_wildcards(topic):
+    """
+    Check if a topic filter contains the wildcards '+' or '#'
+
+    :param topic: the topic filter
+    :type topic: str
+    """
+    return '+' in topic or '#' in topic
+
+
+def is_valid_filter(topic):
+    """
+    Check if a topic filter is valid: '+' and '#' have to occupy a whole
+    level and '#' has to be the last level.
+
+    :param topic: the topic filter
+    :type topic: str
+    """
+    if not topic:
+        return False
+
+    levels = topic.split('/')
+    for i, level in enumerate(levels):
+        if level == '#':
+            if i != len(levels) - 1:
+                return False
+        elif level != '+' and has_wildcards(level):
+            return False
+
+    return True
+
+
+def covers(topic_filter, other):
+    """
+    Check if every topic matched by other is also matched by topic_filter
+
+    :param topic_filter: the wider topic filter
+    :type topic_filter: str
+
+    :param other: the narrower topic filter or topic
+    :type other: str
+    """
+    levels = topic_filter.split('/')
+    other_levels = other.split('/')
+
+    for i, level in enumerate(levels):
+        if level == '#':
+            return True
+        if i >= len(other_levels):
+            return False
+        if level == '+':
+            if other_levels[i] == '#':
+                return False
+            continue
+        if level != other_levels[i]:
+            return False
+
+    return len(levels) == len(other_levels)
+
+
+class TopicTrie:
+    """
+    Trie of MQTT topic filters, which may contain the wildcards '+' and '#'.
+
+    The cost of match() depends on the number of levels of the topic, not on
+    the number of filters in the trie.
+    """
+
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def insert(self, topic_filter, value):
+        """
+        Add a value for a topic filter
+
+        :param topic_filter: the topic filter
+        :type topic_filter: str
+
+        :param value: value returned by match() for matching topics
+        :type value: object
+        """
+        node = self.root
+        for level in topic_filter.split('/'):
+            node = node.setdefault(level, {})
+
+        # values are stored under the None key of the node
+        node.setdefault(None, []).append(value)
+        self.size += 1
+
+    def match(self, topic):
+        """
+        Return the values of all filters matching a topic
+
+        :param topic: the topic of a message
+        :type topic: str
+        """
+        result = []
+        levels = topic.split('/')
+        # wildcards do not match topics starting with '$' (MQTT 3.1.1, 4.7.2)
+        wildcards = not topic.startswith('$')
+
+        nodes = [self.root]
+        for level in levels:
+            next_nodes = []
+            for node in nodes:
+                if wildcards:
+                    multi = node.get('#', None)
+                    if multi is not None:
+                        result.extend(multi[None])
+                    single = node.get('+', None)
+                    if single is not None:
+                        next_nodes.append(single)
+
+                child = node.get(level, None)
+                if child is not None:
+                    next_nodes.append(child)
+
+            if not next_nodes:
+                return result
+
+            nodes = next_nodes
+            wildcards = True
+
+        for node in nodes:
+            result.extend(node.get(None, ()))
+            # 'a/#' also matches 'a'
+            multi = node.get('#', None)
+            if multi is not None:
+                result.extend(multi[None])
+
+        return result
+
+
+def collapse(topics, threshold):
+    """
+    Reduce a set of topic filters to a small set of subscriptions.
+
+    Filters covered by another filter are removed. Literal topics which only
+    differ in a single level are replaced by a '+' wildcard filter, if it
+    covers at least threshold topics.
+
+    :param topics: topic filters
+    :type topics: iterable of str
+
+    :param threshold: minimum number of topics replaced by a wildcard,
+        0 to disable collapsing
+    :type threshold: int
+    """
+    topics = set(topics)
+    filters = [t for t in topics if has_wildcards(t)]
+    literals = [t for t in topics if not has_wildcards(t)]
+
+    if threshold > 0:
+        # count the literal topics per candidate wildcard
+        candidates = collections.defaultdict(list)
+        for topic in literals:
+            levels = topic.split('/')
+            for i in range(len(levels)):
+                candidate = '/'.join(levels[:i] + ['+'] + levels[i + 1:])
+                candidates[candidate].append(topic)
+
+        covered = set()
+        for candidate, members in sorted(candidates.items(),
+                                         key=lambda c: (-len(c[1]), c[0])):
+            members = [t for t in members if t not in covered]
+            if len(members) < threshold:
+                continue
+
+            filters.append(candidate)
+            covered.update(members)
+
+        literals = [t for t in literals if t not in covered]
+
+    # drop all filters covered by another one
+    filters = sorted(set(filters))
+    result = [t for t in filters
+              if not any(f != t and covers(f, t) for f in filters)]
+
+    trie = TopicTrie()
+    for topic in result:
+        trie.insert(topic, topic)
+
+    result += [t for t in sorted(literals) if not trie.match(t)]
+
+    return result
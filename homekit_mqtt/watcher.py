@@ -0,0 +1,222 @@
+import concurrent.futures
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+MAPPING_KEYS = ('topic_in', 'topic_out', 'adapter', 'options')
+
+
+def layout(acc):
+    """
+    Return everything of an accessory cached by the HomeKit controllers: its
+    name, category, services, characteristics and accessory information
+
+    :param acc: the accessory
+    :type acc: pyhap.accessory.Accessory
+    """
+    services = []
+    for serv in acc.services:
+        info = serv.display_name == 'AccessoryInformation'
+        services.append((serv.type_id, [
+            (char.type_id, char.value if info else None)
+            for char in serv.characteristics]))
+
+    return acc.display_name, acc.category, services
+
+
+def mapping(acc):
+    """
+    Return the broker and polling settings of an accessory and the topics,
+    adapters and options of its characteristics
+
+    :param acc: the accessory
+    :type acc: pyhap.accessory.Accessory
+    """
+    poll = tuple(getattr(acc, key, None)
+                 for key in ('poll_topic', 'poll_payload', 'poll_interval',
+                             'mqtt_broker'))
+    return poll, [tuple(char.properties.get(key, None)
+                        for key in MAPPING_KEYS)
+                  for serv in acc.services for char in serv.characteristics]
+
+
+class ConfigWatcher:
+    """
+    Polls the config directory of a CfgLoader and applies changed accessory
+    configs to a running MqttBridge:
+
+    - accessories of new files are added, those of removed files are removed
+    - accessories of files which cannot be loaded any more are kept
+    - accessories with changed services, characteristics or information are
+      replaced, keeping their AID
+    - accessories with only changed topics, adapters, options or polling
+      settings are remapped
+
+    Only the affected topics are subscribed or unsubscribed. The config
+    number of the bridge is increased only if accessories were added, removed
+    or replaced, so the controllers refetch the accessories.
+    """
+
+    def __init__(self, bridge, loader, interval=5.0):
+        """
+        Init
+
+        :param bridge: the running bridge
+        :type bridge: homekit_mqtt.mqtt_bridge.MqttBridge
+
+        :param loader: the loader which loaded the accessories of the bridge
+        :type loader: homekit_mqtt.cfg_loader.CfgLoader
+
+        :param interval: seconds between two polls
+        :type interval: float
+        """
+        self.bridge = bridge
+        self.loader = loader
+        self.interval = interval
+
+        self.snapshot = self._snapshot()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _snapshot(self):
+        snapshot = {}
+        for fname in self.loader.find_cfgs():
+            try:
+                stat = os.stat(fname)
+            except OSError:
+                continue
+            snapshot[fname] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def start(self):
+        """
+        Start polling in a background thread
+        """
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name='cfg-watcher')
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop polling
+        """
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.warn('Reloading the accessories failed: {}'.format(e))
+
+    def check(self):
+        """
+        Reload the accessories if a config file was added, changed or removed
+        and return if the layout of the bridge changed
+        """
+        snapshot = self._snapshot()
+        if snapshot == self.snapshot:
+            return False
+
+        changed = self.reload()
+
+        # include the AIDs written by the reload
+        self.snapshot = self._snapshot()
+        return changed
+
+    def _call(self, func):
+        """
+        Call func on the event loop of the driver if it is running, so the
+        accessories are not modified while HomeKit requests are served
+        """
+        loop = self.bridge.driver.loop
+        if not loop.is_running():
+            return func()
+
+        future = concurrent.futures.Future()
+
+        def run():
+            try:
+                future.set_result(func())
+            except Exception as e:
+                future.set_exception(e)
+
+        loop.call_soon_threadsafe(run)
+        return future.result()
+
+    def reload(self):
+        """
+        Reload all accessories and apply the differences to the bridge.
+        Return if the layout of the bridge changed.
+        """
+        old = dict(zip((cfg.fname for cfg in self.loader.acc_cfgs),
+                       self.loader.accs))
+        old_cfgs = {cfg.fname: cfg for cfg in self.loader.acc_cfgs}
+        new_accs = self.loader.load_accessories()
+        new_cfgs = self.loader.acc_cfgs
+
+        def apply():
+            counts = {'added': 0, 'removed': 0, 'replaced': 0, 'remapped': 0}
+
+            # remove first, so the AIDs are free for new accessories
+            fnames = set(cfg.fname for cfg in new_cfgs)
+            kept = []
+            for fname in [fname for fname in old if fname not in fnames]:
+                # an invalid file must not remove the accessory from HomeKit
+                if os.path.exists(fname):
+                    logger.warn('Keeping the accessory of "{}" until it '
+                                'can be loaded again'.format(fname))
+                    kept.append(fname)
+                    continue
+                self.bridge.remove_accessory(old.pop(fname))
+                counts['removed'] += 1
+
+            accs = []
+            cfgs = list(new_cfgs)
+            for cfg, new_acc in zip(new_cfgs, new_accs):
+                acc = old.get(cfg.fname, None)
+                if acc is None:
+                    if new_acc.aid in self.bridge.accessories:
+                        new_acc.aid = None
+                    self.bridge.add_accessory(new_acc)
+                    counts['added'] += 1
+                    acc = new_acc
+                elif layout(acc) != layout(new_acc):
+                    self.bridge.remove_accessory(acc)
+                    new_acc.aid = acc.aid
+                    self.bridge.add_accessory(new_acc)
+                    counts['replaced'] += 1
+                    acc = new_acc
+                elif mapping(acc) != mapping(new_acc):
+                    self.bridge.remap_accessory(acc, new_acc)
+                    counts['remapped'] += 1
+                accs.append(acc)
+
+            for fname in kept:
+                accs.append(old[fname])
+                cfgs.append(old_cfgs[fname])
+
+            self.bridge.commit_changes()
+            return accs, cfgs, counts
+
+        accs, cfgs, counts = self._call(apply)
+        logger.info('Reloaded accessories: {added} added, {removed} removed, '
+                    '{replaced} replaced, {remapped} remapped'.format(
+                        **counts))
+
+        # save the AIDs of the accessories in use
+        self.loader.accs = accs
+        self.loader.acc_cfgs = cfgs
+        self.loader.save_accessories()
+
+        changed = counts['added'] + counts['removed'] + counts['replaced'] > 0
+        if changed:
+            try:
+                self.bridge.driver.config_changed()
+            except Exception as e:
+                logger.warn('Could not update the config number: {}'.format(
+                    e))
+
+        return changed
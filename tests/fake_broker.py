@@ -0,0 +1,265 @@
+"""A minimal MQTT 3.1.1 broker for tests and benchmarks."""
+
+import time
+import socket
+import struct
+import threading
+import collections
+
+PACKET_TYPES = {
+    1: 'CONNECT', 3: 'PUBLISH', 4: 'PUBACK', 5: 'PUBREC', 6: 'PUBREL',
+    7: 'PUBCOMP', 8: 'SUBSCRIBE', 10: 'UNSUBSCRIBE', 12: 'PINGREQ',
+    14: 'DISCONNECT'
+}
+
+
+def matches(topic_filter, topic):
+    """Check if a topic matches a topic filter"""
+    levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[i]:
+            return False
+
+    return len(levels) == len(topic_levels)
+
+
+def encode_length(length):
+    """Encode the remaining length of a MQTT packet"""
+    result = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        result.append(byte)
+        if length == 0:
+            return bytes(result)
+
+
+def encode_str(s):
+    s = s.encode('utf-8')
+    return struct.pack('!H', len(s)) + s
+
+
+class Connection:
+    """A connected client"""
+
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+    def send(self, data):
+        with self.lock:
+            self.sock.sendall(data)
+
+    def recv_exactly(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError('closed')
+            data += chunk
+        return data
+
+    def read_packet(self):
+        header = self.recv_exactly(1)[0]
+        length = 0
+        shift = 0
+        while True:
+            byte = self.recv_exactly(1)[0]
+            length += (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+
+        return header >> 4, header & 0x0f, self.recv_exactly(length)
+
+    def publish(self, topic, payload, retain=False):
+        body = encode_str(topic) + payload
+        header = 0x30 | (0x01 if retain else 0x00)
+        self.send(bytes([header]) + encode_length(len(body)) + body)
+
+    def serve(self):
+        try:
+            while True:
+                ptype, flags, body = self.read_packet()
+                self.broker.record(PACKET_TYPES.get(ptype, ptype), body)
+
+                if ptype == 1:
+                    self.send(b'\x20\x02\x00\x00')
+                elif ptype == 3:
+                    self.handle_publish(flags, body)
+                elif ptype == 6:
+                    self.send(b'\x70\x02' + body[:2])
+                elif ptype == 8:
+                    self.handle_subscribe(body)
+                elif ptype == 10:
+                    self.handle_unsubscribe(body)
+                elif ptype == 12:
+                    self.send(b'\xd0\x00')
+                elif ptype == 14:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.broker.disconnected(self)
+            self.sock.close()
+
+    def handle_publish(self, flags, body):
+        qos = (flags >> 1) & 0x03
+        length = struct.unpack('!H', body[:2])[0]
+        topic = body[2:2 + length].decode('utf-8')
+        pos = 2 + length
+        if qos > 0:
+            packet_id = body[pos:pos + 2]
+            pos += 2
+            if qos == 1:
+                self.send(b'\x40\x02' + packet_id)
+            else:
+                self.send(b'\x50\x02' + packet_id)
+
+        self.broker.received(topic, body[pos:], bool(flags & 0x01))
+
+    def handle_subscribe(self, body):
+        packet_id = body[:2]
+        pos = 2
+        granted = bytearray()
+        topics = []
+        while pos < len(body):
+            length = struct.unpack('!H', body[pos:pos + 2])[0]
+            topic = body[pos + 2:pos + 2 + length].decode('utf-8')
+            qos = body[pos + 2 + length]
+            pos += 3 + length
+
+            self.subscriptions[topic] = qos
+            topics.append(topic)
+            granted.append(qos)
+
+        body = packet_id + bytes(granted)
+        self.send(b'\x90' + encode_length(len(body)) + body)
+
+        # retained messages follow the SUBACK
+        for topic in topics:
+            self.broker.subscribed(self, topic)
+
+    def handle_unsubscribe(self, body):
+        pos = 2
+        while pos < len(body):
+            length = struct.unpack('!H', body[pos:pos + 2])[0]
+            topic = body[pos + 2:pos + 2 + length].decode('utf-8')
+            pos += 2 + length
+            self.subscriptions.pop(topic, None)
+
+        self.send(b'\xb0\x02' + body[:2])
+
+
+class FakeBroker:
+    """
+    A MQTT broker on localhost, serving each client in its own thread.
+
+    It counts the received packets by type, remembers the published messages
+    and retained messages and forwards messages to matching subscriptions.
+    """
+
+    def __init__(self, port=0):
+        self.lock = threading.Lock()
+        self.packets = collections.Counter()
+        self.messages = []
+        self.retained = {}
+        self.connections = []
+        self.on_publish = None
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+
+        self.thread = threading.Thread(target=self._accept, daemon=True)
+        self.thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                return
+
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = Connection(self, sock)
+            with self.lock:
+                self.connections.append(conn)
+            threading.Thread(target=conn.serve, daemon=True).start()
+
+    def record(self, ptype, body):
+        with self.lock:
+            self.packets[ptype] += 1
+
+    def disconnected(self, conn):
+        with self.lock:
+            if conn in self.connections:
+                self.connections.remove(conn)
+
+    def subscribed(self, conn, topic):
+        for retained_topic, payload in list(self.retained.items()):
+            if matches(topic, retained_topic):
+                conn.publish(retained_topic, payload, retain=True)
+
+    def received(self, topic, payload, retain):
+        with self.lock:
+            self.messages.append((topic, payload))
+            if retain:
+                self.retained[topic] = payload
+        if self.on_publish is not None:
+            self.on_publish(topic, payload)
+
+    def publish(self, topic, payload, retain=False):
+        """
+        Send a message to all clients with a matching subscription
+        """
+        if retain:
+            self.retained[topic] = payload
+
+        with self.lock:
+            connections = list(self.connections)
+
+        for conn in connections:
+            if any(matches(f, topic) for f in list(conn.subscriptions)):
+                conn.publish(topic, payload)
+
+    def subscriptions(self):
+        """Return all topic filters subscribed by any client"""
+        with self.lock:
+            return {topic: qos for conn in self.connections
+                    for topic, qos in conn.subscriptions.items()}
+
+    def wait_for(self, predicate, timeout=5.0):
+        """Wait until predicate() is true"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if predicate():
+                return True
+            time.sleep(0.01)
+        return False
+
+    def drop_clients(self):
+        """Close the connections of all clients"""
+        with self.lock:
+            connections = list(self.connections)
+        for conn in connections:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+
+    def close(self):
+        self.drop_clients()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
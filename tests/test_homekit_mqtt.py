@@ -6,22 +6,49 @@
 import pytest
 
 import os
+import sys
+import asyncio
+import logging
+import time
 import shutil
+import threading
+import urllib.request
 import configparser
+from unittest import mock
 
 from click.testing import CliRunner
+import paho.mqtt.client as mqtt
 
 from homekit_mqtt import cli
 
+from pyhap.accessory import Accessory, Bridge
 from pyhap.accessory_driver import AccessoryDriver
 import pyhap.characteristic as pyhap_char
+import pyhap.loader as pyhap_loader
 
-from homekit_mqtt import cfg_loader, mqtt_bridge, tasmota
+from homekit_mqtt import cfg_loader, mqtt_bridge, tasmota, topic_trie
+from homekit_mqtt import batcher, json_path, registry
+from homekit_mqtt import metrics
+from homekit_mqtt import shards as shards_mod
+from homekit_mqtt.backoff import Backoff
+from homekit_mqtt.brokers import (DEFAULT_BROKER, broker_topic,
+                                  set_current_broker)
+from homekit_mqtt.inbound import InboundQueue
+from homekit_mqtt.log_channel import LogChannel, parse_level
+from homekit_mqtt.notify import NotifyPolicy
+from homekit_mqtt.poller import Poller, TimerWheel
+from homekit_mqtt.publisher import PublishQueue
+from homekit_mqtt.state_cache import DeviceStateCache
+from homekit_mqtt.timers import Timers
+from homekit_mqtt.watcher import ConfigWatcher
 
+from fake_broker import FakeBroker
 
-@pytest.fixture(scope='module')
-def config_dir():
-    os.makedirs('test_config')
+
+@pytest.fixture
+def config_dir(tmp_path):
+    path = str(tmp_path / 'test_config')
+    os.makedirs(path)
 
     bridge_conf = """
     [Accessory]
@@ -50,18 +77,90 @@ def config_dir():
     CurrentTemperature = stat/Thermometer/DHT11Temperature _ _
     """
 
-    with open(os.path.join('test_config', 'bridge.cfg'), 'w') as f:
+    with open(os.path.join(path, 'bridge.cfg'), 'w') as f:
         f.write(bridge_conf)
 
-    with open(os.path.join('test_config', 'lamp.cfg'), 'w') as f:
+    with open(os.path.join(path, 'lamp.cfg'), 'w') as f:
         f.write(bulb_conf)
 
-    with open(os.path.join('test_config', 'thermo.cfg'), 'w') as f:
+    with open(os.path.join(path, 'thermo.cfg'), 'w') as f:
         f.write(thermo_conf)
 
-    yield 'test_config'
+    yield path
+
+    # the state, cache and values files of the drivers are kept in path
+    shutil.rmtree(path)
+
+
+def make_driver(config_dir, **kwargs):
+    """
+    Return a driver keeping its state file and the files derived from it in
+    config_dir
+    """
+    kwargs.setdefault('port', 51826)
+    kwargs.setdefault('persist_file',
+                      os.path.join(config_dir, 'accessory.state'))
+    return AccessoryDriver(**kwargs)
+
+
+@pytest.fixture
+def make_bridge(config_dir):
+    """
+    Return a function creating a bridge with the accessories of config_dir
+    and a mocked publish() of its MQTT client
+    """
+    def make(persist_file=None, publish=None):
+        if persist_file is None:
+            driver = make_driver(config_dir)
+        else:
+            driver = make_driver(config_dir, persist_file=persist_file)
+        bridge = mqtt_bridge.MqttBridge(config_dir, driver, 'MQTT')
+        bridge.client.publish = publish or mock.Mock()
+
+        loader = cfg_loader.CfgLoader(driver, config_dir)
+        for acc in loader.load_accessories():
+            bridge.add_accessory(acc)
+        loader.save_accessories()
+
+        return bridge
+
+    return make
+
 
-    shutil.rmtree('test_config')
+@pytest.fixture
+def bridge(make_bridge):
+    return make_bridge()
+
+
+@pytest.fixture
+def broker():
+    broker = FakeBroker()
+    yield broker
+    broker.close()
+
+
+def write_bridge_cfg(config_dir, broker, **options):
+    with open(os.path.join(config_dir, 'bridge.cfg'), 'w') as f:
+        f.write('[Accessory]\nDisplayName = MQTT Bridge\n\n[MQTT]\n')
+        f.write('HostName = 127.0.0.1\nPort = {}\n'.format(broker.port))
+        for key, value in options.items():
+            f.write('{} = {}\n'.format(key, value))
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def get_char(bridge, name, char_name):
+    for acc in bridge.accessories.values():
+        if acc.display_name == name:
+            for serv in acc.services[1:]:
+                return serv.get_characteristic(char_name)
 
 
 def test_command_line_interface():
@@ -77,7 +176,7 @@ def test_command_line_interface():
 
 def test_cfg_loader(config_dir):
     # start the accessory driver on port 51826
-    driver = AccessoryDriver(port=51826)
+    driver = make_driver(config_dir)
 
     # load accs
     loader = cfg_loader.CfgLoader(driver, config_dir)
@@ -89,17 +188,124 @@ def test_cfg_loader(config_dir):
     assert 'topic_in' in \
         accs[1].services[1].characteristics[0].properties.keys()
 
-    # save accs
+    # save accs with the aid's assigned by the bridge
+    bridge = Bridge(driver, 'Bridge')
+    for acc in accs:
+        bridge.add_accessory(acc)
     loader.save_accessories()
 
     cfg = configparser.ConfigParser()
     cfg.optionxform = str
-    fname = os.path.join('test_config', 'lamp.cfg')
+    fname = os.path.join(config_dir, 'lamp.cfg')
     cfg.fname = fname
     cfg.read(fname)
 
     assert 'AID' in cfg['Accessory'].keys()
 
+    # characteristics with invalid options are skipped
+    assert cfg_loader.check_options({'qos': '1'}) is None
+    for qos in ('3', 'x', '-1'):
+        assert cfg_loader.check_options({'qos': qos}) is not None
+    assert cfg_loader.check_options({'deadband': '0.5',
+                                     'interval': '10'}) is None
+    for value in ('x', '-1', 'nan'):
+        assert cfg_loader.check_options({'deadband': value}) is not None
+        assert cfg_loader.check_options({'interval': value}) is not None
+    assert cfg_loader.check_options({'path': 'POWER', 'map': 'ON:1'},
+                                    'json') is None
+    for options in ({'map': 'ON'}, {'scale': '0'}, {'index': 'x'}):
+        assert cfg_loader.check_options(options, 'json') is not None
+        assert cfg_loader.check_options(options) is None
+    with open(os.path.join(config_dir, 'plug.cfg'), 'w') as f:
+        f.write('[Accessory]\nCategory = Outlet\n\n[Outlet]\n'
+                'On = stat/Plug/POWER cmnd/Plug/POWER _ qos=3\n'
+                'OutletInUse = stat/Plug/POWER _ _ qos=2\n')
+    plug = [acc for acc in loader.load_accessories()
+            if acc.display_name == 'plug'][0]
+    options = [char.properties.get('options', None)
+               for char in plug.services[1].characteristics]
+    assert {'qos': '3'} not in options
+    assert {'qos': '2'} in options
+
+
+def test_cfg_cache(config_dir):
+    driver = make_driver(config_dir)
+    accs = cfg_loader.CfgLoader(driver, config_dir).load_accessories()
+    assert os.path.exists(os.path.join(config_dir, 'accessory.cache'))
+
+    # unchanged files are not parsed again
+    with mock.patch.object(cfg_loader.CfgLoader, 'read_cfg') as read_cfg:
+        cached = cfg_loader.CfgLoader(driver, config_dir).load_accessories()
+        read_cfg.assert_not_called()
+    assert [acc.display_name for acc in cached] == \
+        [acc.display_name for acc in accs]
+
+    # changed files are
+    fname = os.path.join(config_dir, 'thermo.cfg')
+    with open(fname, 'a') as f:
+        f.write('[HumiditySensor]\n'
+                'CurrentRelativeHumidity = stat/Thermometer/Humidity _ _\n')
+
+    read_cfg = cfg_loader.CfgLoader.read_cfg
+    with mock.patch.object(cfg_loader.CfgLoader, 'read_cfg',
+                           side_effect=read_cfg) as mocked:
+        loader = cfg_loader.CfgLoader(driver, config_dir, workers=2)
+        accs = loader.load_accessories()
+        assert [args[0] for args, _ in mocked.call_args_list] == [fname]
+
+    thermo = [acc for acc in accs if acc.display_name == 'Thermometer'][0]
+    assert len(thermo.services) == 3
+
+
+def test_build_service():
+    hap_loader = pyhap_loader.get_loader()
+    required = hap_loader.serv_types['Thermostat']['RequiredCharacteristics']
+
+    temp = hap_loader.get_char('CurrentTemperature')
+    humidity = hap_loader.get_char('CurrentRelativeHumidity')
+    serv = cfg_loader.build_service(
+        hap_loader, 'Thermostat',
+        {temp.type_id: temp, humidity.type_id: humidity})
+
+    # required characteristics first, configured ones replace the defaults
+    assert [char.display_name for char in serv.characteristics] == \
+        required + ['CurrentRelativeHumidity']
+    assert serv.characteristics[required.index('CurrentTemperature')] is temp
+    assert all(char.service is serv for char in serv.characteristics)
+
+    with pytest.raises(KeyError):
+        cfg_loader.build_service(hap_loader, 'NoService', {})
+
+
+def test_save_accessories(config_dir):
+    def start():
+        driver = make_driver(config_dir)
+        bridge = mqtt_bridge.MqttBridge(config_dir, driver, 'MQTT')
+        loader = cfg_loader.CfgLoader(driver, config_dir)
+        accs = loader.load_accessories()
+        for acc in accs:
+            bridge.add_accessory(acc)
+
+        written = []
+        with mock.patch.object(cfg_loader.CfgLoader, 'write_aid',
+                               side_effect=cfg_loader.CfgLoader.write_aid) \
+                as write_aid:
+            loader.save_accessories()
+            written = [args[0] for args, _ in write_aid.call_args_list]
+
+        return {acc.display_name: acc.aid for acc in accs}, written
+
+    aids, written = start()
+    assert len(written) == 2
+    assert not [f for f in os.listdir(config_dir) if f.endswith('.tmp')]
+
+    # a second start with unchanged config does not write anything
+    assert start() == (aids, [])
+
+    cfg = configparser.ConfigParser()
+    cfg.read(os.path.join(config_dir, 'lamp.cfg'))
+    assert cfg['Accessory']['AID'] == str(aids['Lamp'])
+
 
 def test_mqtt_bridge():
     # test conversion from MQTT to HAP
@@ -115,6 +321,15 @@ def test_mqtt_bridge():
     assert mqtt_bridge.mqtt2hap(
         pyhap_char.HAP_FORMAT_ARRAY, '{"x" : 1, "y" : 2}') == {'x': 1, 'y': 2}
 
+    # bytes and textual booleans
+    assert mqtt_bridge.mqtt2hap(pyhap_char.HAP_FORMAT_BOOL, b'false') is False
+    assert mqtt_bridge.mqtt2hap(pyhap_char.HAP_FORMAT_BOOL, 'OFF') is False
+    assert mqtt_bridge.mqtt2hap(pyhap_char.HAP_FORMAT_BOOL, b'1') is True
+    assert mqtt_bridge.mqtt2hap(pyhap_char.HAP_FORMAT_STRING, b'foo') == 'foo'
+    assert mqtt_bridge.mqtt2hap(pyhap_char.HAP_FORMAT_UINT8, b'42.0') == 42
+    assert mqtt_bridge.mqtt2hap(
+        pyhap_char.HAP_FORMAT_DICTIONARY, b'{"x": 1}') == {'x': 1}
+
     # test conversion from HAP to python types
     assert mqtt_bridge.hap2var(pyhap_char.HAP_FORMAT_BOOL, True) is True
     assert mqtt_bridge.hap2var(pyhap_char.HAP_FORMAT_FLOAT, '3.14') == 3.14
@@ -127,6 +342,7 @@ def test_mqtt_bridge():
 
     assert mqtt_bridge.hap2var(
         pyhap_char.HAP_FORMAT_ARRAY, {'x': 1, 'y': 2}) == '{"x": 1, "y": 2}'
+    assert mqtt_bridge.hap2var(pyhap_char.HAP_FORMAT_STRING, b'foo') == 'foo'
 
 
 def test_tasmota():
@@ -162,3 +378,977 @@ def test_tasmota():
     assert tasmota.ColorTemperature.output('', 140) == 153
     assert tasmota.ColorTemperature.output('', 600) == 500
     assert tasmota.ColorTemperature.output('', 250) == 250
+
+
+def test_decode_payload():
+    assert mqtt_bridge.decode_payload(b'ON') == ('ON', None)
+    assert mqtt_bridge.decode_payload(b'') == ('', None)
+    assert mqtt_bridge.decode_payload(b'{"POWER":"ON"}') == (
+        '{"POWER":"ON"}', {'POWER': 'ON'})
+    assert mqtt_bridge.decode_payload(b'{broken') == ('{broken', None)
+
+    # adapters with json_input accept the parsed payload
+    assert tasmota.POWER.input('', {'POWER': 'OFF'}) is False
+    assert tasmota.Dimmer.input('', {'Dimmer': 42}) == 42
+    assert tasmota.Saturation.input(
+        'stat/test/RESULT', {'HSBColor': '21,42,63'}) == 42
+
+
+def test_json_path(config_dir, make_bridge):
+    def compile(**options):
+        return json_path.compile_adapter(options)
+
+    result = {'POWER': 'ON', 'Dimmer': 42, 'HSBColor': '21,42,63',
+              'Channel': [10, 17, 24], 'CT': 600}
+    power = compile(path='POWER', map='ON:1,OFF:0')
+    hue = compile(path='HSBColor', split=',', index='0')
+    brightness = compile(path='HSBColor', split=',', index='2')
+    assert power.input('', result) == '1'
+    assert power.input('', 'OFF') == '0'
+    assert power.input('', {'Dimmer': 1}) is None
+    assert power.output('', True) == 'ON'
+    assert hue.input('', result) == '21'
+    assert brightness.input('', result) == '63'
+    assert hue.field is brightness.field
+    assert compile(path='Channel.1').input('', result) == 17
+    assert compile(path='CT', clamp='153:500').input('', result) == 500
+    assert compile(path='CT', clamp='153:500').output('', 140) == 153
+    assert compile(path='*.Temperature').input(
+        '', {'Time': '', 'DS18B20': {'Temperature': 21.4}}) == 21.4
+    assert compile(path='Power', scale='0.1').input('', {'Power': 215}) == \
+        pytest.approx(21.5)
+    assert compile(scale='0.1').output('', 21.5) == 215
+    assert compile(map='HOLD:1').input('', 'HOLD') == '1'
+    with pytest.raises(ValueError):
+        compile(map='ON')
+
+    with open(os.path.join(config_dir, 'bulb.cfg'), 'w') as f:
+        f.write('[Accessory]\nCategory = Lightbulb\nDisplayName = Bulb\n\n'
+                '[Lightbulb]\n'
+                'On = stat/Bulb/RESULT cmnd/Bulb/POWER json path=POWER '
+                'map=ON:1,OFF:0\n'
+                'Hue = stat/Bulb/RESULT cmnd/Bulb/HSBColor1 json '
+                'path=HSBColor split=, index=0\n'
+                'Brightness = stat/Bulb/RESULT cmnd/Bulb/HSBColor3 json '
+                'path=HSBColor split=, index=2\n')
+
+    bridge = make_bridge()
+
+    bridge.update_char('stat/Bulb/RESULT',
+                       b'{"POWER":"ON","HSBColor":"21,42,63"}')
+    assert get_char(bridge, 'Bulb', 'On').value is True
+    assert get_char(bridge, 'Bulb', 'Hue').value == 21
+    assert get_char(bridge, 'Bulb', 'Brightness').value == 63
+
+    get_char(bridge, 'Bulb', 'On').client_update_value(False)
+    get_char(bridge, 'Bulb', 'Hue').client_update_value(120)
+    assert [c[0][:2] for c in bridge.client.publish.call_args_list] == [
+        ('cmnd/Bulb/POWER', 'OFF'), ('cmnd/Bulb/HSBColor1', 120)]
+
+
+def test_adapter_registry(bridge):
+    class Occupancy:
+        json_input = True
+
+        def input(topic, payload):
+            return payload['occupancy']
+
+        def output(topic, payload):
+            return None
+
+        def input_batch(messages):
+            # the latest state of the burst wins
+            return messages[-1][1]['occupancy']
+
+    plugin = mock.Mock(spec=['Occupancy'], Occupancy=Occupancy)
+    load = mock.Mock(return_value=plugin)
+    broken = mock.Mock(side_effect=ImportError('missing'))
+
+    with mock.patch('homekit_mqtt.registry.iter_entry_points',
+                    return_value=[('z2m', load), ('broken', broken)]) as eps:
+        reg = registry.AdapterRegistry()
+
+        # built-in adapters do not list the plugins
+        assert reg.resolve('tasmota.POWER') is tasmota.POWER
+        eps.assert_not_called()
+
+        # plugins are loaded on first use and cached
+        assert reg.resolve('z2m.Occupancy') is Occupancy
+        assert reg.resolve('z2m.Occupancy') is Occupancy
+        load.assert_called_once_with()
+        assert reg.resolve('z2m.Unknown') is None
+        assert reg.resolve('broken.Adapter') is None
+        assert reg.resolve('json') is None
+        eps.assert_called_once_with('homekit_mqtt.adapters')
+        assert load.call_count == 1
+
+    assert registry.capabilities(Occupancy) == registry.Capabilities(
+        json_input=True, batch_input=True, prune=False)
+    assert Occupancy.input_batch([('zigbee2mqtt/Hall', {'occupancy': False}),
+                                  ('zigbee2mqtt/Hall', {'occupancy': True})])
+    assert registry.capabilities(tasmota.Hue).prune
+    assert not registry.capabilities(None).json_input
+
+    bridge.registry = reg
+    assert bridge.get_adapter('z2m.Occupancy') is Occupancy
+    assert bridge.get_adapter('tasmota.Nope') is None
+
+
+def test_batch_adapters(config_dir, make_bridge):
+    assert batcher.device_of('stat/Plug/RESULT') == 'Plug'
+    assert batcher.device_of('zigbee2mqtt/Plug') == 'zigbee2mqtt/Plug'
+    assert batcher.device_of(broker_topic('sensors', 'stat/Plug/RESULT')) \
+        == broker_topic('sensors', 'Plug')
+    assert tasmota.POWER.input_batch([('stat/Plug/RESULT', 'ON'),
+                                      ('tele/Plug/STATE', {'Uptime': 1})])
+
+    with open(os.path.join(config_dir, 'bridge.cfg'), 'a') as f:
+        f.write('BatchWindow = 0.05\n')
+    with open(os.path.join(config_dir, 'plug.cfg'), 'w') as f:
+        f.write('[Accessory]\nCategory = Outlet\nDisplayName = Plug\n\n'
+                '[Outlet]\nOn = +/Plug/+ cmnd/Plug/POWER tasmota.POWER\n'
+                'OutletInUse = tele/Plug/STATE _ json path=POWER '
+                'map=ON:1,OFF:0\n')
+
+    bridge = make_bridge()
+    driver = bridge.driver
+    driver.publish = mock.Mock()
+
+    # a burst of a device is applied once, with the latest values
+    bridge.update_char('stat/Plug/RESULT', b'{"POWER":"OFF"}')
+    bridge.update_char('tele/Plug/STATE', b'{"Uptime":"1","POWER":"ON"}')
+    bridge.update_char('tele/Plug/SENSOR', b'{"ENERGY":{"Power":3}}')
+    on = get_char(bridge, 'Plug', 'On')
+    in_use = get_char(bridge, 'Plug', 'OutletInUse')
+    assert on.value is False
+
+    assert wait_for(lambda: 'batches' in bridge.stats)
+    assert on.value is True
+    assert in_use.value is True
+    assert bridge.stats['batches'] == 1
+    assert bridge.stats['batched_messages'] == 4
+    assert driver.publish.call_count == 2
+
+    # adapters without input_batch() are not delayed
+    bridge.update_char('stat/Thermometer/DHT11Temperature', b'21.5')
+    assert get_char(bridge, 'Thermometer',
+                    'CurrentTemperature').value == 21.5
+    bridge.timers.stop()
+
+
+def test_dispatch(bridge):
+    lamp = get_char(bridge, 'Lamp', 'On')
+    thermo = get_char(bridge, 'Thermometer', 'CurrentTemperature')
+
+    bridge.update_char('stat/Lamp/POWER', b'ON')
+    assert lamp.value is True
+    bridge.update_char('stat/Thermometer/DHT11Temperature', b'21.5')
+    assert thermo.value == 21.5
+
+    # unknown topics are reported, but do not raise
+    bridge.update_char('stat/Unknown/POWER', b'ON')
+    assert bridge.client.publish.called
+
+    # a failing adapter does not affect the other routes of the topic
+    class Broken:
+        def input(topic, payload):
+            raise ValueError('broken')
+
+    routes = bridge.routes['stat/Lamp/POWER']
+    bridge.routes = dict(bridge.routes)
+    bridge.routes['stat/Lamp/POWER'] = \
+        (routes[0]._replace(adapter=Broken),) + routes
+
+    bridge.update_char('stat/Lamp/POWER', b'OFF')
+    assert lamp.value is False
+
+
+def test_concurrent_dispatch(bridge):
+    errors = []
+    done = threading.Event()
+
+    def dispatch():
+        i = 0
+        while not done.is_set():
+            try:
+                bridge.update_char('stat/Unknown{}/POWER'.format(i), b'ON')
+                bridge.update_char('stat/Lamp/POWER', b'ON')
+            except Exception as e:
+                errors.append(e)
+            i += 1
+
+    # accessories are added while messages are dispatched
+    thread = threading.Thread(target=dispatch)
+    thread.start()
+    try:
+        for i in range(100):
+            acc = Accessory(bridge.driver, 'Switch{}'.format(i))
+            char = acc.add_preload_service('Switch').get_characteristic('On')
+            char.properties['topic_in'] = 'stat/Switch{}/POWER'.format(i)
+            bridge.add_accessory(acc)
+            bridge.save_values()
+    finally:
+        done.set()
+        thread.join(5.0)
+
+    assert errors == []
+    bridge.update_char('stat/Switch99/POWER', b'1')
+    assert char.value is True
+
+
+def test_topic_trie():
+    trie = topic_trie.TopicTrie()
+    for f in ['a/b', 'a/+', 'a/#', '+/+/c', '#', '$SYS/#']:
+        trie.insert(f, f)
+
+    assert sorted(trie.match('a/b')) == ['#', 'a/#', 'a/+', 'a/b']
+    assert sorted(trie.match('a')) == ['#', 'a/#']
+    assert sorted(trie.match('x/y/c')) == ['#', '+/+/c']
+    assert trie.match('$SYS/uptime') == ['$SYS/#']
+
+    assert topic_trie.is_valid_filter('tele/+/SENSOR')
+    assert not topic_trie.is_valid_filter('tele/#/SENSOR')
+    assert not topic_trie.is_valid_filter('tele/a+/SENSOR')
+
+    topics = ['stat/dev{}/RESULT'.format(i) for i in range(10)]
+    assert topic_trie.collapse(topics, 8) == ['stat/+/RESULT']
+    assert topic_trie.collapse(topics, 0) == sorted(topics)
+    assert topic_trie.collapse(
+        ['tele/+/SENSOR', 'tele/a/SENSOR', 'tele/#'], 0) == ['tele/#']
+
+
+def test_wildcard_dispatch(bridge):
+    thermo = get_char(bridge, 'Thermometer', 'CurrentTemperature')
+    routes = dict(bridge.routes)
+    routes['tele/+/Temperature'] = \
+        routes.pop('stat/Thermometer/DHT11Temperature')
+    bridge.routes = routes
+
+    bridge.update_char('tele/Thermometer/Temperature', b'19.5')
+    assert thermo.value == 19.5
+
+    # unknown topics from collapsed subscriptions are dropped silently
+    bridge.routes['stat/Lamp2/POWER'] = bridge.routes['stat/Lamp/POWER']
+    bridge.collapse_threshold = 2
+    assert ('stat/+/POWER', 0) in bridge.get_subscriptions()
+    bridge.update_char('stat/Other/POWER', b'ON')
+    assert not bridge.client.publish.called
+
+
+def test_batched_subscribe(config_dir, broker):
+    write_bridge_cfg(config_dir, broker, SubscribeChunkSize=2,
+                     CollapseThreshold=0)
+    for i in range(3):
+        with open(os.path.join(config_dir, 'plug{}.cfg'.format(i)), 'w') as f:
+            f.write('[Accessory]\nCategory = Outlet\n\n[Outlet]\n')
+            f.write('On = stat/Plug{0}/POWER cmnd/Plug{0}/POWER tasmota.POWER '
+                    'qos=1\n'.format(i))
+
+    driver = make_driver(config_dir)
+    bridge = mqtt_bridge.MqttBridge(config_dir, driver, 'MQTT')
+    loader = cfg_loader.CfgLoader(driver, config_dir)
+    for acc in loader.load_accessories():
+        bridge.add_accessory(acc)
+
+    bridge.connect()
+    try:
+        assert broker.wait_for(lambda: 'subscribe_seconds' in bridge.stats)
+
+        # 5 topics in chunks of 2
+        assert broker.packets['SUBSCRIBE'] == 3
+        assert bridge.stats['subscriptions'] == 5
+
+        subscriptions = broker.subscriptions()
+        assert subscriptions['stat/Plug0/POWER'] == 1
+        assert subscriptions['stat/Thermometer/DHT11Temperature'] == 0
+    finally:
+        bridge.client.loop_stop()
+        bridge.client.disconnect()
+
+
+def test_asyncio_mode(config_dir, broker):
+    write_bridge_cfg(config_dir, broker)
+
+    driver = make_driver(config_dir)
+    bridge = mqtt_bridge.MqttBridge(config_dir, driver, 'MQTT',
+                                    use_asyncio=True)
+    loader = cfg_loader.CfgLoader(driver, config_dir)
+    for acc in loader.load_accessories():
+        bridge.add_accessory(acc)
+    bridge._compile_dispatch()
+
+    loop = driver.loop
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    bridge.connect()
+    try:
+        assert broker.wait_for(lambda: 'subscribe_seconds' in bridge.stats)
+
+        char = get_char(bridge, 'Thermometer', 'CurrentTemperature')
+        broker.publish('stat/Thermometer/DHT11Temperature', b'23.5')
+        assert wait_for(lambda: char.get_value() == 23.5)
+
+        # timers run on the event loop as well
+        fired = threading.Event()
+        bridge.timers.call_later(0.01, fired.set)
+        assert fired.wait(5.0)
+    finally:
+        loop.call_soon_threadsafe(bridge.aio.stop)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(5.0)
+        loop.run_until_complete(asyncio.sleep(0.01))
+        bridge.client.disconnect()
+
+
+def test_connect_retry(config_dir):
+    # the broker is down at startup
+    broker = FakeBroker()
+    broker.close()
+    write_bridge_cfg(config_dir, broker, ReconnectMin=0.05, ReconnectMax=0.2)
+
+    driver = make_driver(config_dir)
+    bridge = mqtt_bridge.MqttBridge(config_dir, driver, 'MQTT')
+    loader = cfg_loader.CfgLoader(driver, config_dir)
+    for acc in loader.load_accessories():
+        bridge.add_accessory(acc)
+
+    start = time.monotonic()
+    bridge.connect()
+    assert time.monotonic() - start < 0.5
+    assert wait_for(lambda: bridge.backoff.attempts >= 2)
+    assert 'mqtt_connects' not in bridge.stats
+
+    broker = FakeBroker(broker.port)
+    broker.publish('stat/Thermometer/DHT11Temperature', b'19.5', retain=True)
+    try:
+        assert wait_for(lambda: 'mqtt_ready_seconds' in bridge.stats)
+        assert bridge.stats['mqtt_connects'] == 1
+        assert bridge.backoff.attempts == 0
+
+        char = get_char(bridge, 'Thermometer', 'CurrentTemperature')
+        assert wait_for(lambda: char.get_value() == 19.5)
+    finally:
+        bridge.stopped.set()
+        bridge.client.loop_stop()
+        bridge.client.disconnect()
+        broker.close()
+
+
+def test_backoff():
+    backoff = Backoff(1.0, 8.0, rand=lambda: 1.0)
+    assert [backoff.next() for _ in range(5)] == [1.0, 2.0, 4.0, 8.0, 8.0]
+    backoff.reset()
+    assert backoff.next() == 1.0
+
+    backoff = Backoff(1.0, 8.0, rand=lambda: 0.0)
+    assert [backoff.next() for _ in range(3)] == [0.5, 1.0, 2.0]
+
+
+def test_config_watcher(config_dir, broker):
+    write_bridge_cfg(config_dir, broker)
+
+    driver = make_driver(config_dir)
+    driver.config_changed = mock.Mock()
+    bridge = mqtt_bridge.MqttBridge(config_dir, driver, 'MQTT')
+    loader = cfg_loader.CfgLoader(driver, config_dir)
+    for acc in loader.load_accessories():
+        bridge.add_accessory(acc)
+    loader.save_accessories()
+    watcher = ConfigWatcher(bridge, loader)
+
+    bridge.connect()
+    try:
+        assert broker.wait_for(lambda: 'subscribe_seconds' in bridge.stats)
+        assert not watcher.check()
+
+        def write(fname, content):
+            with open(os.path.join(config_dir, fname), 'w') as f:
+                f.write(content)
+
+        # remap a topic
+        thermo = get_char(bridge, 'Thermometer', 'CurrentTemperature')
+        aids = set(bridge.accessories)
+        write('thermo.cfg', '[Accessory]\nCategory = Sensor\n'
+              'DisplayName = Thermometer\n\n[TemperatureSensor]\n'
+              'CurrentTemperature = stat/Thermometer/Temperature _ _\n')
+        assert not watcher.check()
+        assert set(bridge.accessories) == aids
+        assert broker.wait_for(lambda: 'stat/Thermometer/Temperature' in
+                               broker.subscriptions())
+        assert broker.wait_for(lambda: 'stat/Thermometer/DHT11Temperature'
+                               not in broker.subscriptions())
+        broker.publish('stat/Thermometer/Temperature', b'22.5')
+        assert wait_for(lambda: thermo.get_value() == 22.5)
+        driver.config_changed.assert_not_called()
+
+        # add and remove accessories
+        lamp = get_char(bridge, 'Lamp', 'On')
+        bridge.update_char('stat/Lamp/POWER', b'ON')
+        assert lamp in bridge.seen
+        write('plug.cfg', '[Accessory]\nCategory = Outlet\n'
+              'DisplayName = Plug\n\n[Outlet]\n'
+              'On = stat/Plug/POWER cmnd/Plug/POWER json path=POWER '
+              'map=ON:1,OFF:0\n')
+        os.remove(os.path.join(config_dir, 'lamp.cfg'))
+        assert watcher.check()
+        assert driver.config_changed.call_count == 1
+        names = [acc.display_name for acc in bridge.accessories.values()]
+        assert sorted(names) == ['Plug', 'Thermometer']
+
+        # the removed accessory leaves neither values nor adapters behind
+        assert lamp not in bridge.seen
+        assert tasmota.POWER not in bridge.adapters
+        assert len(bridge.adapters) == 1
+        assert broker.wait_for(lambda: 'stat/Plug/POWER' in
+                               broker.subscriptions())
+        assert broker.wait_for(lambda: 'stat/Lamp/POWER' not in
+                               broker.subscriptions())
+
+        # replace an accessory with new services, keeping its aid
+        aid = thermo.service.broker.aid
+        with open(os.path.join(config_dir, 'thermo.cfg'), 'a') as f:
+            f.write('\n[HumiditySensor]\nCurrentRelativeHumidity = '
+                    'stat/Thermometer/Humidity _ _\n')
+        assert watcher.check()
+        assert driver.config_changed.call_count == 2
+        assert len(bridge.accessories[aid].services) == 3
+        assert get_char(bridge, 'Thermometer', 'CurrentTemperature') \
+            is not thermo
+
+        # a file with an error keeps its accessory
+        write('plug.cfg', '[Accessory]\nCategory = Toaster\n')
+        assert not watcher.check()
+        assert driver.config_changed.call_count == 2
+        names = [acc.display_name for acc in bridge.accessories.values()]
+        assert sorted(names) == ['Plug', 'Thermometer']
+    finally:
+        bridge.stopped.set()
+        bridge.client.loop_stop()
+        bridge.client.disconnect()
+
+
+def test_shards(config_dir):
+    for i in range(20):
+        with open(os.path.join(config_dir, 'plug{}.cfg'.format(i)), 'w') as f:
+            f.write('[Accessory]\nCategory = Outlet\n\n[Outlet]\n')
+            f.write('On = stat/Plug{0}/POWER cmnd/Plug{0}/POWER _\n'.format(i))
+
+    def load(shard, shards):
+        driver = make_driver(
+            config_dir, port=shards_mod.shard_port(51826, shard),
+            persist_file=os.path.join(
+                config_dir, shards_mod.shard_state_file(shard, shards)))
+        loader = cfg_loader.CfgLoader(driver, config_dir, shard=shard,
+                                      shards=shards)
+        return sorted(acc.display_name for acc in loader.load_accessories())
+
+    # the shards partition the accessories, independent of other files
+    everything = load(0, 1)
+    parts = [load(shard, 3) for shard in range(3)]
+    assert sorted(sum(parts, [])) == everything
+    assert all(parts)
+
+    os.remove(os.path.join(config_dir, 'plug0.cfg'))
+    assert [load(shard, 3) for shard in range(3)] == \
+        [[name for name in part if name != 'plug0'] for part in parts]
+
+    # a shard over the limit of a bridge does not start
+    with mock.patch.object(cli, 'AccessoryDriver'), \
+            mock.patch.object(cli, 'MqttBridge'), \
+            mock.patch.object(cli.cfg_loader, 'CfgLoader') as loader:
+        loader.return_value.load_accessories.return_value = \
+            [mock.Mock()] * (shards_mod.MAX_ACCESSORIES + 1)
+        result = CliRunner().invoke(cli.main, ['--cfg', config_dir,
+                                               '--shards', '3', '--shard',
+                                               '0'])
+    assert result.exit_code != 0
+    assert '--shards' in result.output
+
+
+def test_supervisor():
+    supervisor = shards_mod.Supervisor(
+        [[sys.executable, '-c', 'import sys; sys.exit(3)'],
+         [sys.executable, '-c', 'import time; time.sleep(60)']],
+        interval=0.01, backoff=lambda: Backoff(0.01, 0.05))
+    thread = threading.Thread(target=supervisor.run)
+    thread.start()
+    try:
+        # the failing shard is restarted, the other one keeps running
+        assert wait_for(lambda: supervisor.restarts[0] >= 3)
+        assert supervisor.restarts[1] == 0
+    finally:
+        supervisor.stop()
+        thread.join(10)
+
+    assert supervisor.procs[1].poll() is not None
+
+    # --reset is only passed to the first start of each shard
+    with mock.patch.object(shards_mod.Supervisor, 'run'), \
+            mock.patch.object(shards_mod.Supervisor, '__init__',
+                              return_value=None) as init:
+        cli.supervise('cfg', True, False, 5.0, 2)
+    commands = init.call_args[0][0]
+    first_commands = init.call_args[1]['first_commands']
+    assert all('--reset' not in command for command in commands)
+    assert [command[:-1] for command in first_commands] == commands
+    assert all(command[-1] == '--reset' for command in first_commands)
+
+
+def test_snapshot(config_dir, make_bridge):
+    def start():
+        bridge = make_bridge(os.path.join(config_dir, 'accessory.state'))
+        bridge.driver.publish = mock.Mock()
+        bridge.restore_values()
+        return bridge
+
+    bridge = start()
+    bridge.update_char('stat/Thermometer/DHT11Temperature', b'21.5')
+    bridge.update_char('stat/Lamp/POWER', b'ON')
+    bridge.save_values()
+
+    fname = os.path.join(config_dir, 'accessory.values')
+    mtime = os.stat(fname).st_mtime_ns
+    bridge.save_values()
+    assert os.stat(fname).st_mtime_ns == mtime
+
+    # restored without events
+    bridge = start()
+    thermo = get_char(bridge, 'Thermometer', 'CurrentTemperature')
+    assert thermo.get_value() == 21.5
+    assert get_char(bridge, 'Lamp', 'On').get_value() is True
+
+    # a retained message with the same value does not fire an event
+    bridge.update_char('stat/Thermometer/DHT11Temperature', b'21.5')
+    bridge.driver.publish.assert_not_called()
+    bridge.update_char('stat/Thermometer/DHT11Temperature', b'22')
+    assert bridge.driver.publish.call_count == 1
+
+    # values of remapped characteristics are not restored
+    with open(os.path.join(config_dir, 'thermo.cfg'), 'w') as f:
+        f.write('[Accessory]\nCategory = Sensor\nDisplayName = Thermometer\n'
+                '\n[TemperatureSensor]\n'
+                'CurrentTemperature = stat/Thermometer/Temperature _ _\n')
+    bridge = start()
+    assert get_char(bridge, 'Thermometer', 'CurrentTemperature') \
+        .get_value() == 0
+
+
+def test_poller(config_dir, make_bridge):
+    wheel = TimerWheel(size=4)
+    wheel.schedule(10, 'item')
+    assert [wheel.advance() for _ in range(10)][-2:] == [[], ['item']]
+
+    now = [1000.0]
+    sent = []
+    stats = {}
+    with mock.patch('homekit_mqtt.poller.time.monotonic', lambda: now[0]):
+        poller = Poller(lambda topic, payload: sent.append(topic),
+                        mock.Mock(), stats, rate=3, timeout=5)
+        entries = [poller.add(i, 'cmnd/Dev{}/STATE'.format(i), '', 10)
+                   for i in range(20)]
+        poller.start()
+
+        def tick():
+            now[0] += 1
+            count = len(sent)
+            poller._tick()
+            return len(sent) - count
+
+        # staggered and rate limited
+        counts = [tick() for _ in range(10)]
+        assert max(counts) <= 3
+        assert sum(counts) >= 10
+        counts += [tick() for _ in range(5)]
+        assert sorted(set(sent)) == sorted(entry.topic for entry in entries)
+
+        # devices reporting by themselves are not polled
+        del sent[:]
+        for _ in range(30):
+            for entry in entries:
+                entry.touch()
+            tick()
+        assert sent == []
+        assert stats['polls_skipped'] >= 20
+
+        # polls on demand, unless fresh or in flight
+        poller.request(entries[0])
+        assert sent == []
+        now[0] += 10
+        poller.request(entries[0])
+        poller.request(entries[0])
+        assert sent == ['cmnd/Dev0/STATE']
+
+    # the tick only runs while devices are polled
+    timers = mock.Mock()
+    poller = Poller(mock.Mock(), timers, {})
+    poller.start()
+    timers.call_later.assert_not_called()
+    poller.add(0, 'cmnd/Dev0/STATE', '', 10)
+    poller.add(1, 'cmnd/Dev1/STATE', '', 10)
+    poller.start()
+    assert timers.call_later.call_count == 1
+    poller._tick()
+    assert timers.call_later.call_count == 2
+    poller.stop()
+    poller._tick()
+    poller.start()
+    assert timers.call_later.call_count == 3
+    poller.remove(0)
+    poller.remove(1)
+    poller._tick()
+    assert timers.call_later.call_count == 3
+
+    with open(os.path.join(config_dir, 'plug.cfg'), 'w') as f:
+        f.write('[Accessory]\nCategory = Outlet\nDisplayName = Plug\n'
+                'PollTopic = cmnd/Plug/STATE\nPollInterval = 60\n\n'
+                '[Outlet]\n'
+                'On = stat/Plug/POWER cmnd/Plug/POWER tasmota.POWER\n')
+
+    bridge = make_bridge()
+
+    # reading a stale value polls the device
+    char = get_char(bridge, 'Plug', 'On')
+    char.get_value()
+    bridge.client.publish.assert_called_once_with('cmnd/Plug/STATE', '', 0)
+
+    bridge.client.publish.reset_mock()
+    bridge.update_char('stat/Plug/POWER', b'ON')
+    assert char.get_value() is True
+    bridge.client.publish.assert_not_called()
+
+
+def test_metrics(config_dir, make_bridge):
+    histogram = metrics.Histogram((0.001, 0.01))
+    for value in [0.0005, 0.005, 0.005, 1.0]:
+        histogram.observe(value)
+    assert histogram.counts == [1, 2, 1]
+    assert histogram.render('t')[:3] == ['t_bucket{le="0.001"} 1',
+                                         't_bucket{le="0.01"} 3',
+                                         't_bucket{le="+Inf"} 4']
+
+    # disabled by default, nothing is wrapped
+    bridge = make_bridge()
+    assert bridge.metrics is None
+    assert 'update_char' not in bridge.__dict__
+
+    with open(os.path.join(config_dir, 'bridge.cfg'), 'a') as f:
+        f.write('\n[Metrics]\nPort = 1\nHost = 127.0.0.1\n')
+
+    bridge = make_bridge(publish=mock.Mock(
+        return_value=mock.Mock(rc=mqtt.MQTT_ERR_SUCCESS)))
+
+    bridge.update_char('stat/Lamp/POWER', b'ON')
+    bridge.update_char('stat/Lamp/POWER', b'')
+    get_char(bridge, 'Lamp', 'On').client_update_value(False)
+    for i in range(3):
+        bridge.update_char('stat/Unknown{}/POWER'.format(i), b'ON')
+
+    bridge.metrics.serve(0, '127.0.0.1')
+    port = bridge.metrics.server.server_address[1]
+    try:
+        with urllib.request.urlopen(
+                'http://127.0.0.1:{}/metrics'.format(port)) as response:
+            text = response.read().decode('utf-8')
+    finally:
+        bridge.metrics.stop()
+
+    assert 'homekit_mqtt_messages_total{topic="stat/Lamp/POWER"} 2' in text
+    assert 'homekit_mqtt_dispatch_seconds_count 5' in text
+    # unknown topics share one series
+    assert 'Unknown' not in text
+    assert 'homekit_mqtt_messages_unmatched_total 3' in text
+    assert 'homekit_mqtt_adapter_seconds_count{adapter="POWER",' \
+        'method="input"} 2' in text
+    assert 'homekit_mqtt_adapter_seconds_count{adapter="POWER",' \
+        'method="output"} 1' in text
+    assert 'homekit_mqtt_adapter_exceptions_total{adapter="POWER",' \
+        'method="input"} 1' in text
+    assert 'homekit_mqtt_publish_sent_total 1' in text
+    assert 'homekit_mqtt_hap_events_total ' in text
+
+
+def test_log_channel(bridge):
+    now = [1000.0]
+    sent = []
+    stats = {}
+    timers = mock.Mock()
+    with mock.patch('homekit_mqtt.log_channel.time.monotonic',
+                    lambda: now[0]):
+        channel = LogChannel(sent.append, timers, stats, rate=1, burst=2,
+                             window=60)
+
+        # repetitions are counted, not sent
+        for _ in range(100):
+            channel.warn('Received unknown topic "a"')
+        assert sent == ['Received unknown topic "a"']
+        assert stats == {'log_suppressed': 99}
+        timers.call_later.assert_called_once_with(60, channel.flush)
+
+        # the token bucket limits distinct messages
+        channel.warn('b')
+        channel.warn('c')
+        assert sent[1:] == ['b']
+        assert stats['log_dropped'] == 1
+        channel.log(logging.DEBUG, 'below the level')
+        assert len(sent) == 2
+
+        now[0] += 60
+        channel.flush()
+        assert sent[2] == \
+            'Received unknown topic "a" (repeated 99 times in 60s)'
+        channel.warn('c')
+        assert sent[3] == 'c'
+
+        # keys beyond MAX_KEYS are still logged locally
+        with mock.patch('homekit_mqtt.log_channel.MAX_KEYS', 1), \
+                mock.patch('homekit_mqtt.log_channel.logger') as log:
+            channel.warn('d')
+            assert log.log.call_args == mock.call(logging.WARNING, 'd')
+        assert sent[4:] == []
+        assert channel.overflow == 1
+
+        # without a window, every message is logged and published
+        channel = LogChannel(sent.append, timers, stats, rate=1, burst=2,
+                             window=0)
+        del sent[:]
+        now[0] += 60
+        channel.warn('e')
+        channel.warn('e')
+        assert sent == ['e', 'e']
+        assert not channel.entries
+
+    # warnings of the bridge use the configured channel
+    assert bridge.log_channel.level == logging.WARNING
+    bridge.update_char('stat/Lamp/POWER', b'')
+    bridge.update_char('stat/Lamp/POWER', b'')
+    bridge.client.publish.assert_called_once_with(
+        'stat/homekit/log', mock.ANY)
+    assert bridge.stats['log_suppressed'] == 1
+    with pytest.raises(ValueError):
+        parse_level('LOUD')
+    assert parse_level('off') > logging.CRITICAL
+
+
+def test_notify_policy():
+    char = mock.Mock()
+    stats = {}
+    timers = Timers()
+
+    # drop unchanged values and values within the deadband
+    policy = NotifyPolicy.from_options(char, timers, stats,
+                                       {'deadband': '0.5'})
+    for value in [20.0, 20.0, 20.3, 21.0]:
+        policy.offer(value)
+    assert [c[0][0] for c in char.set_value.call_args_list] == [20.0, 21.0]
+    assert stats == {'notify_delivered': 2, 'notify_suppressed': 2}
+
+    # deliver the latest value at the end of the interval
+    char.reset_mock()
+    policy = NotifyPolicy.from_options(char, timers, stats,
+                                       {'interval': '0.1'})
+    for value in [1, 2, 3]:
+        policy.offer(value)
+    assert [c[0][0] for c in char.set_value.call_args_list] == [1]
+
+    time.sleep(0.3)
+    assert [c[0][0] for c in char.set_value.call_args_list] == [1, 3]
+    assert policy.delivered == 2
+    assert policy.suppressed == 1
+
+    assert NotifyPolicy.from_options(char, timers, stats, {'qos': 1}) is None
+    timers.stop()
+
+
+def test_inbound_queue():
+    gate = threading.Event()
+    dispatched = []
+
+    def dispatch(topic, payload):
+        gate.wait()
+        dispatched.append((topic, payload))
+
+    # the worker blocks on the first message, the others are queued
+    stats = {}
+    queue = InboundQueue(dispatch, stats, size=4, collapse_depth=2)
+    queue.put('a', 0)
+    assert wait_for(lambda: stats['inbound_depth'] == 0)
+    for topic, payload in [('b', 1), ('c', 2), ('b', 3), ('d', 4), ('e', 5),
+                           ('f', 6)]:
+        queue.put(topic, payload)
+    assert stats['inbound_collapsed'] == 1
+    assert stats['inbound_dropped'] == 1
+    assert stats['inbound_max_depth'] == 4
+
+    gate.set()
+    assert wait_for(lambda: len(dispatched) == 5)
+    assert dispatched == [('a', 0), ('c', 2), ('d', 4), ('e', 5), ('f', 6)]
+    queue.stop()
+
+    stats = {}
+    queue = InboundQueue(dispatched.append, stats, size=1,
+                         policy='drop_newest', loop=mock.Mock())
+    queue.put('a', 0)
+    queue.put('b', 1)
+    assert stats['inbound_dropped'] == 1
+    assert list(queue.queue) == [['a', 0]]
+    queue.loop.call_soon.assert_called_once_with(queue._drain)
+    with pytest.raises(ValueError):
+        InboundQueue(dispatch, {}, policy='random')
+
+
+def test_inbound_dispatch(bridge):
+    message = mock.Mock(topic='stat/Thermometer/DHT11Temperature',
+                        payload=b'21.5')
+    bridge.client.on_message(bridge.client, None, message)
+    char = get_char(bridge, 'Thermometer', 'CurrentTemperature')
+    assert wait_for(lambda: char.value == 21.5)
+    assert bridge.stats['inbound_max_depth'] == 1
+    bridge.inbound.stop()
+
+
+def test_publish_queue():
+    sent = []
+    online = [True]
+
+    def send(topic, value):
+        # a stalled broker must not block other threads publishing
+        assert not queue.lock.locked()
+        if online[0]:
+            sent.append((topic, value))
+        return online[0]
+
+    stats = {}
+    timers = Timers()
+    queue = PublishQueue(send, timers, stats, window=0.1, retry_max=0.2)
+
+    # a slider drag sends the first and the last value
+    for value in range(10):
+        queue.publish('cmnd/test/Dimmer', value)
+    assert sent == [('cmnd/test/Dimmer', 0)]
+    assert wait_for(lambda: len(sent) == 2)
+    assert sent[1] == ('cmnd/test/Dimmer', 9)
+    assert stats == {'publish_sent': 2, 'publish_coalesced': 8}
+
+    # the final value is retried until it is sent
+    online[0] = False
+    queue.publish('cmnd/test/Dimmer', 42)
+    time.sleep(0.3)
+    online[0] = True
+    assert wait_for(lambda: len(sent) == 3)
+    assert sent[2] == ('cmnd/test/Dimmer', 42)
+    timers.stop()
+
+
+def test_state_cache():
+    cache = DeviceStateCache(tasmota.device_key, maxsize=2)
+    cache.set('stat/a/RESULT', [1, 2, 3])
+    assert cache.get('cmnd/a/HSBColor') == (1, 2, 3)
+    assert cache.update('cmnd/b/HSBColor', 1, 50, (0, 0, 100)) == (0, 50, 100)
+
+    # least recently used devices are dropped
+    cache.set('stat/c/RESULT', (7, 8, 9))
+    assert cache.get('stat/a/RESULT') is None
+    assert len(cache) == 2
+
+    # removed devices are evicted
+    cache.retain(['stat/c/RESULT', 'cmnd/c/HSBColor'])
+    assert cache.get('stat/b/RESULT') is None
+    assert cache.get('stat/c/RESULT') == (7, 8, 9)
+
+    # devices of the same name on different brokers are kept apart
+    set_current_broker('sensors')
+    try:
+        assert cache.get('stat/c/RESULT') is None
+        cache.set('stat/c/RESULT', (4, 5, 6))
+    finally:
+        set_current_broker(DEFAULT_BROKER)
+    assert cache.get('stat/c/RESULT') == (7, 8, 9)
+    cache.retain(['stat/c/RESULT', broker_topic('sensors', 'stat/c/RESULT')])
+    assert len(cache) == 2
+
+    # devices matching a wildcard filter are kept
+    cache.retain(['stat/+/RESULT'])
+    assert cache.get('stat/c/RESULT') == (7, 8, 9)
+    assert len(cache) == 1
+    cache.retain([broker_topic('sensors', '#')])
+    assert len(cache) == 0
+
+    # concurrent writes of different channels are not lost
+    def write(adapter, values):
+        for value in values:
+            adapter.output('cmnd/race/HSBColor', value)
+
+    threads = [threading.Thread(target=write, args=(adapter, range(1000)))
+               for adapter in (tasmota.Hue, tasmota.Saturation,
+                               tasmota.Brightness)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert tasmota.HSBColor.cache.get('cmnd/race/HSBColor') == (999, 999, 999)
+
+
+def test_multiple_brokers(config_dir, broker):
+    sensors = FakeBroker()
+    write_bridge_cfg(config_dir, broker)
+    with open(os.path.join(config_dir, 'bridge.cfg'), 'a') as f:
+        f.write('\n[MQTT:sensors]\nHostName = 127.0.0.1\nPort = {}\n'
+                'QoS = 1\n'.format(sensors.port))
+    with open(os.path.join(config_dir, 'thermo.cfg'), 'w') as f:
+        f.write('[Accessory]\nCategory = Sensor\nDisplayName = Thermometer\n'
+                'Broker = sensors\n\n[TemperatureSensor]\nCurrentTemperature'
+                ' = stat/Thermometer/DHT11Temperature _ _\n')
+    with open(os.path.join(config_dir, 'switch.cfg'), 'w') as f:
+        f.write('[Accessory]\nCategory = Switch\nDisplayName = Switch\n\n'
+                '[Switch]\nOn = stat/Lamp/POWER cmnd/Lamp/POWER '
+                'tasmota.POWER broker=sensors\n')
+
+    driver = make_driver(config_dir)
+    bridge = mqtt_bridge.MqttBridge(config_dir, driver, 'MQTT')
+    for acc in cfg_loader.CfgLoader(driver, config_dir).load_accessories():
+        bridge.add_accessory(acc)
+    bridge._compile_dispatch()
+    assert set(bridge.brokers) == {'default', 'sensors'}
+
+    bridge.connect()
+    try:
+        assert broker.wait_for(lambda: 'mqtt_ready_seconds' in bridge.stats)
+        assert broker.subscriptions() == {'stat/Lamp/POWER': 0}
+        assert sensors.subscriptions() == {
+            'stat/Thermometer/DHT11Temperature': 1, 'stat/Lamp/POWER': 1}
+        assert bridge.stats['subscriptions'] == 3
+
+        # each broker has its own dispatching thread
+        thermo = get_char(bridge, 'Thermometer', 'CurrentTemperature')
+        sensors.publish('stat/Thermometer/DHT11Temperature', b'21.5')
+        assert wait_for(lambda: thermo.get_value() == 21.5)
+        assert bridge.brokers['sensors'].inbound is not bridge.inbound
+        assert 'inbound_depth:sensors' in bridge.stats
+        assert 'homekit_mqtt_inbound_depth{broker="sensors"}' in \
+            metrics.Metrics(bridge.stats).render()
+
+        # the same topic of different brokers feeds different characteristics
+        # and adapters receive the topic without the name of the broker
+        lamp = get_char(bridge, 'Lamp', 'On')
+        switch = get_char(bridge, 'Switch', 'On')
+        with mock.patch.object(tasmota.POWER, 'input',
+                               wraps=tasmota.POWER.input) as power_input:
+            sensors.publish('stat/Lamp/POWER', b'ON')
+            assert wait_for(lambda: switch.get_value())
+        power_input.assert_called_once_with('stat/Lamp/POWER', 'ON')
+        assert not lamp.get_value()
+        broker.publish('stat/Lamp/POWER', b'ON')
+        assert wait_for(lambda: lamp.get_value())
+
+        # values set in the Home app are published to the broker of the
+        # characteristic
+        switch.client_update_value(False)
+        assert sensors.wait_for(
+            lambda: ('cmnd/Lamp/POWER', b'OFF') in sensors.messages)
+        assert all(topic != 'cmnd/Lamp/POWER' for topic, _ in broker.messages)
+    finally:
+        for other in bridge.brokers.values():
+            other.client.loop_stop()
+            other.client.disconnect()
+        sensors.close()